@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Backup and restore benchmarks.
+
+Runs ``Runner.backup`` and ``Runner.restore`` against a synthetic vault, with
+``lpass`` replaced by ``benchmarks/bin/lpass``, for every combination of
+codec, encryption, container format and store type asked for. Each case
+records the median and every repeat's latency, the throughput in MB/s of
+export data, the stored size and the peak Python memory allocated, and the
+results are written as json so they can be compared between commits::
+
+    python benchmarks/run.py --records 20000 --output before.json
+    git checkout my-branch
+    python benchmarks/run.py --records 20000 --output after.json --compare before.json
+
+The ``s3`` store uses an in-process moto mock if moto is installed, or any S3
+compatible endpoint (such as a local MinIO) given with ``--s3-endpoint``, and
+is skipped otherwise.
+"""
+import argparse
+import contextlib
+import datetime
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from lp_backup import Runner  # noqa: E402
+import vault  # noqa: E402
+
+CODECS = ['none', 'gzip', 'bz2', 'lzma'] + (
+    ['zstd'] if importlib.util.find_spec('zstandard') else [])
+STORES = ['memory', 'osfs', 's3']
+FORMATS = ['legacy', 'container']
+# a fixed key so every run encrypts the same way
+KEY = 'S1dWQ2ZEUWhfcmQ4WjVpZ2JKV2FlV1o2ZzZJS2NhdGM='
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--attachment-size', type=int, default=0,
+                        help="bytes of incompressible notes per attachment")
+    parser.add_argument('--attachment-every', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--codecs', default=','.join(CODECS))
+    parser.add_argument('--stores', default=','.join(STORES))
+    parser.add_argument('--formats', default=','.join(FORMATS))
+    parser.add_argument('--encryption', default='on,off')
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--compression-workers', default='1')
+    parser.add_argument('--s3-endpoint', default=None)
+    parser.add_argument('--s3-bucket', default='lp-backup-benchmark')
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', default=None,
+                        help="an earlier results file to compare against")
+    return parser.parse_args(argv)
+
+
+@contextlib.contextmanager
+def s3_stand_in(args):
+    """Yield the S3 endpoint to use, None for the moto mock, or raise
+    LookupError if no S3 is available."""
+    if args.s3_endpoint:
+        yield args.s3_endpoint
+        return
+    try:
+        from moto import mock_aws
+    except ImportError:
+        try:
+            from moto import mock_s3 as mock_aws
+        except ImportError:
+            raise LookupError("install moto or pass --s3-endpoint")
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        yield None
+
+
+def store_config(store, workdir, args, endpoint):
+    if store == 'memory':
+        return {'URI': 'mem://'}
+    if store == 'osfs':
+        return {'URI': os.path.join(workdir, 'store')}
+    config = {'Type': 'S3', 'Bucket': args.s3_bucket}
+    if endpoint:
+        config['Endpoint URL'] = endpoint
+    return config
+
+
+def make_bucket(args, endpoint):
+    import boto3
+    client = boto3.client('s3', endpoint_url=endpoint)
+    try:
+        client.create_bucket(Bucket=args.s3_bucket)
+    except client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_case(case, args, export_size, endpoint):
+    store, fmt, codec, encrypted = case
+    with tempfile.TemporaryDirectory() as workdir:
+        config = {
+            'Email': 'benchmark@example.com',
+            'Trust': False,
+            'Encryption Key': KEY if encrypted else None,
+            'Compression': codec,
+            'Compression Workers': args.compression_workers,
+            'Format': fmt,
+            'Streaming': args.streaming,
+            'Prefix': 'bench',
+            'Date': True,
+            'Backing Store': [store_config(store, workdir, args, endpoint)],
+        }
+        config_path = os.path.join(workdir, 'config.yml')
+        with open(config_path, 'w') as config_file:
+            json.dump(config, config_file)
+        restore_path = os.path.join(workdir, 'restored.csv')
+        with Runner(config_path) as runner:
+            backup_times, restore_times = [], []
+            for _ in range(args.repeat):
+                outfile, elapsed = timed(runner.backup)
+                backup_times.append(elapsed)
+                _, elapsed = timed(lambda: runner.restore(outfile, restore_path))
+                restore_times.append(elapsed)
+            stored_size = runner.latest()['size']
+            backup_peak = peak_memory(runner.backup)
+            restore_peak = peak_memory(lambda: runner.restore(outfile, restore_path))
+        if os.path.getsize(restore_path) != export_size:
+            raise RuntimeError(f"{case_key(case)} restored the wrong amount of data")
+    backup_median = statistics.median(backup_times)
+    restore_median = statistics.median(restore_times)
+    return {
+        'case': case_key(case),
+        'store': store,
+        'format': fmt,
+        'codec': codec,
+        'encrypted': encrypted,
+        'streaming': args.streaming,
+        'backup_seconds': backup_median,
+        'backup_seconds_all': backup_times,
+        'backup_mb_per_second': export_size / backup_median / 1e6,
+        'backup_peak_bytes': backup_peak,
+        'restore_seconds': restore_median,
+        'restore_seconds_all': restore_times,
+        'restore_mb_per_second': export_size / restore_median / 1e6,
+        'restore_peak_bytes': restore_peak,
+        'stored_bytes': stored_size,
+        'ratio': export_size / stored_size,
+    }
+
+
+def case_key(case):
+    store, fmt, codec, encrypted = case
+    return f"{store}/{fmt}/{codec}/{'encrypted' if encrypted else 'plain'}"
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=HERE, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True,
+                              universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, previous_path):
+    """Print how each case changed against an earlier results file."""
+    with open(previous_path) as previous_file:
+        previous_report = json.load(previous_file)
+    if previous_report['vault'] != report['vault']:
+        print("warning: the vaults differ, so the results are not comparable")
+    previous = {result['case']: result for result in previous_report['results']}
+    print(f"{'case':40} {'backup':>8} {'restore':>8} {'size':>8}")
+    for result in report['results']:
+        before = previous.get(result['case'])
+        if before is None:
+            continue
+        changes = [result[key] / before[key] for key in
+                   ('backup_seconds', 'restore_seconds', 'stored_bytes')]
+        flag = '  SLOWER' if max(changes[:2]) > 1.1 else ''
+        print(f"{result['case']:40} " + ' '.join(f"{change:8.2f}" for change in changes) + flag)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    export = vault.generate(args.records, args.attachment_size, args.attachment_every)
+    stores = args.stores.split(',')
+    results = []
+    skipped = {}
+    with tempfile.TemporaryDirectory() as vault_dir:
+        vault_path = os.path.join(vault_dir, 'vault.csv')
+        with open(vault_path, 'wb') as vault_file:
+            vault_file.write(export)
+        os.environ['LP_BENCH_VAULT'] = vault_path
+        os.environ['PATH'] = os.path.join(HERE, 'bin') + os.pathsep + os.environ['PATH']
+        with contextlib.ExitStack() as stack:
+            endpoint = None
+            if 's3' in stores:
+                try:
+                    endpoint = stack.enter_context(s3_stand_in(args))
+                    make_bucket(args, endpoint)
+                except LookupError as err:
+                    skipped['s3'] = str(err)
+                    stores.remove('s3')
+            cases = itertools.product(stores, args.formats.split(','), args.codecs.split(','),
+                                      [value == 'on' for value in args.encryption.split(',')])
+            for case in cases:
+                result = run_case(case, args, len(export), endpoint)
+                print(f"{result['case']:40} backup {result['backup_mb_per_second']:7.1f} MB/s  "
+                      f"restore {result['restore_mb_per_second']:7.1f} MB/s  "
+                      f"ratio {result['ratio']:5.2f}")
+                results.append(result)
+    for store, reason in skipped.items():
+        print(f"skipped {store}: {reason}")
+    report = {
+        'commit': git_commit(),
+        'created': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'vault': {'records': args.records, 'attachment_size': args.attachment_size,
+                  'attachment_every': args.attachment_every, 'bytes': len(export)},
+        'repeat': args.repeat,
+        'skipped': skipped,
+        'results': results,
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    if args.compare:
+        compare(report, args.compare)
+    return report
+
+
+if __name__ == '__main__':
+    main()
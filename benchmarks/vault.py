@@ -0,0 +1,50 @@
+"""
+Synthetic lastpass vaults for benchmarks.
+
+The export has the same columns as ``lpass export`` and is deterministic for a
+given seed, so runs on different commits back up the same data.
+"""
+import base64
+import csv
+import io
+import random
+
+FIELDNAMES = ['url', 'username', 'password', 'totp', 'extra', 'name', 'grouping', 'fav']
+WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel',
+         'india', 'juliet', 'kilo', 'lima', 'mike', 'november', 'oscar', 'papa']
+
+
+def generate(records=10000, attachment_size=0, attachment_every=10, seed=0):
+    """
+    Build a vault export.
+
+    :param optional records: the number of records
+    :param optional attachment_size: bytes of random (incompressible) base64
+        data added to the notes of every ``attachment_every``\\ th record, to
+        stand in for secure notes and attachments
+    :param optional attachment_every: how often a record has an attachment
+    :param optional seed: the random seed
+
+    :return: the export as bytes
+    """
+    rng = random.Random(seed)
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(FIELDNAMES)
+    for number in range(records):
+        site = f"{rng.choice(WORDS)}{number}"
+        extra = ''
+        if attachment_size and number % attachment_every == 0:
+            raw = bytes(rng.getrandbits(8) for _ in range(attachment_size * 3 // 4))
+            extra = base64.b64encode(raw).decode('ascii')
+        writer.writerow([
+            f"https://{site}.example.com/login",
+            f"{rng.choice(WORDS)}.{rng.choice(WORDS)}@example.com",
+            ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789!@#$%') for _ in range(20)),
+            '',
+            extra,
+            site,
+            f"{rng.choice(WORDS).title()}\\{rng.choice(WORDS).title()}",
+            rng.choice(['0', '1']),
+        ])
+    return out.getvalue().encode('utf-8')
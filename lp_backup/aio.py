@@ -0,0 +1,162 @@
+"""
+asyncio interface to :class:`lp_backup.Runner`.
+
+``lpass`` runs through ``asyncio.create_subprocess_exec``, so waiting on the
+lastpass export does not hold a thread. Backing store I/O is done by
+pyfilesystem2, which only has a blocking API, so it runs on a bounded thread
+pool shared by every operation instead of on a thread per job. Many accounts
+can be backed up concurrently from one event loop.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+
+from lp_backup import exceptions
+from lp_backup import stream
+from lp_backup.runner import Runner
+
+DEFAULT_IO_WORKERS = 4
+
+
+class AsyncRunner(object):
+    """
+    Coroutine versions of the :class:`lp_backup.Runner` operations.
+
+    Every operation can be cancelled and takes an optional timeout, raising
+    ``asyncio.TimeoutError`` when it runs out. A cancelled or timed out
+    ``lpass`` process is killed, including the export of a streaming backup,
+    which then fails instead of being stored. Store I/O that has already started on the
+    thread pool runs to completion, but its result is discarded. Backups
+    with one runner are run one at a time since they share its manifest;
+    restores and listings can overlap them.
+
+    :param path: the configuration file, as for :class:`lp_backup.Runner`
+    :param keyword filesystem: where the configuration file is, as for
+        :class:`lp_backup.Runner`
+    :param keyword executor: a ``concurrent.futures`` executor to run store
+        I/O on. Share one between runners to bound the threads used by all of
+        them. By default each runner makes its own with ``io_workers``
+        threads.
+    :param keyword io_workers: the size of the default executor
+    :param keyword timeout: default timeout in seconds for each operation
+    """
+    def __init__(self, path, *, filesystem=None, executor=None,
+                 io_workers=DEFAULT_IO_WORKERS, timeout=None):
+        self.runner = Runner(path, filesystem=filesystem)
+        self.timeout = timeout
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=io_workers)
+        self._backup_lock = None
+
+    @property
+    def config(self):
+        return self.runner.config
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the store connections, and the executor if this runner made
+        it."""
+        self.runner.close()
+        if self._own_executor:
+            self.executor.shutdown(wait=False)
+
+    async def login(self, *, timeout=None):
+        """Log in to lastpass, as :meth:`lp_backup.Runner.login`."""
+        stdout, stderr, _ = await self._lpass(self.runner._login_command()[1:],
+                                              timeout)
+        self.runner._check_login(stdout, stderr)
+
+    async def ensure_login(self, *, timeout=None):
+        """Log in only if ``lpass status`` says the session has expired."""
+        _, _, returncode = await self._lpass(["status", "--quiet"], timeout)
+        self.runner.logged_in = returncode == 0
+        if not self.runner.logged_in:
+            await self.login(timeout=timeout)
+
+    async def backup(self, *, timeout=None):
+        """
+        Create a backup, as :meth:`lp_backup.Runner.backup`.
+
+        :param keyword timeout: seconds to allow for the whole backup
+
+        :return: the name of the backup file
+        """
+        if self._backup_lock is None:
+            self._backup_lock = asyncio.Lock()
+        async with self._backup_lock:
+            return await asyncio.wait_for(self._backup(), self._timeout(timeout))
+
+    async def _backup(self):
+        metrics = self.runner.metrics
+        with metrics.operation("backup"):
+            await self._in_executor(metrics.carry(self.runner._prepare_backup))
+            if not self.runner.logged_in:
+                await self.login()
+            if self.runner.settings.streaming:
+                # the streaming pipeline pulls chunks from lpass itself, on the
+                # executor, so it is killed from here if this is cancelled
+                cancellation = stream.Cancellation()
+                try:
+                    return await self._in_executor(
+                        metrics.carry(self.runner._backup_streaming), cancellation)
+                except BaseException:
+                    cancellation.cancel()
+                    raise
+            with metrics.stage("export") as stage:
+                backup_data, errors, _ = await self._lpass(["export"], None)
+                stage["bytes"] = len(backup_data)
+            if errors:
+                raise exceptions.BackupFailed(errors)
+            return await self._in_executor(metrics.carry(self.runner._store_export),
+                                           backup_data)
+
+    async def restore(self, infilename, new_file, *, timeout=None):
+        """Restore a backup, as :meth:`lp_backup.Runner.restore`."""
+        return await self._run(self.runner.restore, infilename, new_file,
+                               timeout=timeout)
+
+    async def list_backups(self, *, timeout=None):
+        """The catalogued backups, as :meth:`lp_backup.Runner.list_backups`."""
+        return await self._run(self.runner.list_backups, timeout=timeout)
+
+    async def latest(self, *, timeout=None):
+        """The newest backup, as :meth:`lp_backup.Runner.latest`."""
+        return await self._run(self.runner.latest, timeout=timeout)
+
+    async def prune(self, dry_run=False, scan=False, *, timeout=None):
+        """Apply the retention policy, as :meth:`lp_backup.Runner.prune`."""
+        return await self._run(self.runner.prune, dry_run, scan, timeout=timeout)
+
+    def _timeout(self, timeout):
+        return self.timeout if timeout is None else timeout
+
+    async def _run(self, func, *args, timeout=None):
+        return await asyncio.wait_for(self._in_executor(func, *args),
+                                      self._timeout(timeout))
+
+    def _in_executor(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def _lpass(self, args, timeout):
+        """Run lpass, killing it if it is cancelled or times out.
+
+        :return: tuple of (stdout, stderr, returncode)
+        """
+        proc = await asyncio.create_subprocess_exec(
+            "lpass", *args, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE, **self.runner._lpass_env())
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(),
+                                                    self._timeout(timeout))
+        except BaseException:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+        return stdout, stderr, proc.returncode
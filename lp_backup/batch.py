@@ -0,0 +1,67 @@
+"""
+Back up many lastpass accounts at once.
+
+Each account runs on its own :class:`lp_backup.Runner`, with its own lastpass
+session directory, on a bounded pool of workers, so a batch takes about as
+long as its accounts divided by the number of workers instead of their sum.
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+DEFAULT_ACCOUNT_WORKERS = 4
+
+AccountResult = namedtuple('AccountResult',
+                           ['email', 'success', 'outfile', 'duration', 'error'])
+
+
+def backup_accounts(runners, max_workers=DEFAULT_ACCOUNT_WORKERS):
+    """
+    Back up each runner's account, ``max_workers`` at a time. A failed
+    account does not stop the others.
+
+    :param runners: the runners to back up, e.g. from
+        :meth:`lp_backup.Runner.accounts`
+    :param optional max_workers: the most accounts to back up at once
+
+    :return: list of :class:`AccountResult` in the order of ``runners``
+    """
+    runners = list(runners)
+    if not runners:
+        return []
+    with ThreadPoolExecutor(max_workers=max(min(int(max_workers), len(runners)), 1)) as executor:
+        return list(executor.map(_backup_account, runners))
+
+
+def _backup_account(runner):
+    email = runner.config.get("Email")
+    start = time.monotonic()
+    try:
+        runner.ensure_login()
+        outfile = runner.backup()
+    except Exception as err:
+        # one account's failure, whatever it is, must not lose the others' results
+        return AccountResult(email, False, None, time.monotonic() - start, err)
+    return AccountResult(email, True, outfile, time.monotonic() - start, None)
+
+
+def summary(results, elapsed):
+    """
+    Describe a batch of backups for people.
+
+    :param results: the results from :func:`backup_accounts`
+    :param elapsed: the wall clock seconds the batch took
+
+    :return: list of lines, one per account and a total
+    """
+    lines = []
+    for result in results:
+        if result.success:
+            lines.append(f"OK      {result.email}  {result.duration:.1f}s  {result.outfile}")
+        else:
+            lines.append(f"FAILED  {result.email}  {result.duration:.1f}s  {result.error}")
+    failed = sum(1 for result in results if not result.success)
+    total = sum(result.duration for result in results)
+    lines.append(f"{len(results) - failed} succeeded, {failed} failed in "
+                 f"{elapsed:.1f}s ({total:.1f}s of backups)")
+    return lines
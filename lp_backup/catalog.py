@@ -0,0 +1,123 @@
+"""
+Catalog of the backups stored under a prefix.
+
+The catalog is a small json file next to the backups listing every backup
+with its time, size, checksum, codec and the backing stores holding it, so
+backups can be listed and the latest one found with a single read instead of
+listing the prefix on every store.
+"""
+import datetime
+import hashlib
+import json
+
+from lp_backup import exceptions
+from lp_backup import file_io
+
+CATALOG_NAME = 'lp_backup-catalog.json'
+
+
+def load(backing_store_fs, prefix=''):
+    """
+    Read the catalog from the backing stores.
+
+    :param backing_store_fs: a pyfilesystem2 object or list of objects
+    :param optional prefix: the prefix the backups are stored under
+
+    :return: the catalog, or an empty one if none has been written yet
+    """
+    try:
+        data = file_io.read_backup(backing_store_fs, CATALOG_NAME, prefix)
+    except exceptions.ConfigurationError:
+        return {'version': 1, 'backups': []}
+    return json.loads(data.decode('utf-8'))
+
+
+def save(backing_store_fs, catalog, prefix='', **policy):
+    """
+    Atomically replace the catalog on the backing stores.
+
+    :param backing_store_fs: a pyfilesystem2 object or list of objects
+    :param catalog: the catalog to write
+    :param optional prefix: the prefix the backups are stored under
+    :param policy: upload options passed on to
+        :func:`lp_backup.file_io.replace_file`
+    """
+    data = json.dumps(catalog, indent=2, sort_keys=True).encode('utf-8')
+    return file_io.replace_file(backing_store_fs, data, CATALOG_NAME, prefix,
+                                **policy)
+
+
+def entry(filename, email, size, checksum, codec, fmt, encrypted, stores,
+          kind='full', depends=None, index=None, md5=None, plaintext_hmac=None,
+          key_id=None):
+    """
+    Describe a new backup for the catalog.
+
+    :param filename: the name of the backup file
+    :param email: the account the backup is for
+    :param size: the size of the stored file in bytes
+    :param checksum: the sha256 hex digest of the stored file
+    :param codec: the compression codec
+    :param fmt: the backup format, ``legacy`` or ``container``
+    :param encrypted: whether the backup is encrypted
+    :param stores: labels of the backing stores holding the backup
+    :param optional kind: ``full`` or ``delta``
+    :param optional depends: backups needed to restore this one
+    :param optional index: the name of the backup's record index, if it has one
+    :param optional md5: the md5 hex digest of the stored file, to compare with
+        S3 ETags
+    :param optional plaintext_hmac: keyed hash of the plaintext, see
+        :func:`lp_backup.manifest.fingerprint`
+    :param optional key_id: the id of the key the backup is encrypted with,
+        see :func:`lp_backup.rotation.key_id`
+    """
+    now = datetime.datetime.today()
+    return {
+        'filename': filename,
+        'email': email,
+        'timestamp': now.timestamp(),
+        'created': now.isoformat(),
+        'size': size,
+        'checksum': checksum,
+        'codec': codec,
+        'format': fmt,
+        'encrypted': encrypted,
+        'kind': kind,
+        'depends': list(depends or []),
+        'stores': list(stores),
+        'index': index,
+        'md5': md5,
+        'plaintext_hmac': plaintext_hmac,
+        'key_id': key_id,
+    }
+
+
+def add(catalog, new_entry):
+    """Add or replace a backup in the catalog."""
+    catalog['backups'] = [backup for backup in catalog['backups']
+                          if backup['filename'] != new_entry['filename']]
+    catalog['backups'].append(new_entry)
+    return catalog
+
+
+def backups(catalog, email=None):
+    """
+    The backups in a catalog, oldest first.
+
+    :param catalog: the catalog loaded with :func:`load`
+    :param optional email: only list backups of this account
+    """
+    found = [backup for backup in catalog['backups']
+             if email is None or backup['email'] == email]
+    return sorted(found, key=lambda backup: backup['timestamp'])
+
+
+def checksum(data):
+    """sha256 hex digest of stored backup data."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def md5(data):
+    """md5 hex digest of stored backup data, as S3 reports it in the ETag of
+    an object uploaded in one part."""
+    return hashlib.md5(data).hexdigest()
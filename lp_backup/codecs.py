@@ -0,0 +1,314 @@
+"""
+Registry of compression codecs.
+
+Every codec has a name used in the configuration and the catalog, a number
+recorded in container headers, the file suffix used for legacy backups and
+the magic bytes its output starts with, so a restore can tell which codec a
+backup was made with. Compression libraries are imported on first use, and
+``zstd`` is only available when the ``zstandard`` package is installed.
+
+Blocks can be compressed on a process pool. Each block is an independent
+compressed stream, and every codec here decompresses concatenated streams, so
+block-compressed data needs nothing special to restore.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import importlib
+import importlib.util
+
+from lp_backup import exceptions
+
+
+class Codec(object):
+    """
+    One compression codec.
+
+    :param name: the name used in the configuration
+    :param id_: the number recorded in container headers
+    :param suffix: the file suffix of legacy backups
+    :param magic: the bytes compressed data starts with
+    :param module: the module implementing the codec
+    :param level_name: the keyword taking the compression level
+    :param levels: tuple of the lowest and highest compression level
+    """
+    def __init__(self, name, id_, suffix='', magic=None, module=None,
+                 level_name=None, levels=None):
+        self.name = name
+        self.id = id_
+        self.suffix = suffix
+        self.magic = magic
+        self.module = module
+        self.level_name = level_name
+        self.levels = levels
+
+    def __repr__(self):
+        return f"Codec({self.name!r})"
+
+    def _module(self):
+        try:
+            return importlib.import_module(self.module)
+        except ImportError:
+            raise exceptions.ConfigurationError(
+                f"The {self.name} codec needs the {self.module} package.")
+
+    def check(self, level=None):
+        """
+        Make sure the codec can be used, without importing it, and that
+        ``level`` is one of its compression levels.
+
+        :raises ConfigurationError: if its package is not installed or the
+            level is out of range
+        """
+        if self.module is not None and importlib.util.find_spec(self.module) is None:
+            raise exceptions.ConfigurationError(
+                f"The {self.name} codec needs the {self.module} package.")
+        if level is not None and self.levels is not None:
+            lowest, highest = self.levels
+            if not lowest <= level <= highest:
+                raise exceptions.ConfigurationError(
+                    f"Compression Level must be from {lowest} to {highest} "
+                    f"for {self.name}, not {level}.")
+
+    def compress(self, data, level=None):
+        """Compress bytes in one go, at the codec's default level unless
+        ``level`` is given."""
+        if self.module is None:
+            return data
+        options = {self.level_name: level} if level is not None else {}
+        return self._module().compress(data, **options)
+
+    def decompress(self, data):
+        """Decompress bytes, including several concatenated streams."""
+        if self.module is None:
+            return data
+        return self._module().decompress(data)
+
+    def compressor(self, level=None):
+        """An object with ``compress`` and ``flush`` methods producing one
+        compressed stream incrementally."""
+        if self.module is None:
+            return _Passthrough()
+        if self.name == 'gzip':
+            import zlib
+            # wbits of 16 + MAX_WBITS writes a gzip header and trailer
+            return zlib.compressobj(9 if level is None else level, zlib.DEFLATED,
+                                    16 + zlib.MAX_WBITS)
+        if self.name == 'lzma':
+            import lzma
+            return lzma.LZMACompressor(preset=level)
+        import bz2
+        return bz2.BZ2Compressor(9 if level is None else level)
+
+    def decompressor(self):
+        """An object with a ``decompress`` method, and ``eof`` and
+        ``unused_data`` attributes, decompressing one stream incrementally."""
+        if self.module is None:
+            return None
+        if self.name == 'gzip':
+            import zlib
+            return _ZlibDecompressor(zlib.decompressobj(16 + zlib.MAX_WBITS))
+        if self.name == 'lzma':
+            import lzma
+            return lzma.LZMADecompressor()
+        import bz2
+        return bz2.BZ2Decompressor()
+
+
+class _Passthrough(object):
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+class _ZlibDecompressor(object):
+    """Give a zlib decompress object the ``eof`` attribute of the others."""
+    def __init__(self, decompressobj):
+        self.decompressobj = decompressobj
+
+    def decompress(self, data):
+        return self.decompressobj.decompress(data)
+
+    @property
+    def eof(self):
+        return self.decompressobj.eof
+
+    @property
+    def unused_data(self):
+        return self.decompressobj.unused_data
+
+
+class ZstdCodec(Codec):
+    """zstd through the optional ``zstandard`` package."""
+    def compress(self, data, level=None):
+        zstandard = self._module()
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+
+    def decompress(self, data):
+        zstandard = self._module()
+        out = []
+        while data:
+            decompressor = zstandard.ZstdDecompressor().decompressobj()
+            out.append(decompressor.decompress(data))
+            data = decompressor.unused_data
+        return b''.join(out)
+
+    def compressor(self, level=None):
+        zstandard = self._module()
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+
+    def decompressor(self):
+        return _ZstdDecompressor(self._module().ZstdDecompressor())
+
+
+class _ZstdDecompressor(object):
+    def __init__(self, decompressor):
+        self._decompressobj = decompressor.decompressobj()
+
+    def decompress(self, data):
+        return self._decompressobj.decompress(data)
+
+    @property
+    def eof(self):
+        return bool(getattr(self._decompressobj, 'eof', False)
+                    or self._decompressobj.unused_data)
+
+    @property
+    def unused_data(self):
+        return self._decompressobj.unused_data
+
+
+CODECS = {
+    'none': Codec('none', 0),
+    'lzma': Codec('lzma', 1, '.xz', b'\xfd7zXZ\x00', 'lzma', 'preset', (0, 9)),
+    'gzip': Codec('gzip', 2, '.gz', b'\x1f\x8b', 'gzip', 'compresslevel', (0, 9)),
+    'bz2': Codec('bz2', 3, '.bz2', b'BZh', 'bz2', 'compresslevel', (1, 9)),
+    'zstd': ZstdCodec('zstd', 4, '.zst', b'\x28\xb5\x2f\xfd', 'zstandard',
+                      levels=(1, 22)),
+}
+
+
+def get(name):
+    """
+    Look a codec up by name.
+
+    :raises ConfigurationError: if there is no such codec
+    """
+    try:
+        return CODECS[str(name).lower()]
+    except KeyError:
+        raise exceptions.ConfigurationError(f"Unknown compression codec {name}.")
+
+
+def by_id(id_):
+    """Look a codec up by the number recorded in container headers."""
+    for codec in CODECS.values():
+        if codec.id == id_:
+            return codec
+    raise exceptions.BackupFailed(f"Unknown compression codec {id_}.")
+
+
+def from_config(compression):
+    """
+    The codec named by the ``Compression`` setting, which is a codec name, or
+    ``true`` for lzma and ``false`` or null for none.
+    """
+    if compression is True:
+        return CODECS['lzma']
+    if compression is False or compression is None:
+        return CODECS['none']
+    if str(compression).lower() in ('true', 'false'):
+        return from_config(str(compression).lower() == 'true')
+    return get(compression)
+
+
+def detect(filename='', data=None):
+    """
+    Work out which codec a legacy backup was compressed with, from its file
+    name suffix or, failing that, from the magic bytes at the start of it.
+
+    :param optional filename: the backup file name
+    :param optional data: the start of the stored data
+
+    :return: the codec, ``none`` if neither gives it away
+    """
+    for codec in CODECS.values():
+        if codec.suffix and filename.endswith(codec.suffix):
+            return codec
+    if isinstance(data, (bytes, bytearray)):
+        for codec in CODECS.values():
+            if codec.magic and data[:len(codec.magic)] == codec.magic:
+                return codec
+    return CODECS['none']
+
+
+def _compress_block(args):
+    name, level, block = args
+    return CODECS[name].compress(block, level)
+
+
+def compress_blocks(blocks, codec, level=None, workers=1):
+    """
+    Compress each block on its own, in order, on a pool of ``workers``
+    processes. At most twice as many blocks as workers are held at once.
+
+    :param blocks: iterable of byte blocks
+    :param codec: the codec to compress with
+    :param optional level: the compression level
+    :param optional workers: the number of processes, 1 to compress in this
+        process
+    """
+    if codec.module is None:
+        yield from blocks
+        return
+    if workers <= 1:
+        for block in blocks:
+            yield codec.compress(block, level)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for block in blocks:
+            pending.append(executor.submit(_compress_block, (codec.name, level, block)))
+            if len(pending) >= workers * 2:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def compress_stream(chunks, codec, level=None):
+    """
+    Compress a stream of chunks into one compressed stream.
+
+    :param chunks: iterable of byte chunks
+    :param codec: the codec to compress with
+    :param optional level: the compression level
+    """
+    compressor = codec.compressor(level)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def decompress_stream(chunks, codec):
+    """
+    Decompress a stream of chunks incrementally, including several
+    concatenated compressed streams such as block-compressed data.
+
+    :param chunks: iterable of compressed byte chunks
+    :param codec: the codec the data was compressed with
+    """
+    if codec.module is None:
+        yield from chunks
+        return
+    decompressor = codec.decompressor()
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            chunk = b''
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                decompressor = codec.decompressor()
@@ -0,0 +1,379 @@
+"""
+Loading and validating the configuration file.
+
+The yaml is parsed once per change of the file: :func:`load` caches the
+parsed mapping and its :class:`Config` by path, and only reads the file again
+when its modification time or size changes, so building many runners from
+the same file is cheap.
+
+:func:`compile` checks every option up front and reports all the problems at
+once, so a bad configuration fails before logging in or exporting the vault.
+``$VARIABLE`` values in backing store settings are read from the environment
+there too, once, and a cached configuration is compiled again when one of
+them changes. The runner keeps the raw mapping as ``config``, with variables
+as written, and reads every option from the read only :class:`Config`.
+"""
+import copy
+import os
+import threading
+import types
+
+from lp_backup import codecs
+from lp_backup import exceptions
+from lp_backup import retention
+
+FORMATS = ('legacy', 'container')
+
+_yaml = None
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _string(value):
+    if not isinstance(value, str):
+        raise ValueError(f"must be text, not {value!r}")
+    return value
+
+
+def _boolean(value):
+    if not isinstance(value, bool):
+        raise ValueError(f"must be true or false, not {value!r}")
+    return value
+
+
+def _number(kind, minimum=None, special=()):
+    def parse(value):
+        if isinstance(value, str) and value.lower() in special:
+            return value.lower()
+        if isinstance(value, bool):
+            raise ValueError(f"must be a number, not {value!r}")
+        try:
+            number = kind(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"must be a number, not {value!r}")
+        if minimum is not None and number < minimum:
+            raise ValueError(f"must be at least {minimum}, not {value!r}")
+        return number
+    return parse
+
+
+def _key(value):
+    if not isinstance(value, (str, bytes)):
+        raise ValueError("must be a key, null or generate")
+    return value
+
+
+def _keys(value):
+    if not isinstance(value, list):
+        raise ValueError("must be a list of keys")
+    for key in value:
+        if not isinstance(key, (str, bytes)):
+            raise ValueError("must be a list of keys")
+    return tuple(value)
+
+
+def _compression(value):
+    try:
+        codec = codecs.from_config(value)
+        codec.check()
+        return codec.name
+    except exceptions.ConfigurationError as err:
+        raise ValueError(str(err))
+
+
+def _format(value):
+    if str(value).lower() not in FORMATS:
+        raise ValueError(f"must be one of {', '.join(FORMATS)}, not {value!r}")
+    return str(value).lower()
+
+
+def _mapping(value):
+    if not isinstance(value, dict):
+        raise ValueError("must be a mapping")
+    return types.MappingProxyType(dict(value))
+
+
+def _retention(value):
+    value = _mapping(value)
+    if not value:
+        return None
+    unknown = set(value) - {name for name, _ in retention.PERIODS}
+    if unknown:
+        raise ValueError(f"unknown periods {', '.join(sorted(unknown))}")
+    try:
+        return types.MappingProxyType(retention.parse_policy(value))
+    except (TypeError, ValueError):
+        raise ValueError("counts must be numbers")
+
+
+def _schedule(value):
+    from lp_backup import schedule
+    try:
+        schedule.parse_schedule(_string(value))
+    except exceptions.ConfigurationError as err:
+        raise ValueError(str(err))
+    return value
+
+
+def _backing_stores(value):
+    if not isinstance(value, list) or not value:
+        raise ValueError("must be a list of stores")
+    return tuple(_backing_store(store, number) for number, store in enumerate(value))
+
+
+REQUIRED_STORE_OPTIONS = {
+    's3': ('Bucket',),
+    'dav': ('Base URL', 'Root', 'Username', 'Password'),
+}
+
+
+def _backing_store(store, number):
+    if not isinstance(store, dict):
+        raise ValueError(f"store {number} must be a mapping")
+    if 'Name' in store and not isinstance(store['Name'], str):
+        raise ValueError(f"store {number} Name must be text")
+    if 'Type' not in store:
+        required = ('URI',)
+    elif str(store['Type']).lower() == 's3':
+        required = REQUIRED_STORE_OPTIONS['s3']
+        for option in ('Part Size', 'Concurrency'):
+            if option in store:
+                if option == 'Part Size':
+                    from lp_backup import s3
+                    parse = _number(float, s3.MIN_PART_SIZE // s3.MIB)
+                else:
+                    parse = _number(int, 1)
+                try:
+                    parse(store[option])
+                except ValueError as err:
+                    raise ValueError(f"store {number} {option} {err}")
+    elif 'dav' in str(store['Type']).lower():
+        required = REQUIRED_STORE_OPTIONS['dav']
+    else:
+        raise ValueError(f"store {number} has unknown Type {store['Type']!r}")
+    missing = [option for option in required if not store.get(option)]
+    if missing:
+        raise ValueError(f"store {number} is missing {', '.join(missing)}")
+    unset = [f"${name}" for name in variables(store) if name not in os.environ]
+    if unset:
+        raise ValueError(f"store {number} refers to unset environment variables "
+                         f"{', '.join(unset)}")
+    return types.MappingProxyType({option: _from_environment(value)
+                                   for option, value in store.items()})
+
+
+def variables(store):
+    """The names of the environment variables a backing store's settings
+    refer to as ``$VARIABLE``."""
+    return [value[1:] for value in store.values()
+            if isinstance(value, str) and value.startswith('$')]
+
+
+def _from_environment(value):
+    if isinstance(value, str) and value.startswith('$'):
+        return os.environ[value[1:]]
+    return value
+
+
+def _accounts(value):
+    if not isinstance(value, list) or not value:
+        raise ValueError("must be a list of accounts")
+    for number, account in enumerate(value):
+        if not isinstance(account, dict) or not account.get('Email'):
+            raise ValueError(f"account {number} needs an Email")
+    return tuple(types.MappingProxyType(dict(account)) for account in value)
+
+
+# attribute, configuration option, parser, default
+FIELDS = (
+    ('email', 'Email', _string, None),
+    ('trust', 'Trust', _boolean, False),
+    ('encryption_key', 'Encryption Key', _key, None),
+    ('previous_keys', 'Previous Encryption Keys', _keys, ()),
+    ('allow_unencrypted', 'Allow Unencrypted', _boolean, False),
+    ('backing_stores', 'Backing Store', _backing_stores, ()),
+    ('prefix', 'Prefix', _string, ''),
+    ('date', 'Date', _boolean, False),
+    ('compression', 'Compression', _compression, 'none'),
+    ('compression_level', 'Compression Level', _number(int), None),
+    ('compression_workers', 'Compression Workers', _number(int, 1, ('auto',)), 1),
+    ('format', 'Format', _format, 'legacy'),
+    ('streaming', 'Streaming', _boolean, False),
+    ('chunk_size', 'Chunk Size', _number(int, 1), None),
+    ('record_index', 'Record Index', _boolean, False),
+    ('skip_unchanged', 'Skip Unchanged', _boolean, False),
+    ('incremental', 'Incremental', _boolean, False),
+    ('full_snapshot_every', 'Full Snapshot Every', _number(int, 0), 24),
+    ('full_snapshot_days', 'Full Snapshot Days', _number(float, 0), 7.0),
+    ('upload_workers', 'Upload Workers', _number(int, 1), None),
+    ('quorum', 'Quorum', _number(int, 1, ('all',)), 'all'),
+    ('upload_retries', 'Upload Retries', _number(int, 0), None),
+    ('retry_delay', 'Retry Delay', _number(float, 0), None),
+    ('spool_directory', 'Spool Directory', _string, None),
+    ('hedge_delay', 'Hedge Delay', _number(float, 0), None),
+    ('verify_workers', 'Verify Workers', _number(int, 1), None),
+    ('sync_workers', 'Sync Workers', _number(int, 1), None),
+    ('rotate_workers', 'Rotate Workers', _number(int, 1), None),
+    ('account_workers', 'Account Workers', _number(int, 1), None),
+    ('retention', 'Retention', _retention, None),
+    ('schedule', 'Schedule', _schedule, None),
+    ('schedule_jitter', 'Schedule Jitter', _number(float, 0), 0.0),
+    ('lpass_home', 'LPASS Home', _string, None),
+    ('metrics', 'Metrics', _mapping, None),
+    ('accounts', 'Accounts', _accounts, ()),
+)
+
+
+class Config(object):
+    """
+    The validated configuration, one attribute per option, named after the
+    option in snake case (``Backing Store`` is ``backing_stores`` and
+    ``Previous Encryption Keys`` is ``previous_keys``). Options that are not
+    set have their default. Build it with :func:`compile`.
+
+    It is read only, mappings included, so one instance can be shared by
+    every runner built from the same file.
+
+    :param optional values: dict of attribute to value
+    """
+    __slots__ = tuple(field[0] for field in FIELDS)
+
+    def __init__(self, values=None):
+        values = values or {}
+        for attribute, _, _, default in FIELDS:
+            object.__setattr__(self, attribute, values.get(attribute, default))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Config is read only, cannot set {name}")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"Config is read only, cannot delete {name}")
+
+    def __repr__(self):
+        return f"Config(email={self.email!r})"
+
+
+def compile(raw, source='the configuration file'):
+    """
+    Validate a parsed configuration. Each entry of ``Accounts`` is checked
+    with its settings laid over the top level ones, as it is run.
+
+    :param raw: the mapping parsed from the yaml
+    :param optional source: what to call the configuration in errors
+
+    :return: a :class:`Config`
+    :raises ConfigurationError: listing every problem found
+    """
+    if not isinstance(raw, dict):
+        raise exceptions.ConfigurationError(f"{source} must be a yaml mapping.")
+    compiled, problems = _check(raw)
+    if not problems and compiled.accounts:
+        top_level = dict(raw)
+        top_level.pop('Accounts')
+        for account in compiled.accounts:
+            _, account_problems = _check(dict(top_level, **account))
+            problems += [f"account {account['Email']}: {problem}"
+                         for problem in account_problems]
+    if problems:
+        raise exceptions.ConfigurationError(
+            f"Invalid options in {source}:\n" + "\n".join(f"  - {problem}"
+                                                       for problem in problems))
+    return compiled
+
+
+def _check(raw):
+    problems = []
+    invalid = set()
+    values = {}
+    for attribute, option, parse, _ in FIELDS:
+        value = raw.get(option)
+        if value is None:
+            continue
+        try:
+            values[attribute] = parse(value)
+        except ValueError as err:
+            problems.append(f"{option} {err}")
+            invalid.add(option)
+    compiled = Config(values)
+    if not invalid & {'Compression', 'Compression Level'}:
+        try:
+            codecs.get(compiled.compression).check(compiled.compression_level)
+        except exceptions.ConfigurationError as err:
+            problems.append(str(err).rstrip('.'))
+    if 'Encryption Key' not in raw:
+        problems.append("Encryption Key is required; set it to null to not encrypt")
+    if not compiled.accounts:
+        if not compiled.email and 'Email' not in invalid:
+            problems.append("Email is required")
+        if not compiled.backing_stores and 'Backing Store' not in invalid:
+            problems.append("Backing Store is required")
+    return compiled, problems
+
+
+def load(path, filesystem=None):
+    """
+    Read and validate a configuration file, reusing the result of an earlier
+    call until the file changes.
+
+    :param path: the path of the yaml file, on the local disk or on
+        ``filesystem``
+    :param optional filesystem: a pyfilesystem2 object holding the file.
+        Files on other filesystems are not cached.
+
+    :return: a tuple of (raw mapping, :class:`Config`). The mapping is the
+        caller's own copy, so changing it does not change the cache, and the
+        :class:`Config` is read only.
+    """
+    path = str(path)
+    if filesystem is not None:
+        with filesystem.open(path, 'r') as configfile:
+            raw = _parse(configfile)
+        return raw, compile(raw, path)
+    cache_key = os.path.abspath(os.path.expanduser(path))
+    try:
+        stat = os.stat(cache_key)
+    except OSError as err:
+        raise exceptions.ConfigurationError(f"Cannot read {path}: {err}")
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _cache_lock:
+        cached = _cache.get(cache_key)
+    if cached is None or cached[0] != version or cached[3] != _environment(cached[1]):
+        with open(cache_key, 'r') as configfile:
+            raw = _parse(configfile)
+        cached = (version, raw, compile(raw, path), _environment(raw))
+        with _cache_lock:
+            _cache[cache_key] = cached
+    return copy.deepcopy(cached[1]), cached[2]
+
+
+def _environment(raw):
+    """The values of the environment variables the backing stores of a
+    parsed configuration refer to."""
+    stores = []
+    for section in [raw] + list(raw.get('Accounts') or []):
+        if isinstance(section, dict) and isinstance(section.get('Backing Store'), list):
+            stores += section['Backing Store']
+    return tuple((name, os.environ.get(name)) for store in stores
+                 if isinstance(store, dict) for name in variables(store))
+
+
+def clear_cache():
+    """Forget every cached configuration."""
+    with _cache_lock:
+        _cache.clear()
+
+
+def yaml():
+    """The shared round-trip yaml parser, which keeps comments on writing."""
+    global _yaml
+    if _yaml is None:
+        from ruamel.yaml import YAML
+        _yaml = YAML()
+    return _yaml
+
+
+def _parse(configfile):
+    try:
+        return yaml().load(configfile)
+    except Exception as err:
+        raise exceptions.ConfigurationError(f"Cannot parse the configuration: {err}")
@@ -0,0 +1,339 @@
+"""
+Versioned, chunked on-disk container for backups.
+
+A container starts with a fixed header recording the format version, the
+compression codec and the cipher, followed by a sequence of frames. Every
+frame is compressed *then* encrypted on its own, so the data is compressed
+while it still has some redundancy and frames can be produced and consumed
+one at a time. A zero length frame marks the end of the container so a
+truncated upload is detected on restore.
+
+Since version 2 the header ends with a random container id, and every
+frame's payload starts with a seal holding the frame's number, whether it is
+the last frame and a hash of the header. The seal is encrypted along with the
+frame, so frames that were dropped, reordered or moved between containers
+are caught on restore even though each frame is its own Fernet token.
+Version 1 containers, without either, are still read.
+
+Encrypted frames hold the raw bytes of the Fernet token rather than its
+url-safe base64 form, which saves a third of the size of the ciphertext.
+
+The header itself is not authenticated, so when a key is configured, a
+container whose header says it is not encrypted is refused unless that is
+explicitly allowed: otherwise flipping the cipher byte would have anyone's
+plaintext restored as the backup.
+"""
+import base64
+import hashlib
+import io
+import os
+import struct
+
+from lp_backup import codecs
+from lp_backup import exceptions
+from lp_backup import stream
+
+MAGIC = b'LPBK'
+VERSION = 2
+SUFFIX = '.lpbk'
+HEADER = struct.Struct('>4sBBB')
+CONTAINER_ID_SIZE = 16
+# the longest header of any version
+MAX_HEADER_SIZE = HEADER.size + CONTAINER_ID_SIZE
+FRAME_HEADER = struct.Struct('>I')
+DIGEST_SIZE = 8
+# frame number, flags and header digest at the start of each frame's payload
+SEAL = struct.Struct(f'>IB{DIGEST_SIZE}s')
+LAST_FRAME = 1
+
+CIPHERS = {'none': 0, 'fernet': 1}
+
+
+def header(codec='lzma', cipher='fernet'):
+    """
+    Build the header for a new container.
+
+    :param optional codec: name of the compression codec used on each frame
+    :param optional cipher: name of the cipher used on each frame
+
+    :return: the header bytes
+    """
+    try:
+        fields = HEADER.pack(MAGIC, VERSION, codecs.get(codec).id, CIPHERS[cipher])
+    except KeyError as err:
+        raise exceptions.ConfigurationError(f"Unknown container option {err}")
+    return fields + os.urandom(CONTAINER_ID_SIZE)
+
+
+def header_size(version):
+    """The length of the header of a container of some version."""
+    return HEADER.size + (CONTAINER_ID_SIZE if version >= 2 else 0)
+
+
+def read_header(data):
+    """
+    Parse a container header.
+
+    :param data: at least the first ``HEADER.size`` bytes of a container.
+        The container id that follows them is not needed.
+
+    :return: a tuple of (version, codec name, cipher name)
+    """
+    magic, version, codec_id, cipher_id = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise exceptions.BackupFailed("Not a backup container.")
+    if version > VERSION:
+        raise exceptions.BackupFailed(f"Unsupported container version {version}.")
+    return version, codecs.by_id(codec_id).name, _name_of(CIPHERS, cipher_id)
+
+
+def is_container(data):
+    """
+    Whether some backup data is a container rather than a legacy backup.
+
+    :param data: the start of the backup data
+    """
+    return isinstance(data, (bytes, bytearray)) and data[:len(MAGIC)] == MAGIC
+
+
+def is_complete(data):
+    """
+    Cheap check that a container was not truncated, without decoding it.
+
+    :param data: the container bytes
+    """
+    return (is_container(data) and len(data) >= HEADER.size + FRAME_HEADER.size
+            and data[-FRAME_HEADER.size:] == FRAME_HEADER.pack(0))
+
+
+def encode_frames(chunks, codec='lzma', fernet=None, level=None, workers=1):
+    """
+    Turn a stream of plaintext chunks into a container, one frame per chunk.
+    Each frame is held back until the next one is ready, so the last frame
+    can be sealed as the last. An empty stream still gets one empty frame.
+
+    :param chunks: iterable of plaintext byte chunks
+    :param optional codec: name of the compression codec
+    :param optional fernet: the Fernet object to encrypt with, or None to
+        leave the frames unencrypted.
+    :param optional level: the compression level
+    :param optional workers: the number of processes compressing frames
+    """
+    head = header(codec, 'fernet' if fernet else 'none')
+    yield head
+    digest = _digest(head)
+    frames = codecs.compress_blocks(_blocks(chunks), codecs.get(codec), level, workers)
+    held = next(frames)
+    number = 0
+    for payload in frames:
+        yield _seal_frame(held, number, 0, digest, fernet)
+        held = payload
+        number += 1
+    yield _seal_frame(held, number, LAST_FRAME, digest, fernet)
+    yield FRAME_HEADER.pack(0)
+
+
+def _blocks(chunks):
+    empty = True
+    for chunk in chunks:
+        if chunk:
+            empty = False
+            yield chunk
+    if empty:
+        yield b''
+
+
+def _seal_frame(payload, number, flags, digest, fernet):
+    payload = SEAL.pack(number, flags, digest) + payload
+    if fernet:
+        payload = base64.urlsafe_b64decode(fernet.encrypt(payload))
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def _digest(head):
+    return hashlib.sha256(head).digest()[:DIGEST_SIZE]
+
+
+def encode(data, codec='lzma', fernet=None, frame_size=stream.CHUNK_SIZE,
+           level=None, workers=1):
+    """
+    Build a complete container from plaintext bytes.
+
+    :param data: the plaintext
+    :param optional codec: name of the compression codec
+    :param optional fernet: the Fernet object to encrypt with
+    :param optional frame_size: the number of plaintext bytes per frame
+    :param optional level: the compression level
+    :param optional workers: the number of processes compressing frames
+
+    :return: the container bytes
+    """
+    chunks = (data[i:i + frame_size] for i in range(0, len(data), frame_size))
+    return b''.join(encode_frames(chunks, codec, fernet, level, workers))
+
+
+def decode_stream(infile, fernet=None, allow_unencrypted=False):
+    """
+    Read a container from a binary file object and yield the plaintext of one
+    frame at a time.
+
+    :param infile: a readable binary file object positioned at the header
+    :param optional fernet: the Fernet object to decrypt with
+    :param optional allow_unencrypted: read a container that is not encrypted
+        even though ``fernet`` is given
+
+    :raises BackupFailed: if the container is malformed, truncated or its
+        frames are missing or out of order, or if it is not encrypted while
+        ``fernet`` is given and that is not allowed
+    :raises InvalidKey: if the container is encrypted and no key is configured
+    """
+    head = _read_header(infile)
+    version, codec_name, cipher = read_header(head)
+    codec = codecs.get(codec_name)
+    _check_cipher(cipher, fernet, allow_unencrypted)
+    number = 0
+    last = version < 2
+    while True:
+        (length,) = FRAME_HEADER.unpack(_read_exactly(infile, FRAME_HEADER.size))
+        if not length:
+            if not last:
+                raise exceptions.BackupFailed("Backup container is missing frames.")
+            return
+        if last and version >= 2:
+            raise exceptions.BackupFailed("Backup container has frames after its last.")
+        payload = _decrypt(_read_exactly(infile, length), cipher, fernet)
+        if version >= 2:
+            payload, last = _unseal(payload, head, number)
+        number += 1
+        yield codec.decompress(payload)
+
+
+def rotate_stream(infile, fernet, plaintext=None):
+    """
+    Re-encrypt a container with the current key of a ``MultiFernet``, one
+    frame at a time. The compressed payloads are left as they are, and a
+    Fernet token's length only depends on its plaintext, so the container
+    keeps its size and every frame keeps its offset. Frame seals are carried
+    over unchanged inside the re-encrypted frames.
+
+    :param infile: a readable binary file object positioned at the header
+    :param fernet: the ``MultiFernet`` holding the current and old keys
+    :param optional plaintext: callable given the plaintext of every frame,
+        which is then also decrypted and decompressed
+
+    :raises BackupFailed: if the container is malformed, truncated or not
+        encrypted
+    """
+    head = _read_header(infile)
+    version, codec_name, cipher = read_header(head)
+    if cipher != 'fernet':
+        raise exceptions.BackupFailed("Backup container is not encrypted.")
+    codec = codecs.get(codec_name)
+    yield head
+    number = 0
+    while True:
+        prefix = _read_exactly(infile, FRAME_HEADER.size)
+        (length,) = FRAME_HEADER.unpack(prefix)
+        if not length:
+            yield prefix
+            return
+        token = base64.urlsafe_b64encode(_read_exactly(infile, length))
+        if plaintext is not None:
+            payload = fernet.decrypt(token)
+            if version >= 2:
+                # the seal is rotated with the frame; check it while it is open
+                payload, _ = _unseal(payload, head, number)
+            plaintext(codec.decompress(payload))
+        number += 1
+        payload = base64.urlsafe_b64decode(fernet.rotate(token))
+        yield FRAME_HEADER.pack(len(payload)) + payload
+
+
+def decode_frame(frame, head, number, fernet=None, allow_unencrypted=False):
+    """
+    Decode one frame read on its own, such as with a ranged read.
+
+    :param frame: the frame bytes, length prefix included
+    :param head: the container's header, or at least its first
+        ``MAX_HEADER_SIZE`` bytes
+    :param number: the position of the frame in the container, from 0
+    :param optional fernet: the Fernet object to decrypt with
+    :param optional allow_unencrypted: as for :func:`decode_stream`
+
+    :return: the frame's plaintext
+    :raises BackupFailed: if the frame is truncated or is not frame
+        ``number`` of this container, or as for :func:`decode_stream`
+    """
+    version, codec, cipher = read_header(head)
+    head = head[:header_size(version)]
+    _check_cipher(cipher, fernet, allow_unencrypted)
+    (length,) = FRAME_HEADER.unpack_from(frame)
+    if len(frame) != FRAME_HEADER.size + length:
+        raise exceptions.BackupFailed("Backup container frame is truncated.")
+    payload = _decrypt(frame[FRAME_HEADER.size:], cipher, fernet)
+    if version >= 2:
+        payload, _ = _unseal(payload, head, number)
+    return codecs.get(codec).decompress(payload)
+
+
+def _check_cipher(cipher, fernet, allow_unencrypted):
+    if cipher == 'fernet' and not fernet:
+        raise exceptions.InvalidKey("Backup is encrypted but no encryption key "
+                                    "is configured.")
+    if cipher == 'none' and fernet and not allow_unencrypted:
+        raise exceptions.BackupFailed(
+            "Backup container is not encrypted but an encryption key is configured. "
+            "Set Allow Unencrypted to restore it.")
+
+
+def _decrypt(payload, cipher, fernet):
+    if cipher == 'fernet':
+        return fernet.decrypt(base64.urlsafe_b64encode(payload))
+    return payload
+
+
+def _unseal(payload, head, number):
+    """Check a frame's seal, returning the compressed data and whether it is
+    the last frame."""
+    if len(payload) < SEAL.size:
+        raise exceptions.BackupFailed("Backup container frame is truncated.")
+    sealed_number, flags, digest = SEAL.unpack_from(payload)
+    if digest != _digest(head):
+        raise exceptions.BackupFailed("Backup container frame belongs to another container.")
+    if sealed_number != number:
+        raise exceptions.BackupFailed(
+            f"Backup container frame {sealed_number} found where frame {number} belongs.")
+    return payload[SEAL.size:], bool(flags & LAST_FRAME)
+
+
+def decode(data, fernet=None, allow_unencrypted=False):
+    """
+    Decode a complete container held in memory.
+
+    :param data: the container bytes
+    :param optional fernet: the Fernet object to decrypt with
+    :param optional allow_unencrypted: as for :func:`decode_stream`
+
+    :return: the plaintext
+    """
+    return b''.join(decode_stream(io.BytesIO(data), fernet, allow_unencrypted))
+
+
+def _read_header(infile):
+    head = _read_exactly(infile, HEADER.size)
+    version = read_header(head)[0]
+    return head + _read_exactly(infile, header_size(version) - HEADER.size)
+
+
+def _read_exactly(infile, size):
+    data = infile.read(size)
+    if len(data) != size:
+        raise exceptions.BackupFailed("Backup container is truncated.")
+    return data
+
+
+def _name_of(table, value):
+    for name, id_ in table.items():
+        if id_ == value:
+            return name
+    raise exceptions.BackupFailed(f"Unknown container option {value}.")
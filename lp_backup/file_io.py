@@ -1,16 +1,67 @@
-import botocore
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import contextlib
+import io
+import queue
+import random
+import sys
+import threading
+import time
+import weakref
+
 import fs
-from fs.copy import copy_file
 from fs.errors import DirectoryExists
-from fs import tempfs
 
 from lp_backup import exceptions
 
+MAX_UPLOAD_WORKERS = 8
+UPLOAD_RETRIES = 3
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30.0
+MAX_DELETE_WORKERS = 16
+S3_DELETE_BATCH = 1000
+# chunks of a streamed backup waiting for each store
+STREAM_QUEUE_DEPTH = 4
+# seconds between checks that the other end of a stream is still there
+PIPE_POLL = 0.1
+PIPE_READ_SIZE = 1024 * 1024
+
+_labels = weakref.WeakKeyDictionary()
+_labels_lock = threading.Lock()
+# (store label, prefix) to the lock guarding the catalog and manifest there
+_index_locks = {}
+
+StoreResult = namedtuple('StoreResult', ['store', 'success', 'bytes_written',
+                                         'duration', 'error'])
+StoreResult.__doc__ = """
+The outcome of writing a backup to one backing store.
+
+:param store: the backing store filesystem
+:param success: whether the backup was written
+:param bytes_written: the number of bytes written
+:param duration: seconds spent writing to the store
+:param error: the exception raised by the store, if any
+"""
+
+DeleteResult = namedtuple('DeleteResult', ['store', 'deleted', 'errors'])
+DeleteResult.__doc__ = """
+The outcome of deleting backups from one backing store.
+
+:param store: the backing store filesystem
+:param deleted: the names of the files that are gone from the store
+:param errors: dict of file name to the error that stopped it being deleted
+"""
 
-def write_out_backup(backing_store_fs, data, outfile, prefix=''):
+
+def write_out_backup(backing_store_fs, data, outfile, prefix='', *,
+                     max_workers=None, quorum=None, retries=UPLOAD_RETRIES,
+                     retry_delay=RETRY_DELAY, spool=None):
     """
-    Write the backup data to its final location. A backing store is required
-    and either a filepath to the packaged backup or the tmp filesystem is required.
+    Write the backup data to its final location. The data is uploaded straight
+    from memory to each backing store without staging it on local disk.
+    When there are several backing stores they are written to concurrently,
+    and each store is retried on its own, so one failing store neither holds
+    up nor aborts the others.
 
     :param backing_store_fs: a pyfilesystem2 object to be the final storage
             location of the backup. (should be `OSFS`, `S3FS`, `FTPFS`, etc.)
@@ -23,29 +74,224 @@ def write_out_backup(backing_store_fs, data, outfile, prefix=''):
             This is can be a good place to encode some information about the
             backup. A slash will be appended to the prefix to create
             a directory or pseudo-directory structure.
+    :param keyword max_workers: the most stores to write to at once. Defaults
+            to one thread per store, up to ``MAX_UPLOAD_WORKERS``.
+    :param keyword quorum: how many stores must be written successfully. By
+            default every store must succeed.
+    :param keyword retries: how many more times to try a store after it
+            fails, see :func:`with_retries`.
+    :param keyword retry_delay: the base delay between tries in seconds.
+    :param keyword spool: a :class:`~lp_backup.spool.Spool` to keep the
+            backup in for stores that still fail, so a later run can deliver
+            it. Spooled copies count towards the quorum.
 
+    :return: a list of :class:`StoreResult`, one per backing store, in order.
+    :raises BackupFailed: if fewer stores than the quorum were written.
     """
+    return _write_all(backing_store_fs, data, outfile, prefix, max_workers,
+                      quorum, retries=retries, retry_delay=retry_delay, spool=spool)
+
+
+def replace_file(backing_store_fs, data, outfile, prefix='', *,
+                 max_workers=None, quorum=None, retries=UPLOAD_RETRIES,
+                 retry_delay=RETRY_DELAY, spooled=()):
+    """
+    Atomically write or replace a small file, such as the catalog, on the
+    backing stores. The data is written to a ``.partial`` file which is then
+    moved over ``outfile``, so readers never see a half written file.
+
+    Takes the same arguments and returns the same results as
+    :func:`write_out_backup`, except that nothing is spooled: an old copy of
+    a file like the catalog must not be delivered over a newer one later.
+    Instead:
+
+    :param keyword spooled: labels of the stores with backups waiting in the
+            spool. A failure on one of them counts towards the quorum, as
+            delivering its backups later writes the file to it again.
+    """
+    return _write_all(backing_store_fs, data, outfile, prefix, max_workers,
+                      quorum, atomic=True, retries=retries, retry_delay=retry_delay,
+                      spooled=spooled)
+
+
+def _write_all(backing_store_fs, data, outfile, prefix, max_workers, quorum,
+               atomic=False, retries=UPLOAD_RETRIES, retry_delay=RETRY_DELAY,
+               spool=None, spooled=()):
     if prefix and not prefix[-1] == '/':
         prefix = prefix + '/'
     if not isinstance(backing_store_fs, list):
         backing_store_fs = [backing_store_fs]
-    for backing_fs in backing_store_fs:
-        # print(backing_fs)
-        tmp = tempfs.TempFS()
-        with tmp.open("lp-tmp-backup", 'wb') as tmp_file:
-            tmp_file.write(data)
+    if max_workers is None:
+        max_workers = min(len(backing_store_fs), MAX_UPLOAD_WORKERS)
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        futures = [executor.submit(_timed_write, backing_fs, data, outfile, prefix,
+                                   atomic, retries, retry_delay)
+                   for backing_fs in backing_store_fs]
+        results = [future.result() for future in futures]
+    waiting = sum(1 for result in results
+                  if not result.success and store_label(result.store) in spooled)
+    if spool is not None:
+        for result in results:
+            if not result.success:
+                spool.add(result.store, prefix + outfile, data)
+                waiting += 1
+    _check_quorum(results, quorum, waiting)
+    return results
+
+
+def _timed_write(backing_fs, data, outfile, prefix, atomic=False,
+                 retries=UPLOAD_RETRIES, retry_delay=RETRY_DELAY):
+    start = time.monotonic()
+    try:
+        with_retries(lambda: _write_to_store(backing_fs, data, outfile, prefix, atomic),
+                     retries, retry_delay)
+    except Exception as err:
+        discard_upload(backing_fs, prefix + outfile + ('.partial' if atomic else ''))
+        return StoreResult(backing_fs, False, 0, time.monotonic() - start, err)
+    return StoreResult(backing_fs, True, len(data), time.monotonic() - start, None)
+
+
+def with_retries(func, retries=UPLOAD_RETRIES, delay=RETRY_DELAY):
+    """
+    Call ``func``, trying again after errors that may be transient, such as
+    throttling or a dropped connection. Each wait is drawn at random from zero
+    up to ``delay`` doubled for every failed try (capped at
+    ``MAX_RETRY_DELAY``), so clients that failed together don't retry in step.
+    Errors that won't go away by trying again, like a closed filesystem or a
+    permission error, are raised straight away.
+
+    :param func: callable taking no arguments
+    :param optional retries: how many more times to try after the first
+    :param optional delay: the base delay in seconds
+
+    :return: what ``func`` returns
+    """
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as err:
+            if attempt >= retries or _is_permanent(err):
+                raise
+            time.sleep(random.uniform(0, min(MAX_RETRY_DELAY, delay * 2 ** attempt)))
+            attempt += 1
+
+
+def _is_permanent(err):
+    return isinstance(err, (fs.errors.FilesystemClosed, fs.errors.PermissionDenied,
+                            fs.errors.ResourceReadOnly, fs.errors.Unsupported,
+                            exceptions.ConfigurationError))
+
+
+def discard_upload(backing_fs, path):
+    """Let a store drop what it kept to resume an upload that was given up."""
+    discard = getattr(backing_fs, 'discard_upload', None)
+    if discard is not None:
         try:
-            backing_fs.makedirs(prefix)
-        except DirectoryExists:
+            discard(path)
+        except Exception:
             pass
-        # print(prefix, outfile)
-        copy_file(tmp, "lp-tmp-backup", backing_fs, str(prefix + outfile))
-        tmp.clean()
+
+
+def _write_to_store(backing_fs, data, outfile, prefix, atomic=False):
+    try:
+        backing_fs.makedirs(prefix)
+    except DirectoryExists:
+        pass
+    if not atomic:
+        backing_fs.upload(str(prefix + outfile), io.BytesIO(data))
+        return
+    partial_path = str(prefix + outfile + '.partial')
+    backing_fs.upload(partial_path, io.BytesIO(data))
+    backing_fs.move(partial_path, str(prefix + outfile), overwrite=True)
+
+
+def store_label(backing_fs):
+    """
+    The name a backing store is recorded under in the catalog and the spool.
+    Stores built by :class:`~lp_backup.stores.StoreRegistry` are named after
+    their configuration, others after ``str()``, numbered by position by
+    :func:`label_stores` where that is not unique.
+    """
+    return _labels.get(backing_fs) or str(backing_fs)
+
+
+def set_store_label(backing_fs, label):
+    """Record the name of a backing store, see :func:`store_label`."""
+    with _labels_lock:
+        _labels[backing_fs] = label
+
+
+def label_stores(backing_store_fs):
+    """
+    Name the stores in a list that have no label yet, adding their position
+    to the name of stores that would otherwise be named alike, such as two
+    ``MemoryFS``.
+    """
+    if not isinstance(backing_store_fs, list):
+        backing_store_fs = [backing_store_fs]
+    names = [store_label(backing_fs) for backing_fs in backing_store_fs]
+    with _labels_lock:
+        for position, (backing_fs, name) in enumerate(zip(backing_store_fs, names)):
+            if backing_fs not in _labels:
+                _labels[backing_fs] = f"{name}#{position}" if names.count(name) > 1 else name
+
+
+@contextlib.contextmanager
+def index_lock(backing_store_fs, prefix=''):
+    """
+    Hold the lock for the catalog and manifest under a prefix of some
+    backing stores while reading, changing and writing them back. Stores
+    are told apart by their labels, so every runner in the process writing
+    to the same place waits for the same lock, whichever configuration it
+    was built from.
+
+    :param backing_store_fs: a pyfilesystem2 object or list of objects
+    :param optional prefix: the prefix the catalog and manifest are under
+    """
+    if not isinstance(backing_store_fs, list):
+        backing_store_fs = [backing_store_fs]
+    # taken in a fixed order, so runners sharing only some stores can't deadlock
+    keys = sorted({(store_label(backing_fs), str(prefix or '').strip('/'))
+                   for backing_fs in backing_store_fs})
+    with _labels_lock:
+        locks = [_index_locks.setdefault(key, threading.Lock()) for key in keys]
+    with contextlib.ExitStack() as stack:
+        for lock in locks:
+            stack.enter_context(lock)
+        yield
+
+
+def listed_on(stores, backing_fs):
+    """
+    Whether a catalog entry's ``stores`` list names a backing store, by its
+    label or, in catalogs written before stores had labels, by ``str()``.
+    """
+    return store_label(backing_fs) in stores or str(backing_fs) in stores
+
+
+def unlist(stores, backing_fs):
+    """Remove a backing store from a catalog entry's ``stores`` list."""
+    for name in {store_label(backing_fs), str(backing_fs)}:
+        while name in stores:
+            stores.remove(name)
+
+
+def _check_quorum(results, quorum, spooled=0):
+    succeeded = sum(1 for result in results if result.success)
+    required = len(results) if quorum is None else min(quorum, len(results))
+    if succeeded + spooled < required:
+        failures = '; '.join(f"{result.store}: {result.error!r}"
+                             for result in results if not result.success)
+        raise exceptions.BackupFailed(
+            f"Backup written to {succeeded} of {len(results)} backing stores, "
+            f"{required} required. {failures}")
 
 
 def read_backup(backing_store_fs, infile, prefix=""):
     """
-    Read a backup file from some pyfilesystem.
+    Read a backup file from some pyfilesystem. The file is downloaded
+    straight into memory rather than staged on local disk.
 
     :param backing_store_fs: The pyfilesystem object where the file is located
     :param infile: the name of the file
@@ -53,25 +299,431 @@ def read_backup(backing_store_fs, infile, prefix=""):
 
     :return: raw file data
     """
-    tmp = tempfs.TempFS()
-    # data = ""
     if prefix and not prefix[-1] == '/':
         prefix = prefix + '/'
     if not isinstance(backing_store_fs, list):
         backing_store_fs = [backing_store_fs]
-    restore_succeeded = False
     for backing_fs in backing_store_fs:
+        buffer = io.BytesIO()
+        try:
+            backing_fs.download(prefix + infile, buffer)
+        except _read_errors():
+            continue
+        return buffer.getvalue()
+    raise exceptions.ConfigurationError("Specified file could not be found in any"
+                                        " of the available backing stores.")
+
+
+def open_backup(backing_store_fs, infile, prefix=""):
+    """
+    Open a backup file for reading from the first backing store that has it,
+    so it can be restored a chunk at a time. Stores that can stream a file
+    straight from the network (``open_stream``) do so, others are opened
+    with ``openbin``.
+
+    :param backing_store_fs: a pyfilesystem2 object or list of objects
+    :param infile: the name of the file
+    :param optional prefix: the prefix before the filename
+
+    :return: a readable binary file object, to be closed by the caller
+    """
+    if prefix and not prefix[-1] == '/':
+        prefix = prefix + '/'
+    if not isinstance(backing_store_fs, list):
+        backing_store_fs = [backing_store_fs]
+    for backing_fs in backing_store_fs:
+        opener = getattr(backing_fs, 'open_stream', backing_fs.openbin)
         try:
-            copy_file(backing_fs, prefix + infile, tmp, infile)
-            restore_succeeded = True
-            break
-        except (botocore.exceptions.NoCredentialsError, OSError,
-                fs.errors.ResourceNotFound, fs.errors.PermissionDenied):
+            return opener(prefix + infile)
+        except _read_errors():
             continue
-    if not restore_succeeded:
-        raise exceptions.ConfigurationError("Specified file could not be found in any"
-                                            " of the available backing stores.")
-    with tmp.open(infile, 'rb') as retrieved_file:
-        data = retrieved_file.read()
-    tmp.clean()
-    return data
+    raise exceptions.ConfigurationError("Specified file could not be found in any"
+                                        " of the available backing stores.")
+
+
+def read_ranges(backing_store_fs, infile, ranges, prefix=""):
+    """
+    Read byte ranges of a file from the first backing store that has it.
+    Ranges that follow each other are read together. Stores that support
+    ranged reads (``read_range``, such as S3) fetch only those bytes, others
+    seek in the opened file.
+
+    :param backing_store_fs: a pyfilesystem2 object or list of objects
+    :param infile: the name of the file
+    :param ranges: list of (offset, length) tuples
+    :param optional prefix: the prefix before the filename
+
+    :return: a dict of offset to the bytes read there
+    """
+    if prefix and not prefix[-1] == '/':
+        prefix = prefix + '/'
+    if not isinstance(backing_store_fs, list):
+        backing_store_fs = [backing_store_fs]
+    spans = []
+    for offset, length in sorted(set(ranges)):
+        if spans and spans[-1][0] + spans[-1][1] == offset:
+            spans[-1][1] += length
+        else:
+            spans.append([offset, length])
+    for backing_fs in backing_store_fs:
+        try:
+            blocks = _read_spans(backing_fs, prefix + infile, spans)
+        except _read_errors():
+            continue
+        found = {}
+        for offset, length in ranges:
+            start, block = next((start, block) for start, block in blocks
+                                if start <= offset < start + len(block))
+            found[offset] = block[offset - start:offset - start + length]
+        return found
+    raise exceptions.ConfigurationError("Specified file could not be found in any"
+                                        " of the available backing stores.")
+
+
+def _read_spans(backing_fs, path, spans):
+    if hasattr(backing_fs, 'read_range'):
+        blocks = [(offset, backing_fs.read_range(path, offset, length))
+                  for offset, length in spans]
+    else:
+        blocks = []
+        with backing_fs.openbin(path) as infile:
+            for offset, length in spans:
+                infile.seek(offset)
+                blocks.append((offset, infile.read(length)))
+    for (_, length), (_, block) in zip(spans, blocks):
+        if len(block) != length:
+            raise exceptions.BackupFailed(f"{path} is shorter than expected.")
+    return blocks
+
+
+def _read_errors():
+    """Errors that mean a store does not have a readable copy of a file.
+    botocore is only consulted if an S3 store has already imported it."""
+    errors = (OSError, fs.errors.ResourceNotFound, fs.errors.PermissionDenied)
+    botocore_exceptions = sys.modules.get('botocore.exceptions')
+    if botocore_exceptions is not None:
+        errors += (botocore_exceptions.NoCredentialsError,)
+    return errors
+
+
+def read_backup_hedged(backing_store_fs, infile, prefix="", *, delay=0.0,
+                       verify=None):
+    """
+    Read a backup file, racing the backing stores against each other so a slow
+    or hung store cannot stall the restore. The first store is asked for the
+    file straight away and each following store is asked after ``delay``
+    seconds without a usable copy, or as soon as an earlier store fails. The
+    first complete copy that passes ``verify`` wins and the other downloads
+    are cancelled.
+
+    :param backing_store_fs: The pyfilesystem object or list of objects where
+        the file is located, in order of preference
+    :param infile: the name of the file
+    :param optional prefix: the prefix before the filename
+    :param keyword delay: seconds to wait for a store before also asking the
+        next one. ``0`` asks every store at once.
+    :param keyword verify: optional callable taking the downloaded bytes and
+        returning whether the copy is usable
+
+    :return: raw file data
+    """
+    if prefix and not prefix[-1] == '/':
+        prefix = prefix + '/'
+    if not isinstance(backing_store_fs, list):
+        backing_store_fs = [backing_store_fs]
+    cancelled = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max(len(backing_store_fs), 1))
+    pending = set()
+    try:
+        for index, backing_fs in enumerate(backing_store_fs):
+            pending.add(executor.submit(_cancellable_download, backing_fs,
+                                        prefix + infile, cancelled))
+            last = index == len(backing_store_fs) - 1
+            data = _first_verified(pending, None if last else delay, verify)
+            if data is not None:
+                return data
+    finally:
+        cancelled.set()
+        executor.shutdown(wait=False)
+    raise exceptions.ConfigurationError("Specified file could not be found in any"
+                                        " of the available backing stores.")
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class _CancellableBuffer(io.BytesIO):
+    def __init__(self, cancelled):
+        super().__init__()
+        self.cancelled = cancelled
+
+    def write(self, data):
+        if self.cancelled.is_set():
+            raise _Cancelled()
+        return super().write(data)
+
+
+def _cancellable_download(backing_fs, path, cancelled):
+    buffer = _CancellableBuffer(cancelled)
+    backing_fs.download(path, buffer)
+    return buffer.getvalue()
+
+
+def _first_verified(pending, timeout, verify):
+    """Wait up to ``timeout`` seconds for one of the pending downloads to
+    produce a verified copy. Failed downloads are dropped from ``pending``."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while pending:
+        remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+        done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        if not done:
+            return None
+        for future in done:
+            pending.discard(future)
+            try:
+                data = future.result()
+            except Exception:
+                continue
+            if verify is None or verify(data):
+                return data
+    return None
+
+
+def write_out_stream(backing_store_fs, chunks, outfile, prefix='', *, quorum=None,
+                     retries=UPLOAD_RETRIES, retry_delay=RETRY_DELAY, spool=None):
+    """
+    Write a stream of backup chunks to every backing store as it is produced.
+    Each store gets its own thread reading from a bounded queue of chunks,
+    so the stores are written concurrently. S3 stores run their own
+    ``upload`` from the queue, so they upload multipart with their per-part
+    retries, and other stores write through ``openbin``. At most
+    ``STREAM_QUEUE_DEPTH`` chunks per store are held in memory, and S3 stores
+    stage nothing on local disk. The data is written to a ``.partial`` file that is
+    moved into place once the stream is complete, and removed if the stream
+    fails. A store that fails part way is dropped and the others carry on.
+
+    :param backing_store_fs: a pyfilesystem2 object or list of objects to be
+            the final storage location of the backup.
+    :param chunks: an iterable of byte chunks to write out.
+    :param outfile: the name of the file to write out to.
+    :param optional prefix: a parent directory for the files to be saved under.
+    :param keyword quorum: how many stores must be written successfully. By
+            default every store must succeed.
+    :param keyword retries: how many more times to try creating the prefix
+            and moving the finished file into place on a store.
+    :param keyword retry_delay: the base delay between tries in seconds.
+    :param keyword spool: a :class:`~lp_backup.spool.Spool` to keep the
+            backup in for stores that failed, copied from a store that took
+            it, so a later run can deliver it.
+
+    :return: a list of :class:`StoreResult`, one per backing store, in order.
+    :raises BackupFailed: if fewer stores than the quorum were written, or
+            none were.
+    """
+    if prefix and not prefix[-1] == '/':
+        prefix = prefix + '/'
+    if not isinstance(backing_store_fs, list):
+        backing_store_fs = [backing_store_fs]
+    pipes = [_ChunkPipe(STREAM_QUEUE_DEPTH) for _ in backing_store_fs]
+    executor = ThreadPoolExecutor(max_workers=max(len(backing_store_fs), 1))
+    try:
+        futures = [executor.submit(_stream_to_store, backing_fs, pipe, outfile, prefix,
+                                   retries, retry_delay)
+                   for backing_fs, pipe in zip(backing_store_fs, pipes)]
+        for chunk in chunks:
+            if not any([pipe.put(chunk) for pipe in pipes]):
+                break
+        for pipe in pipes:
+            pipe.finish()
+    except BaseException:
+        for pipe in pipes:
+            pipe.abort()
+        raise
+    finally:
+        executor.shutdown(wait=True)
+    results = [future.result() for future in futures]
+    written_to = [result.store for result in results if result.success]
+    if not written_to:
+        _check_quorum(results, 1)
+    spooled = 0
+    if spool is not None:
+        for result in results:
+            if not result.success:
+                with open_backup(written_to[0], outfile, prefix) as copy:
+                    spool.add(result.store, prefix + outfile, copy)
+                spooled += 1
+    _check_quorum(results, quorum, spooled)
+    return results
+
+
+def _stream_to_store(backing_fs, pipe, outfile, prefix, retries, retry_delay):
+    partial_path = str(prefix + outfile + '.partial')
+    start = time.monotonic()
+    try:
+        if prefix:
+            with_retries(lambda: backing_fs.makedirs(prefix, recreate=True),
+                         retries, retry_delay)
+        if _is_s3(backing_fs):
+            backing_fs.upload(partial_path, pipe)
+        else:
+            # the generic upload holds the filesystem's lock until the
+            # stream ends, which would block other streams to this store
+            with backing_fs.openbin(partial_path, 'w') as writer:
+                for chunk in iter(lambda: pipe.read(PIPE_READ_SIZE), b''):
+                    writer.write(chunk)
+        if pipe.aborted:
+            raise exceptions.BackupFailed("The backup stream was abandoned.")
+        with_retries(lambda: backing_fs.move(partial_path, str(prefix + outfile),
+                                             overwrite=True), retries, retry_delay)
+    except Exception as err:
+        # stop the producer feeding a store that is no longer reading
+        pipe.abort()
+        try:
+            backing_fs.remove(partial_path)
+        except Exception:
+            pass
+        discard_upload(backing_fs, partial_path)
+        return StoreResult(backing_fs, False, 0, time.monotonic() - start, err)
+    return StoreResult(backing_fs, True, pipe.bytes_read, time.monotonic() - start, None)
+
+
+class _ChunkPipe(object):
+    """
+    A read-only file object that a store's ``upload`` reads from while the
+    backup stream is written to it from another thread. At most ``depth``
+    chunks wait in it, so a slow store slows the stream down rather than
+    filling memory.
+    """
+    def __init__(self, depth):
+        self._chunks = queue.Queue(maxsize=depth)
+        self._buffer = bytearray()
+        self._eof = False
+        self.aborted = False
+        self.bytes_read = 0
+
+    def put(self, chunk):
+        """Queue a chunk, waiting for room. Returns False once the reader
+        has given up."""
+        while not self.aborted:
+            try:
+                self._chunks.put(chunk, timeout=PIPE_POLL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def finish(self):
+        """Mark the end of the stream."""
+        self.put(None)
+
+    def abort(self):
+        """Give up the stream, from either end."""
+        self.aborted = True
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def read(self, size=-1):
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            if self.aborted:
+                raise exceptions.BackupFailed("The backup stream was abandoned.")
+            try:
+                chunk = self._chunks.get(timeout=PIPE_POLL)
+            except queue.Empty:
+                continue
+            if chunk is None:
+                self._eof = True
+            else:
+                self._buffer.extend(chunk)
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self.bytes_read += len(data)
+        return data
+
+
+def delete_backups(backing_store_fs, filenames, prefix='', *, max_workers=None):
+    """
+    Delete backup files from every backing store. Stores are handled
+    concurrently. S3 stores delete up to ``S3_DELETE_BATCH`` objects per
+    request, other stores delete files in parallel. Files that are already
+    missing count as deleted.
+
+    :param backing_store_fs: a pyfilesystem2 object or list of objects
+    :param filenames: the names of the files to delete
+    :param optional prefix: the prefix before the filenames
+    :param keyword max_workers: the most files to delete at once on a store
+        without batch deletes.
+
+    :return: a list of :class:`DeleteResult`, one per backing store, in order.
+    """
+    if prefix and not prefix[-1] == '/':
+        prefix = prefix + '/'
+    if not isinstance(backing_store_fs, list):
+        backing_store_fs = [backing_store_fs]
+    paths = [prefix + filename for filename in filenames]
+    if max_workers is None:
+        max_workers = MAX_DELETE_WORKERS
+    with ThreadPoolExecutor(max_workers=max(len(backing_store_fs), 1)) as executor:
+        futures = []
+        for backing_fs in backing_store_fs:
+            if _is_s3(backing_fs):
+                futures.append(executor.submit(_delete_s3_batches, backing_fs, paths))
+            else:
+                futures.append(executor.submit(_delete_parallel, backing_fs, paths,
+                                               max_workers))
+        results = [future.result() for future in futures]
+    return [DeleteResult(backing_fs, [path[len(prefix):] for path in deleted],
+                         {path[len(prefix):]: error for path, error in errors.items()})
+            for backing_fs, (deleted, errors) in zip(backing_store_fs, results)]
+
+
+def _is_s3(backing_fs):
+    return hasattr(backing_fs, '_bucket_name') and hasattr(backing_fs, '_path_to_key')
+
+
+def _delete_s3_batches(backing_fs, paths):
+    deleted = []
+    errors = {}
+    keys = {backing_fs._path_to_key(path): path for path in paths}
+    key_list = list(keys)
+    for start in range(0, len(key_list), S3_DELETE_BATCH):
+        batch = key_list[start:start + S3_DELETE_BATCH]
+        try:
+            response = backing_fs.client.delete_objects(
+                Bucket=backing_fs._bucket_name,
+                Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+        except Exception as err:
+            errors.update((keys[key], err) for key in batch)
+            continue
+        failed = {error['Key']: error.get('Message', error.get('Code'))
+                  for error in response.get('Errors', [])}
+        errors.update((keys[key], message) for key, message in failed.items())
+        deleted.extend(keys[key] for key in batch if key not in failed)
+    return deleted, errors
+
+
+def _delete_parallel(backing_fs, paths, max_workers):
+    def remove(path):
+        try:
+            backing_fs.remove(path)
+        except fs.errors.ResourceNotFound:
+            pass
+
+    deleted = []
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        futures = {executor.submit(remove, path): path for path in paths}
+        for future, path in futures.items():
+            try:
+                future.result()
+            except Exception as err:
+                errors[path] = err
+            else:
+                deleted.append(path)
+    return deleted, errors
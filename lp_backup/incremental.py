@@ -0,0 +1,217 @@
+"""
+Record-level incremental backups.
+
+An incremental chain starts with an ordinary full backup (the snapshot).
+Later runs parse the export into records and store only the records that were
+added, changed or removed since the previous run as a small json delta, which
+is encrypted and compressed like any other backup. Restoring a delta replays
+the chain from the snapshot.
+
+To diff against the previous run without downloading it, the manifest keeps
+a keyed hash of every record's key and contents. Deltas hold the keyed hashes
+of the records they remove, and name the encryption key whose fingerprint key
+made them, so they still apply after a new key is made.
+"""
+import csv
+import hashlib
+import hmac
+import io
+import json
+
+from lp_backup import exceptions
+
+DELTA_NAME = "-lastpass-delta"
+DELTA_SUFFIX = ".json"
+DIGEST_SIZE = 32
+
+
+def is_delta(filename):
+    """Whether a backup file name is an incremental delta."""
+    return DELTA_NAME + DELTA_SUFFIX in filename
+
+
+def parse_records(data):
+    """
+    Parse an ``lpass export`` csv into records.
+
+    :param data: the exported bytes
+
+    :return: a tuple of (fieldnames, dict of record key to row). Rows are
+        lists of the record's fields. Records are keyed by their ``id`` field
+        when the export has one, otherwise by grouping, name, url and username.
+    """
+    text = data.decode('utf-8', 'surrogateescape')
+    reader = csv.reader(io.StringIO(text, newline=''))
+    try:
+        fieldnames = next(reader)
+    except StopIteration:
+        return [], {}
+    records = {}
+    for row in reader:
+        key = _record_key(fieldnames, row)
+        occurrence = 1
+        unique_key = key
+        while unique_key in records:
+            occurrence += 1
+            unique_key = f"{key}#{occurrence}"
+        records[unique_key] = row
+    return fieldnames, records
+
+
+def format_records(fieldnames, records, lineterminator='\n'):
+    """
+    Write records back out as csv.
+
+    :param fieldnames: the csv header
+    :param records: dict of record key to row
+    :param optional lineterminator: the line ending to use
+
+    :return: the csv bytes
+    """
+    out = io.StringIO(newline='')
+    writer = csv.writer(out, lineterminator=lineterminator)
+    writer.writerow(fieldnames)
+    writer.writerows(records.values())
+    return out.getvalue().encode('utf-8', 'surrogateescape')
+
+
+def record_hashes(records, key):
+    """
+    Keyed hashes of every record, used to diff against the next export.
+
+    :param records: dict of record key to row
+    :param key: the HMAC key, see :func:`lp_backup.manifest.fingerprint_key`
+
+    :return: dict of hashed record key to hashed row
+    """
+    return {_digest(key, record_key): _digest(key, json.dumps(row))
+            for record_key, row in records.items()}
+
+
+def diff(previous_hashes, records, key):
+    """
+    Work out which records changed since the previous export.
+
+    :param previous_hashes: :func:`record_hashes` of the previous export
+    :param records: the records of the new export
+    :param key: the HMAC key the hashes were made with
+
+    :return: a dict with the ``added`` and ``changed`` records and the hashed
+        keys of the ``removed`` records
+    """
+    added = {}
+    changed = {}
+    seen = set()
+    for record_key, row in records.items():
+        hashed_key = _digest(key, record_key)
+        seen.add(hashed_key)
+        if hashed_key not in previous_hashes:
+            added[record_key] = row
+        elif previous_hashes[hashed_key] != _digest(key, json.dumps(row)):
+            changed[record_key] = row
+    removed = sorted(set(previous_hashes) - seen)
+    return {'added': added, 'changed': changed, 'removed': removed}
+
+
+def is_empty(delta):
+    """Whether a delta from :func:`diff` has no changes."""
+    return not (delta['added'] or delta['changed'] or delta['removed'])
+
+
+def dump_delta(delta, fieldnames, snapshot, chain, key_id=None):
+    """
+    Serialize a delta.
+
+    :param delta: the changes from :func:`diff`
+    :param fieldnames: the csv header of the export
+    :param snapshot: name of the full backup the chain starts from
+    :param chain: names of the deltas between the snapshot and this one
+    :param optional key_id: the id of the encryption key the removed records
+        were hashed with, see :func:`lp_backup.rotation.key_id`
+
+    :return: the delta as json bytes
+    """
+    document = dict(delta, version=1, fieldnames=fieldnames, snapshot=snapshot,
+                    chain=list(chain), key_id=key_id)
+    return json.dumps(document).encode('utf-8')
+
+
+def load_delta(data):
+    """Parse a delta written by :func:`dump_delta`."""
+    try:
+        return json.loads(data.decode('utf-8'))
+    except ValueError as err:
+        raise exceptions.BackupFailed(f"Invalid incremental backup: {err}")
+
+
+def apply_delta(records, delta, key):
+    """
+    Apply a delta to a set of records in place.
+
+    :param records: dict of record key to row
+    :param delta: a delta from :func:`load_delta`
+    :param key: the HMAC key the removed record keys were hashed with
+
+    :return: the updated records
+    """
+    removed = set(delta['removed'])
+    if removed:
+        for record_key in [record_key for record_key in records
+                           if _digest(key, record_key) in removed]:
+            del records[record_key]
+    records.update(delta['added'])
+    records.update(delta['changed'])
+    return records
+
+
+def matching_key(records, removed, keys):
+    """
+    Find which of some keys a delta's removed records were hashed with, for
+    deltas that don't record it.
+
+    :param records: dict of record key to row the delta applies to
+    :param removed: the hashed keys of the removed records
+    :param keys: the candidate HMAC keys, the likeliest first
+
+    :return: the key matching the most removed records, the first on a tie
+    """
+    removed = set(removed)
+    if not removed:
+        return keys[0]
+    return max(keys, key=lambda key: sum(1 for record_key in records
+                                         if _digest(key, record_key) in removed))
+
+
+def rekey_removed(records, removed, old_key, new_key):
+    """
+    Hash the keys of a delta's removed records with a new key.
+
+    :param records: dict of record key to row holding the removed records,
+        such as every record of the chain before the delta
+    :param removed: the hashed keys of the removed records
+    :param old_key: the HMAC key they were hashed with
+    :param new_key: the HMAC key to hash them with
+
+    :return: the new list of hashed keys
+    :raises BackupFailed: if a removed record is not among ``records``
+    """
+    rekeyed = {_digest(old_key, record_key): _digest(new_key, record_key)
+               for record_key in records}
+    missing = [hashed for hashed in removed if hashed not in rekeyed]
+    if missing:
+        raise exceptions.BackupFailed(
+            f"{len(missing)} removed records are missing from the incremental chain.")
+    return sorted(rekeyed[hashed] for hashed in removed)
+
+
+def _record_key(fieldnames, row):
+    fields = dict(zip(fieldnames, row))
+    if fields.get('id'):
+        return fields['id']
+    return '\x1f'.join(fields.get(name, '') for name in
+                       ('grouping', 'name', 'url', 'username'))
+
+
+def _digest(key, value):
+    return hmac.new(key, value.encode('utf-8', 'surrogateescape'),
+                    hashlib.sha256).hexdigest()[:DIGEST_SIZE]
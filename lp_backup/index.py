@@ -0,0 +1,228 @@
+"""
+Record index for restoring single entries.
+
+With ``Record Index`` set, container backups are framed on record boundaries
+and a small index is stored next to each one as ``<backup>.index``. It maps
+each record's id, name, folder (grouping) and a keyed hash of its URL to the
+frame holding it, and records where every frame starts in the stored file.
+The index is a container itself, compressed and encrypted like the backup,
+so restoring a few entries reads the index and then only the frames they are
+in, with ranged reads where the store supports them.
+"""
+import csv
+import hashlib
+import hmac
+import json
+
+from lp_backup import container
+from lp_backup import exceptions
+
+INDEX_SUFFIX = '.index'
+VERSION = 1
+FOLDER_SEPARATOR = '\\'
+
+
+def index_name(filename):
+    """The name of the index stored next to a backup."""
+    return filename + INDEX_SUFFIX
+
+
+def is_index(filename):
+    """Whether a file name is a record index rather than a backup."""
+    return filename.endswith(INDEX_SUFFIX)
+
+
+def url_hash(key, url):
+    """Keyed hash of an entry's URL, so the index does not need the URL."""
+    return hmac.new(key, url.encode('utf-8', 'surrogateescape'),
+                    hashlib.sha256).hexdigest()[:32]
+
+
+def entry_of(fieldnames, row, key, frame=None):
+    """
+    Describe one record of the export for the index.
+
+    :param fieldnames: the csv header of the export
+    :param row: the record's fields
+    :param key: the HMAC key for the URL hash
+    :param optional frame: the number of the frame holding the record
+    """
+    fields = dict(zip(fieldnames, row))
+    return {
+        'id': fields.get('id', ''),
+        'name': fields.get('name', ''),
+        'grouping': fields.get('grouping', ''),
+        'url': url_hash(key, fields.get('url', '')),
+        'frame': frame,
+    }
+
+
+class Builder(object):
+    """
+    Split an export into frames of whole records and index them. Feed the
+    export through :meth:`split`, the encoded container through
+    :meth:`track`, then :meth:`dump` the index.
+
+    :param key: the HMAC key for URL hashes, see
+        :func:`lp_backup.manifest.fingerprint_key`
+    :param frame_size: the most plaintext bytes per frame, unless a single
+        record is larger
+    """
+    def __init__(self, key, frame_size):
+        self.key = key
+        self.frame_size = frame_size
+        self.header = None
+        self.fieldnames = None
+        self.entries = []
+        self.frames = []
+
+    def split(self, chunks):
+        """
+        Regroup plaintext chunks of the export into frames that hold whole
+        records. The frames concatenate back to the export byte for byte.
+
+        :param chunks: iterable of byte chunks of the export
+        """
+        frame = []
+        size = 0
+        number = 0
+        for raw, row in records(chunks):
+            if self.fieldnames is None:
+                self.header = raw.decode('utf-8', 'surrogateescape')
+                self.fieldnames = row
+            else:
+                if size and size + len(raw) > self.frame_size:
+                    yield b''.join(frame)
+                    frame = []
+                    size = 0
+                    number += 1
+                if row:
+                    self.entries.append(entry_of(self.fieldnames, row, self.key, number))
+            frame.append(raw)
+            size += len(raw)
+        if frame:
+            yield b''.join(frame)
+
+    def track(self, container_chunks):
+        """
+        Pass the chunks from :func:`lp_backup.container.encode_frames` through,
+        noting the offset and length of every frame in the stored file.
+        """
+        offset = 0
+        for chunk in container_chunks:
+            if offset and chunk != container.FRAME_HEADER.pack(0):
+                self.frames.append([offset, len(chunk)])
+            offset += len(chunk)
+            yield chunk
+
+    def dump(self, backup):
+        """
+        Serialize the index.
+
+        :param backup: the name of the backup it indexes
+
+        :return: the index as json bytes
+        """
+        document = {
+            'version': VERSION,
+            'backup': backup,
+            'header': self.header or '',
+            'fieldnames': self.fieldnames or [],
+            'frames': self.frames,
+            'entries': self.entries,
+        }
+        return json.dumps(document).encode('utf-8')
+
+
+def load(data):
+    """Parse an index written by :meth:`Builder.dump`."""
+    try:
+        document = json.loads(data.decode('utf-8'))
+    except ValueError as err:
+        raise exceptions.BackupFailed(f"Invalid record index: {err}")
+    if document.get('version', 0) > VERSION:
+        raise exceptions.BackupFailed(
+            f"Unsupported record index version {document['version']}.")
+    return document
+
+
+class EntryFilter(object):
+    """
+    Which entries to restore. An entry matches if its id, name or URL is one
+    of ``entries``, or it is in one of ``folders`` or a subfolder of one.
+
+    :param key: the HMAC key the index's URL hashes were made with
+    :param optional entries: ids, names or URLs of entries
+    :param optional folders: folder names, such as ``Email\\Work``
+    """
+    def __init__(self, key, entries=(), folders=()):
+        self.key = key
+        self.names = set(entries)
+        self.urls = {url_hash(key, entry) for entry in entries}
+        self.folders = [folder.strip(FOLDER_SEPARATOR) for folder in folders]
+
+    def __bool__(self):
+        return bool(self.names or self.folders)
+
+    def matches(self, entry):
+        """Whether an entry from :func:`entry_of` is selected."""
+        if entry['id'] and entry['id'] in self.names:
+            return True
+        if entry['name'] in self.names or entry['url'] in self.urls:
+            return True
+        grouping = entry['grouping']
+        return any(grouping == folder or grouping.startswith(folder + FOLDER_SEPARATOR)
+                   for folder in self.folders)
+
+
+def select(document, entry_filter):
+    """The numbers of the frames holding the entries a filter matches, in
+    order."""
+    return sorted({entry['frame'] for entry in document['entries']
+                   if entry_filter.matches(entry)})
+
+
+def matching_records(chunks, entry_filter, fieldnames=None):
+    """
+    Yield the raw bytes of the records a filter matches.
+
+    :param chunks: plaintext byte chunks holding whole records
+    :param entry_filter: the :class:`EntryFilter`
+    :param optional fieldnames: the csv header. If not given, the first
+        record is the header, and is yielded too.
+    """
+    for raw, row in records(chunks):
+        if fieldnames is None:
+            fieldnames = row
+            yield raw
+        elif row and entry_filter.matches(entry_of(fieldnames, row, entry_filter.key)):
+            yield raw
+
+
+def records(chunks):
+    """
+    Parse csv from byte chunks split anywhere, yielding the raw bytes of each
+    record, line ending included, with its parsed fields.
+    """
+    pending = []
+
+    def text_lines():
+        for line in _lines(chunks):
+            pending.append(line)
+            yield line.decode('utf-8', 'surrogateescape')
+
+    for row in csv.reader(text_lines()):
+        raw = b''.join(pending)
+        del pending[:]
+        yield raw, row
+
+
+def _lines(chunks):
+    rest = b''
+    for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if rest:
+        yield rest
@@ -1,13 +1,27 @@
 import click
 import os
+import sys
 from pathlib import Path
 
 from lp_backup import Runner
+from lp_backup import exceptions
 
 USER_HOME = os.path.expanduser('~')
+ERRORS = (exceptions.ConfigurationError, exceptions.BackupFailed,
+          exceptions.LoginFailed, exceptions.InvalidKey, exceptions.NoWebdav)
 
 
-@click.group()
+class Group(click.Group):
+    """Report lp_backup's errors as a one line message and exit status 1,
+    instead of a traceback."""
+    def invoke(self, ctx):
+        try:
+            return super().invoke(ctx)
+        except ERRORS as err:
+            raise click.ClickException(str(err) or type(err).__name__)
+
+
+@click.group(cls=Group)
 @click.option('-c', "--config", help="Path to config file",
               default=f"{USER_HOME}/.config/lp_backup.yml")
 @click.pass_context
@@ -25,10 +39,173 @@ def backup(ctx):
 
 
 @cli.command(help="Restore csv file based on config file.")
+@click.argument('backup_file', required=False)
+@click.option('--latest', is_flag=True, help="Restore the most recent backup")
+@click.option('-o', '--output', default=None,
+              help="Path to write the restored csv to, or - for stdout")
+@click.option('--entry', 'entries', multiple=True,
+              help="Only restore the entry with this id, name or URL (repeatable)")
+@click.option('--folder', 'folders', multiple=True,
+              help="Only restore the entries in this folder (repeatable)")
 @click.pass_context
-def restore(ctx):
+def restore(ctx, backup_file, latest, output, entries, folders):
     runner = Runner(ctx.obj["CONFIG"])
-    restore_file_path = runner.restore()
+    if latest:
+        newest = runner.latest()
+        if newest is None:
+            raise click.ClickException("No backups found in the catalog.")
+        backup_file = newest["filename"]
+    if not backup_file:
+        raise click.UsageError("Specify a backup file or --latest.")
+    if output == '-':
+        if entries or folders:
+            runner.restore_entries(backup_file, sys.stdout.buffer, entries=entries,
+                                   folders=folders)
+        else:
+            runner.restore_stream(backup_file, sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+        return
+    if output is None:
+        output = str(Path(os.getcwd(), "lastpass-restore.csv"))
+    if entries or folders:
+        with open(output, 'wb') as outfile:
+            runner.restore_entries(backup_file, outfile, entries=entries, folders=folders)
+        restore_file_path = output
+    else:
+        restore_file_path = runner.restore(backup_file, output)
     print(f"Restored file is {restore_file_path}. It is NOT encrypted, "
           f"be sure to keep it safe and delete it when not needed.")
 
+
+@cli.command(name="list", help="List backups recorded in the catalog.")
+@click.pass_context
+def list_backups(ctx):
+    runner = Runner(ctx.obj["CONFIG"])
+    for entry in runner.list_backups():
+        print(f"{entry['created']}  {entry['size']:>10}  {entry['filename']}")
+
+
+@cli.command(help="Check every copy of every backup on every backing store.")
+@click.option('--quick', is_flag=True,
+              help="Trust matching sizes instead of downloading copies to hash")
+@click.option('--plaintext', is_flag=True,
+              help="Also decrypt every copy and check its plaintext")
+@click.option('-w', '--workers', default=None, type=int,
+              help="Most copies to check at once")
+@click.pass_context
+def verify(ctx, quick, plaintext, workers):
+    from lp_backup.verify import OK, report
+    with Runner(ctx.obj["CONFIG"]) as runner:
+        results = runner.verify(quick=quick, plaintext=plaintext, max_workers=workers)
+        for line in report(results, runner.stores.all()):
+            print(line)
+    if any(result.status != OK for result in results):
+        ctx.exit(1)
+
+
+@cli.command(help="Copy backups missing from a backing store to it from another.")
+@click.option('--dry-run', is_flag=True, help="Only show what would be copied")
+@click.option('-w', '--workers', default=None, type=int,
+              help="Most copies to run at once")
+@click.pass_context
+def sync(ctx, dry_run, workers):
+    from lp_backup.sync import report
+    with Runner(ctx.obj["CONFIG"]) as runner:
+        results = runner.sync(dry_run=dry_run, max_workers=workers)
+    for line in report(results, dry_run):
+        print(line)
+    if any(result.error is not None for result in results):
+        ctx.exit(1)
+
+
+@cli.command(name="rotate-key",
+             help="Re-encrypt backups made with old keys with the current key.")
+@click.option('--new-key', is_flag=True,
+              help="First generate a new current key, keeping the old one to read with")
+@click.option('-w', '--workers', default=None, type=int,
+              help="Most backups to rotate at once")
+@click.pass_context
+def rotate_key(ctx, new_key, workers):
+    with Runner(ctx.obj["CONFIG"]) as runner:
+        if new_key:
+            runner.new_key()
+            print(f"Generated a new Encryption Key in {ctx.obj['CONFIG']}.")
+        results = runner.rotate_key(max_workers=workers)
+    for result in results:
+        if not result.success:
+            print(f"Could not rotate {result.filename}: {result.error}")
+    rotated = sum(1 for result in results if result.success)
+    print(f"Rotated {rotated} of {len(results)} backups.")
+    if rotated < len(results):
+        print("Run rotate-key again to retry the rest.")
+        ctx.exit(1)
+
+
+@cli.command(help="Delete backups no longer kept by the retention policy.")
+@click.option('--dry-run', is_flag=True, help="Only show what would be deleted")
+@click.option('--scan', is_flag=True,
+              help="Also prune dated backups missing from the catalog")
+@click.pass_context
+def prune(ctx, dry_run, scan):
+    runner = Runner(ctx.obj["CONFIG"])
+    report = runner.prune(dry_run=dry_run, scan=scan)
+    action = "Would delete" if dry_run else "Deleted"
+    for filename in report['delete']:
+        print(f"{action} {filename}")
+    print(f"Keeping {len(report['keep'])} backups.")
+    for result in report['results']:
+        for filename, error in result.errors.items():
+            print(f"Could not delete {filename} from {result.store}: {error}")
+
+
+@cli.command(help="Run backups on a schedule until stopped.")
+@click.option('--schedule', default=None,
+              help="Cron-like schedule, overriding Schedule in the config")
+@click.option('--jitter', default=None, type=float,
+              help="Most seconds to delay each run by")
+@click.option('--now', 'run_now', is_flag=True, help="Also back up at startup")
+@click.pass_context
+def daemon(ctx, schedule, jitter, run_now):
+    from lp_backup.schedule import Daemon
+    with Runner(ctx.obj["CONFIG"]) as runner:
+        schedule = schedule or runner.settings.schedule or "@daily"
+        if jitter is None:
+            jitter = runner.settings.schedule_jitter
+        scheduler = Daemon(runner, schedule, jitter)
+        scheduler.install_signal_handlers()
+        print(f"Backing up on schedule {schedule}. "
+              f"Send SIGUSR1 to pid {os.getpid()} to back up now.")
+        if run_now:
+            scheduler.run_once()
+        scheduler.run()
+
+
+@cli.command(name="backup-all",
+             help="Back up every account listed under Accounts in parallel.")
+@click.option('--config-dir', default=None, type=click.Path(exists=True, file_okay=False),
+              help="Also back up every .yml config in this directory")
+@click.option('-w', '--workers', default=None, type=int,
+              help="Most accounts to back up at once")
+@click.pass_context
+def backup_all(ctx, config_dir, workers):
+    import time
+    from lp_backup import batch
+    paths = []
+    if config_dir:
+        paths.extend(sorted(Path(config_dir).glob('*.yml')))
+    if not paths or ctx.obj["CONFIG"].exists():
+        paths.insert(0, ctx.obj["CONFIG"])
+    runners = [Runner(path) for path in paths]
+    if workers is None:
+        workers = runners[0].settings.account_workers or batch.DEFAULT_ACCOUNT_WORKERS
+    start = time.monotonic()
+    try:
+        results = batch.backup_accounts(
+            [account for runner in runners for account in runner.accounts()], workers)
+    finally:
+        for runner in runners:
+            runner.close()
+    for line in batch.summary(results, time.monotonic() - start):
+        print(line)
+    if not all(result.success for result in results):
+        ctx.exit(1)
@@ -0,0 +1,112 @@
+"""
+Per-prefix manifest used to skip backups of an unchanged vault.
+
+The manifest is a small json file stored next to the backups. For each
+account it records a keyed fingerprint of the last exported plaintext and the
+name of the backup holding it. The fingerprint is an HMAC with a key derived
+from the encryption key, so it reveals nothing about the vault to someone
+who can read the backing store but does not hold the key.
+"""
+import datetime
+import hashlib
+import hmac
+import json
+
+from lp_backup import exceptions
+from lp_backup import file_io
+
+MANIFEST_NAME = 'lp_backup-manifest.json'
+
+
+def fingerprint_key(encryption_key):
+    """
+    Derive the fingerprint key from the backup encryption key.
+
+    :param encryption_key: the encryption key from the configuration, or None
+        if backups are not encrypted.
+    """
+    if encryption_key is None:
+        encryption_key = b''
+    elif isinstance(encryption_key, str):
+        encryption_key = encryption_key.encode('utf-8')
+    return hmac.new(encryption_key, b'lp_backup fingerprint', hashlib.sha256).digest()
+
+
+def fingerprint(data, key):
+    """
+    Keyed fingerprint of some plaintext.
+
+    :param data: the exported plaintext
+    :param key: a key from :func:`fingerprint_key`
+
+    :return: the hex digest
+    """
+    return hmac.new(key, data, hashlib.sha256).hexdigest()
+
+
+def load(backing_store_fs, prefix=''):
+    """
+    Read the manifest from the backing stores.
+
+    :param backing_store_fs: a pyfilesystem2 object or list of objects
+    :param optional prefix: the prefix the backups are stored under
+
+    :return: the manifest, or an empty one if none has been written yet
+    """
+    try:
+        data = file_io.read_backup(backing_store_fs, MANIFEST_NAME, prefix)
+    except exceptions.ConfigurationError:
+        return {'accounts': {}}
+    return json.loads(data.decode('utf-8'))
+
+
+def save(backing_store_fs, manifest, prefix='', **policy):
+    """
+    Write the manifest to the backing stores.
+
+    :param backing_store_fs: a pyfilesystem2 object or list of objects
+    :param manifest: the manifest to write
+    :param optional prefix: the prefix the backups are stored under
+    :param policy: upload options passed on to
+        :func:`lp_backup.file_io.replace_file`
+    """
+    data = json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8')
+    return file_io.replace_file(backing_store_fs, data, MANIFEST_NAME, prefix,
+                                **policy)
+
+
+def unchanged_backup(manifest, email, digest):
+    """
+    Find the existing backup of an unchanged vault.
+
+    :param manifest: the manifest loaded with :func:`load`
+    :param email: the account the backup is for
+    :param digest: the fingerprint of the new export
+
+    :return: the name of the backup with the same fingerprint, or None
+    """
+    entry = manifest['accounts'].get(email)
+    if (entry and entry.get('fingerprint')
+            and hmac.compare_digest(entry['fingerprint'], digest)):
+        return entry['backup']
+    return None
+
+
+def record(manifest, email, digest, backup_name, skipped=False):
+    """
+    Record a backup run in the manifest.
+
+    :param manifest: the manifest loaded with :func:`load`
+    :param email: the account the backup is for
+    :param digest: the fingerprint of the export
+    :param backup_name: the backup holding that export
+    :param optional skipped: whether this run reused an existing backup
+    """
+    now = datetime.datetime.today().isoformat()
+    entry = manifest['accounts'].setdefault(email, {'skipped': 0})
+    entry.update(fingerprint=digest, backup=backup_name, checked=now)
+    if skipped:
+        entry['skipped'] = entry.get('skipped', 0) + 1
+    else:
+        entry.update(created=now, skipped=0)
+    return manifest
@@ -0,0 +1,237 @@
+"""
+Timing and size instrumentation for backups and restores.
+
+A :class:`Recorder` times each stage of an operation (``login``, ``export``,
+``encrypt``, ``compress``, ``upload`` and so on) and passes a record of it to
+every hook, along with a ``total`` record when the operation ends. Each record
+is a dict with the ``operation``, ``stage``, ``seconds``, optionally
+``bytes`` and ``store``, any labels such as ``email``, and ``time``. Hooks are
+plain callables; :class:`JsonLines` and :class:`PrometheusTextfile` are
+provided. A recorder without hooks does nothing and costs next to nothing.
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+
+class _NullStage(object):
+    """Stand-in for a stage while metrics are disabled."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    def __init__(self, recorder, name, labels):
+        self.recorder = recorder
+        self.record = dict(labels, stage=name)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.record['seconds'] = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.record['error'] = exc_type.__name__
+        self.recorder.emit(self.record)
+        return False
+
+
+class Recorder(object):
+    """
+    Time stages of backups and restores and pass the records to hooks.
+
+    :param optional hooks: callables taking one record each
+    :param optional labels: labels added to every record, such as ``email``
+    """
+    def __init__(self, hooks=(), labels=None):
+        self.hooks = list(hooks)
+        self.labels = dict(labels or {})
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        return bool(self.hooks)
+
+    def add_hook(self, hook):
+        """Pass every record from now on to ``hook``."""
+        self.hooks.append(hook)
+
+    def child(self, **labels):
+        """A recorder with the same hooks and some extra labels."""
+        return Recorder(self.hooks, dict(self.labels, **labels))
+
+    def operation(self, name):
+        """
+        Context manager around a whole backup or restore. Stages recorded
+        inside it on the same thread are labelled with the operation, and a
+        ``total`` record with ``success`` is emitted at the end.
+        """
+        if not self.hooks:
+            return NULL_STAGE
+        return _Operation(self, name)
+
+    def carry(self, func):
+        """
+        Wrap a callable that will run on another thread, such as an executor,
+        so the stages it records are labelled with the operation in progress
+        on this thread.
+        """
+        operation = getattr(self._local, 'operation', None)
+
+        def run(*args, **kwargs):
+            outer = getattr(self._local, 'operation', None)
+            self._local.operation = operation
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.operation = outer
+        return run
+
+    def stage(self, name, **labels):
+        """
+        Context manager timing one stage. It yields the record, so the stage
+        can add its ``bytes``.
+        """
+        if not self.hooks:
+            return NULL_STAGE
+        return _Stage(self, name, labels)
+
+    def record(self, name, seconds, **labels):
+        """Emit a stage that was timed elsewhere, such as one store's upload."""
+        if self.hooks:
+            self.emit(dict(labels, stage=name, seconds=seconds))
+
+    def emit(self, record):
+        record.setdefault('operation', getattr(self._local, 'operation', None))
+        for key, value in self.labels.items():
+            record.setdefault(key, value)
+        record['time'] = time.time()
+        for hook in self.hooks:
+            hook(record)
+
+
+class _Operation(object):
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.outer = getattr(self.recorder._local, 'operation', None)
+        self.recorder._local.operation = self.name
+        self.start = time.perf_counter()
+        return {}
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record = {'stage': 'total', 'seconds': time.perf_counter() - self.start,
+                  'success': exc_type is None}
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        try:
+            self.recorder.emit(record)
+        finally:
+            self.recorder._local.operation = self.outer
+        return False
+
+
+class JsonLines(object):
+    """
+    Hook writing each record as one line of json.
+
+    :param target: a path to append to, ``-`` for stderr, or a text file object
+    """
+    def __init__(self, target):
+        self.target = target
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, sort_keys=True, default=str) + '\n'
+        with self._lock:
+            if self.target == '-':
+                sys.stderr.write(line)
+            elif isinstance(self.target, str):
+                with open(self.target, 'a') as log:
+                    log.write(line)
+            else:
+                self.target.write(line)
+                self.target.flush()
+
+
+class PrometheusTextfile(object):
+    """
+    Hook keeping the latest value of every stage and rewriting a file for the
+    node exporter's textfile collector whenever an operation finishes. The
+    file is replaced atomically so the collector never reads half of it.
+
+    :param path: the ``.prom`` file to write
+    """
+    PREFIX = 'lp_backup'
+
+    def __init__(self, path):
+        self.path = path
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        labels = {key: record[key] for key in ('operation', 'stage', 'store', 'email')
+                  if record.get(key) is not None}
+        with self._lock:
+            self._set('stage_seconds', labels, record['seconds'])
+            if record.get('bytes') is not None:
+                self._set('stage_bytes', labels, record['bytes'])
+            if record['stage'] != 'total':
+                return
+            labels.pop('stage')
+            self._set('success', labels, 1 if record['success'] else 0)
+            if record['success']:
+                self._set('last_success_timestamp_seconds', labels, record['time'])
+            self._write()
+
+    def _set(self, metric, labels, value):
+        self.series[(metric, tuple(sorted(labels.items())))] = value
+
+    def _write(self):
+        lines = []
+        declared = set()
+        for (metric, labels), value in sorted(self.series.items()):
+            name = f"{self.PREFIX}_{metric}"
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} gauge")
+            label_text = ','.join(f'{key}="{_escape(label)}"' for key, label in labels)
+            lines.append(f"{name}{{{label_text}}} {value}")
+        partial = self.path + '.partial'
+        with open(partial, 'w') as textfile:
+            textfile.write('\n'.join(lines) + '\n')
+        os.replace(partial, self.path)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def from_config(config, **labels):
+    """
+    Build a recorder from the ``Metrics`` section of the configuration.
+
+    :param config: mapping with optional ``Log`` (a path, or ``-`` for
+        stderr) and ``Textfile`` (a Prometheus textfile collector path)
+    :param labels: labels added to every record
+    """
+    hooks = []
+    config = config or {}
+    if config.get('Log'):
+        hooks.append(JsonLines(os.path.expanduser(str(config['Log']))))
+    if config.get('Textfile'):
+        hooks.append(PrometheusTextfile(os.path.expanduser(str(config['Textfile']))))
+    return Recorder(hooks, labels)
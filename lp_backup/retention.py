@@ -0,0 +1,106 @@
+"""
+Grandfather-father-son retention for date-stamped backups.
+
+A retention policy keeps the newest backup in each of the last N hours, days,
+weeks, months and years. The newest backup, anything the manifest still points
+at, and every backup a kept incremental delta depends on are always kept.
+"""
+import datetime
+
+PERIODS = (
+    ('Hourly', lambda when: (when.year, when.month, when.day, when.hour)),
+    ('Daily', lambda when: (when.year, when.month, when.day)),
+    ('Weekly', lambda when: tuple(when.isocalendar()[:2])),
+    ('Monthly', lambda when: (when.year, when.month)),
+    ('Yearly', lambda when: (when.year,)),
+)
+
+
+def parse_policy(retention):
+    """
+    Read the ``Retention`` section of the configuration.
+
+    :param retention: mapping of period name (``Hourly``, ``Daily``,
+        ``Weekly``, ``Monthly``, ``Yearly``) to the number of periods to keep
+
+    :return: dict of period name to count
+    """
+    retention = retention or {}
+    return {name: int(retention.get(name) or 0) for name, _ in PERIODS}
+
+
+def select_keep(entries, policy):
+    """
+    Choose which backups a policy keeps, without regard to dependencies.
+
+    :param entries: catalog entries with ``filename`` and ``timestamp``
+    :param policy: a policy from :func:`parse_policy`
+
+    :return: set of kept file names
+    """
+    newest_first = sorted(entries, key=lambda entry: entry['timestamp'], reverse=True)
+    keep = set()
+    if newest_first:
+        keep.add(newest_first[0]['filename'])
+    for name, period_of in PERIODS:
+        count = policy.get(name, 0)
+        seen = set()
+        for entry in newest_first:
+            if len(seen) >= count:
+                break
+            period = period_of(datetime.datetime.fromtimestamp(entry['timestamp']))
+            if period not in seen:
+                seen.add(period)
+                keep.add(entry['filename'])
+    return keep
+
+
+def plan(entries, policy, protected=()):
+    """
+    Work out which backups to keep and which to delete.
+
+    :param entries: catalog entries with ``filename``, ``timestamp`` and
+        optionally ``depends``
+    :param policy: a policy from :func:`parse_policy`
+    :param optional protected: file names that must be kept regardless
+
+    :return: a tuple of (kept entries, entries to delete), oldest first
+    """
+    by_name = {entry['filename']: entry for entry in entries}
+    keep = select_keep(entries, policy) | (set(protected) & set(by_name))
+    pending = list(keep)
+    while pending:
+        for dependency in by_name[pending.pop()].get('depends', []):
+            if dependency in by_name and dependency not in keep:
+                keep.add(dependency)
+                pending.append(dependency)
+    ordered = sorted(entries, key=lambda entry: entry['timestamp'])
+    return ([entry for entry in ordered if entry['filename'] in keep],
+            [entry for entry in ordered if entry['filename'] not in keep])
+
+
+def entries_from_names(names, email):
+    """
+    Build minimal catalog entries for date-stamped backups found by listing a
+    store, for backups made before the catalog existed.
+
+    :param names: file names found under the prefix
+    :param email: only consider backups of this account
+
+    :return: entries for every name that starts with a timestamp
+    """
+    entries = []
+    marker = '-' + email + '-lastpass-'
+    for name in names:
+        if marker not in name or name.endswith(('.partial', '.index')):
+            continue
+        stamp = name[:name.index(marker)]
+        for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+            try:
+                when = datetime.datetime.strptime(stamp, fmt)
+            except ValueError:
+                continue
+            entries.append({'filename': name, 'email': email,
+                            'timestamp': when.timestamp(), 'depends': []})
+            break
+    return entries
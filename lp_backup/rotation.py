@@ -0,0 +1,139 @@
+"""
+Encryption key rings and re-encrypting stored backups with a new key.
+
+With ``Previous Encryption Keys`` set next to the ``Encryption Key``, backups
+are encrypted with the current key and decrypted with whichever key they were
+made with, through a ``MultiFernet``. Rotating re-encrypts every Fernet token
+of a stored backup with the current key using ``MultiFernet.rotate``. Container
+frames are rotated without decompressing them, so a container keeps its size
+and its record index keeps its offsets. Legacy backups, which are compressed
+after encryption, are decompressed and compressed again around the rotation.
+
+Everything keyed with the fingerprint key, which is derived from the current
+key, is re-keyed on the way: the keyed hash of each backup's plaintext in the
+catalog, the URL hashes in its record index and the hashes of the records an
+incremental delta removes. Until then, backups are checked and deltas applied
+with the fingerprint key of the key they were made with.
+
+Every catalog entry records the id of the key its backup is encrypted with,
+which doubles as the progress of a rotation: an interrupted rotation carries
+on with the backups still on an old key.
+"""
+from collections import namedtuple
+import hashlib
+import hmac
+import itertools
+
+from lp_backup import codecs
+from lp_backup import container
+from lp_backup import exceptions
+from lp_backup import index
+from lp_backup import stream
+
+DEFAULT_WORKERS = 8
+# how many rotated backups to record in the catalog at a time
+SAVE_EVERY = 10
+
+RotateResult = namedtuple('RotateResult', ['filename', 'success', 'error'])
+RotateResult.__doc__ = """
+The outcome of rotating the key of one backup on every store holding it.
+
+``error`` is the exception if it failed, in which case the catalog still
+lists the backup under its old key, so the next rotation tries it again.
+"""
+
+
+def key_id(key):
+    """A short id of an encryption key that reveals nothing about the key."""
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    return hmac.new(key, b'lp_backup key id', hashlib.sha256).hexdigest()[:16]
+
+
+def key_ring(keys):
+    """
+    The cipher for a list of keys, the current key first.
+
+    :return: a ``Fernet`` for a single key, otherwise a ``MultiFernet``
+    """
+    from cryptography.fernet import Fernet, MultiFernet
+    fernets = [Fernet(key) for key in keys]
+    if len(fernets) == 1:
+        return fernets[0]
+    return MultiFernet(fernets)
+
+
+def rotate(filename, chunks, fernet, plaintext=None, level=None):
+    """
+    Re-encrypt a stored backup with the current key, a chunk at a time.
+
+    :param filename: the name of the backup, which tells legacy formats apart
+    :param chunks: iterable of byte chunks of the stored backup
+    :param fernet: the ``Fernet`` or ``MultiFernet`` to rotate to
+    :param optional plaintext: callable given the plaintext a piece at a time
+    :param optional level: the level to compress legacy backups at again
+
+    :return: iterable of byte chunks of the re-encrypted backup
+    :raises BackupFailed: if the backup is not encrypted
+    """
+    if not hasattr(fernet, 'rotate'):
+        from cryptography.fernet import MultiFernet
+        fernet = MultiFernet([fernet])
+    chunks = iter(chunks)
+    first = next(chunks, b'')
+    chunks = itertools.chain([first], chunks)
+    if container.is_container(first):
+        return container.rotate_stream(stream.ChunkReader(chunks), fernet, plaintext)
+    codec = codecs.detect(filename, first)
+    data = codecs.decompress_stream(chunks, codec)
+    if ".stream.encrypted" in filename:
+        tokens = stream.rotate_frames(data, fernet, plaintext)
+    elif ".encrypted" in filename:
+        tokens = _rotate_token(b''.join(data), fernet, plaintext)
+    else:
+        raise exceptions.BackupFailed(f"{filename} is not encrypted.")
+    if codec.module is None:
+        return tokens
+    return codecs.compress_stream(tokens, codec, level)
+
+
+def _rotate_token(token, fernet, plaintext):
+    if plaintext is not None:
+        plaintext(fernet.decrypt(token))
+    yield fernet.rotate(token)
+
+
+class Rekeyed(object):
+    """
+    Collect what is keyed with the fingerprint key from the plaintext of a
+    backup being rotated: the keyed hash of all of it and, for a backup with
+    a record index, the URL hash of every record. Pass it as the
+    ``plaintext`` callable of :func:`rotate`.
+
+    :param key: the new fingerprint key
+    :param optional urls: whether to hash record URLs. Each piece of plaintext
+        must then hold whole records, as the frames of indexed backups do.
+    """
+    def __init__(self, key, urls=False):
+        self.key = key
+        self.digest = hmac.new(key, digestmod=hashlib.sha256)
+        self.url_hashes = [] if urls else None
+        self.fieldnames = None
+
+    def __call__(self, data):
+        self.digest.update(data)
+        if self.url_hashes is None:
+            return
+        for _, row in index.records([data]):
+            if self.fieldnames is None:
+                self.fieldnames = row
+            elif row:
+                self.url_hashes.append(index.entry_of(self.fieldnames, row, self.key)['url'])
+
+    def rekey_index(self, document):
+        """Replace the URL hashes in a loaded record index with new ones."""
+        if len(document['entries']) != len(self.url_hashes):
+            raise exceptions.BackupFailed("Record index does not match its backup.")
+        for entry, url in zip(document['entries'], self.url_hashes):
+            entry['url'] = url
+        return document
@@ -1,22 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import copy
 import datetime
+import functools
+import hashlib
+import hmac
+import itertools
+import json
 import os
-import lzma
 import subprocess
 
-from ruamel.yaml import YAML
-from cryptography.fernet import Fernet
 import fs
 from fs.errors import CreateFailed
-from fs_s3fs import S3FS
+from lp_backup import catalog
+from lp_backup import codecs
+from lp_backup import config as config_file
+from lp_backup import container
 from lp_backup import file_io
+from lp_backup import incremental
+from lp_backup import index
+from lp_backup import manifest
+from lp_backup import metrics
+from lp_backup import retention
+from lp_backup import rotation
+from lp_backup import stream
+from lp_backup.spool import Spool
 from lp_backup import exceptions
+from lp_backup.stores import StoreRegistry
 
-webdav_available = False
-try:
-    from webdavfs.webdavfs import WebDAVFS
-    webdav_available = True
-except ModuleNotFoundError:
-    webdav_available = False
+XZ_FOOTER_MAGIC = b'YZ'
+LPASS_HOME = '~/.local/share/lp_backup/lpass'
 
 
 class Runner(object):
@@ -26,93 +38,993 @@ class Runner(object):
     :download:`example <https://github.com/rickh94/lp_backup/blob/master/docs/source/sample-config.yml>`
     you can use as a starting point.
 
-    :param path: absolute path to the file on the system or relative to
-        the FS object supplied in the filesystem parameter
+    :param path: path to the file on the system, absolute or relative to the
+        working directory, or relative to the FS object supplied in the
+        filesystem parameter
     :param keyword filesystem: a pyfilesystem2 FS object where the yaml config
         file is located.
+
+    The configuration is validated as it is loaded, so a bad file raises
+    ``ConfigurationError`` here, and a file on the local disk is only parsed
+    again when it changes. ``config`` is the parsed yaml and ``settings`` the
+    validated :class:`lp_backup.config.Config` every option is read from,
+    which follows changes made to ``config``.
     """
     def __init__(self, path, *, filesystem=None):
-        self.yaml = YAML()
+        self.yaml = config_file.yaml()
         self.config_path = str(path)
         if not filesystem:
+            # read and written through the root filesystem, so resolve it once
+            self.config_path = os.path.abspath(os.path.expanduser(self.config_path))
             self.filesystem = fs.open_fs('/')
+            self.config, self.settings = config_file.load(self.config_path)
         else:
             self.filesystem = filesystem
-        with self.filesystem.open(self.config_path, 'r') as configfile:
-            self.config = self.yaml.load(configfile)
+            self.config, self.settings = config_file.load(self.config_path,
+                                                          filesystem=filesystem)
         # self.sultan = Sultan()
         self.logged_in = False
+        self.last_upload = []
+        self._stores = None
+        self.metrics = metrics.from_config(self.settings.metrics, email=self.settings.email)
         self.configure_encryption()
 
+    @property
+    def settings(self):
+        """
+        The validated :class:`~lp_backup.config.Config` of ``config``. It is
+        compiled again when ``config`` has been changed since, raising
+        ``ConfigurationError`` if the change is invalid.
+        """
+        if self.config != self._settings_source:
+            self.settings = config_file.compile(self.config, self.config_path)
+        return self._settings
+
+    @settings.setter
+    def settings(self, compiled):
+        self._settings = compiled
+        self._settings_source = copy.deepcopy(self.config)
+
     def login(self):
+        with self.metrics.stage("login"):
+            out = subprocess.run(self._login_command(), stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, **self._lpass_env())
+        self._check_login(out.stdout, out.stderr)
+
+    def add_metrics_hook(self, hook):
+        """
+        Pass timing records for every stage of backups and restores to a
+        callable, as described in :mod:`lp_backup.metrics`.
+
+        :param hook: a callable taking one record (a dict) at a time
+        """
+        self.metrics.add_hook(hook)
+
+    def _login_command(self):
         trust = ""
-        if self.config['Trust']:
+        if self.settings.trust:
             trust = "--trust"
-        out = subprocess.run(["lpass", "login", self.config["Email"], trust], stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        if out.stderr:
-            print(out.stderr)
-            raise exceptions.LoginFailed(out.stderr)
-        if "Success:" in out.stdout.decode('utf-8'):
+        return ["lpass", "login", self.settings.email, trust]
+
+    def _check_login(self, stdout, stderr):
+        if stderr:
+            print(stderr)
+            raise exceptions.LoginFailed(stderr)
+        if "Success:" in stdout.decode('utf-8'):
             self.logged_in = True
         else:
-            print(out.stderr + " " + out.stdout)
-            raise exceptions.LoginFailed(out.stderr + " " + out.stdout)
+            print(stderr + " " + stdout)
+            raise exceptions.LoginFailed(stderr + " " + stdout)
+
+    def ensure_login(self):
+        """
+        Log in only if ``lpass status`` says there is no live session, so a
+        long running process does not log in again for every backup.
+        """
+        with self.metrics.stage("status"):
+            status = subprocess.run(["lpass", "status", "--quiet"],
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    **self._lpass_env())
+        self.logged_in = status.returncode == 0
+        if not self.logged_in:
+            self.login()
+
+    def _lpass_env(self):
+        """Keyword arguments for running lpass, giving it its own session
+        directory when ``LPASS Home`` is set."""
+        home = self.settings.lpass_home
+        if not home:
+            return {}
+        env = dict(os.environ)
+        env["LPASS_HOME"] = os.path.expanduser(home)
+        return {"env": env}
+
+    def accounts(self):
+        """
+        A runner for each entry of ``Accounts``, or just this runner if there
+        are none. See :meth:`for_account`.
+        """
+        if not self.settings.accounts:
+            return [self]
+        return [self.for_account(account) for account in self.settings.accounts]
+
+    def for_account(self, account):
+        """
+        A runner for one entry of ``Accounts``. The entry's settings override
+        this runner's, and each account gets its own lastpass session
+        directory under ``LPASS Home`` so logins don't collide. Accounts that
+        don't set their own ``Backing Store`` share this runner's store
+        connections, so close this runner, not the account runners.
+
+        :param account: the entry from ``Accounts``; ``Email`` is required
+        """
+        if not account.get("Email"):
+            _config_error("Email")
+        account_runner = copy.copy(self)
+        config = dict(self.config)
+        config.pop("Accounts", None)
+        config.update(account)
+        home = os.path.expanduser(self.settings.lpass_home or LPASS_HOME)
+        if "LPASS Home" not in account:
+            config["LPASS Home"] = os.path.join(home, config["Email"])
+        os.makedirs(os.path.expanduser(config["LPASS Home"]), mode=0o700,
+                    exist_ok=True)
+        account_runner.config = config
+        account_runner.settings = config_file.compile(config, self.config_path)
+        account_runner.logged_in = False
+        account_runner.last_upload = []
+        account_runner.metrics = self.metrics.child(email=config["Email"])
+        if "Backing Store" in account:
+            account_runner._stores = None
+        else:
+            account_runner._stores = self.stores
+        if "Encryption Key" in account:
+            if str(account["Encryption Key"]).lower() == "generate":
+                raise exceptions.ConfigurationError(
+                    "Accounts cannot generate an Encryption Key; set one or "
+                    "share the top level key.")
+            account_runner.configure_encryption()
+        return account_runner
 
     def configure_encryption(self):
-        if self.config["Encryption Key"] is None:
+        """
+        Set up the cipher from ``Encryption Key``, generating and saving a key
+        if it is ``generate``. With ``Previous Encryption Keys`` the cipher is
+        a key ring that encrypts with the current key and decrypts with any.
+        """
+        if self.settings.encryption_key is None:
             self.fernet = None
             return
-        if self.config["Encryption Key"].lower() == "generate":
+        from cryptography.fernet import Fernet
+        if str(self.settings.encryption_key).lower() == "generate":
             new_key = Fernet.generate_key()
             self.config["Encryption Key"] = new_key
-            with self.filesystem.open(self.config_path, 'w') as config_file:
-                self.yaml.dump(self.config, config_file)
+            self._save_config()
         try:
-            self.fernet = Fernet(self.config["Encryption Key"])
+            self.fernet = rotation.key_ring(self._encryption_keys())
         except ValueError as err:
-            raise exceptions.InvalidKey("Could not find valid encryption key: "
-                    + err)
+            raise exceptions.InvalidKey(f"Could not find valid encryption key: {err}")
+
+    def _encryption_keys(self):
+        """The current key followed by the ``Previous Encryption Keys``."""
+        return [self.settings.encryption_key] + list(self.settings.previous_keys)
+
+    def _save_config(self):
+        with self.filesystem.open(self.config_path, 'w') as config_file:
+            self.yaml.dump(self.config, config_file)
+
+    def new_key(self):
+        """
+        Generate a new current encryption key, keeping the current one in
+        ``Previous Encryption Keys`` so existing backups stay readable, and
+        save the configuration. Run :meth:`rotate_key` afterwards to
+        re-encrypt the existing backups with it.
+
+        :return: the new key
+        """
+        if self.fernet is None:
+            _config_error("No Encryption Key is configured to rotate.")
+        from cryptography.fernet import Fernet
+        key = Fernet.generate_key().decode('ascii')
+        self.config["Previous Encryption Keys"] = self._encryption_keys()
+        self.config["Encryption Key"] = key
+        self._save_config()
+        self.configure_encryption()
+        return key
+
+    def rotate_key(self, *, max_workers=None):
+        """
+        Re-encrypt every backup of this account still encrypted with an old
+        key, on every store holding it, as described in
+        :mod:`lp_backup.rotation`. Backups are rotated in parallel and the
+        catalog records each one's new key as it goes, so an interrupted
+        rotation picks up where it stopped when run again. Copies of a backup
+        still waiting in the spool are replaced with the rotated backup. Once
+        backups were rotated, the manifest's fingerprints are dropped, so the
+        next backup is a full one keyed with the new key.
+
+        :param keyword max_workers: the most backups to rotate at once, from
+            ``Rotate Workers`` by default
+
+        :return: a list of :class:`~lp_backup.rotation.RotateResult`, one per
+            backup that needed rotating
+        """
+        if self.fernet is None:
+            _config_error("No Encryption Key is configured to rotate.")
+        if max_workers is None:
+            max_workers = self.settings.rotate_workers or rotation.DEFAULT_WORKERS
+        current = self._key_id()
+        pending = [entry for entry in self.list_backups()
+                   if entry['encrypted'] and entry.get('key_id') != current]
+        results = {}
+        updates = {}
+        with self.metrics.operation("rotate"):
+            with ThreadPoolExecutor(max_workers=max(min(max_workers, len(pending)), 1)) as executor:
+                futures = {executor.submit(self._rotate_backup, entry): entry
+                           for entry in pending}
+                for future in as_completed(futures):
+                    filename = futures[future]['filename']
+                    try:
+                        fields = future.result()
+                        self._respool(futures[future])
+                    except Exception as err:
+                        results[filename] = rotation.RotateResult(filename, False, err)
+                        continue
+                    updates[filename] = fields
+                    results[filename] = rotation.RotateResult(filename, True, None)
+                    if len(updates) >= rotation.SAVE_EVERY:
+                        self._catalog_update(updates)
+                        updates = {}
+            if updates:
+                self._catalog_update(updates)
+            if any(result.success for result in results.values()):
+                self._reset_fingerprints()
+        return [results[entry['filename']] for entry in pending]
+
+    def _rotate_backup(self, entry):
+        """Re-encrypt one backup and its record index on the stores holding it,
+        returning the catalog fields that changed."""
+        outfs, prefix = self._backup_stores()
+        holding = self._holding(entry, outfs)
+        filename = entry['filename']
+        policy = self._upload_policy()
+        retry_policy = {key: policy[key] for key in ("retries", "retry_delay") if key in policy}
+        if incremental.is_delta(filename):
+            return self._rotate_delta(entry, holding, prefix, retry_policy)
+        rekeyed = rotation.Rekeyed(self._fingerprint_key(), urls=bool(entry.get('index')))
+        with self.metrics.stage("rotate") as stage:
+            with file_io.open_backup(holding, filename, prefix) as infile:
+                measured = stream.Measured(rotation.rotate(
+                    filename, stream.read_chunks(infile), self.fernet, rekeyed,
+                    self._compression_level()))
+                file_io.write_out_stream(holding, measured, filename, prefix, **retry_policy)
+            stage["bytes"] = measured.size
+        if entry.get('index'):
+            data = file_io.read_backup(holding, entry['index'], prefix)
+            _, codec_name, _ = container.read_header(data)
+            document = index.load(container.decode(data, self.fernet,
+                                                    self.settings.allow_unencrypted))
+            data = container.encode(json.dumps(rekeyed.rekey_index(document)).encode('utf-8'),
+                                    codec_name, self.fernet)
+            file_io.replace_file(holding, data, entry['index'], prefix, **retry_policy)
+        return {
+            'size': measured.size,
+            'checksum': measured.sha256.hexdigest(),
+            'md5': measured.md5.hexdigest(),
+            'plaintext_hmac': rekeyed.digest.hexdigest(),
+            'key_id': self._key_id(),
+        }
+
+    def _holding(self, entry, outfs):
+        """The stores the catalog lists a backup on, or all of them if it
+        lists none of them."""
+        if not isinstance(outfs, list):
+            outfs = [outfs]
+        return [backing_fs for backing_fs in outfs
+                if file_io.listed_on(entry['stores'], backing_fs)] or outfs
+
+    def _respool(self, entry):
+        """Replace the spooled copies of a rotated backup and its record
+        index, which are still encrypted with the old key, with the rotated
+        files, so delivering them later matches the catalog."""
+        spool = self._spool()
+        if spool is None:
+            return
+        outfs, prefix = self._backup_stores()
+        directory = prefix if not prefix or prefix.endswith('/') else prefix + '/'
+        names = [name for name in (entry['filename'], entry.get('index')) if name]
+        for spooled in spool.entries():
+            name = spooled['path'][len(directory):]
+            if spooled['path'].startswith(directory) and name in names:
+                with file_io.open_backup(self._holding(entry, outfs), name, prefix) as infile:
+                    spool.replace(spooled['id'], infile)
+
+    def _rotate_delta(self, entry, holding, prefix, retry_policy):
+        """Re-encrypt an incremental delta, hashing the keys of its removed
+        records again with the new fingerprint key. The records are found in
+        the snapshot and the deltas before it, so the delta still applies once
+        the old key is gone."""
+        filename = entry['filename']
+        with self.metrics.stage("rotate") as stage:
+            stored = file_io.read_backup(holding, filename, prefix)
+            if container.is_container(stored):
+                delta = incremental.load_delta(container.decode(
+                    stored, self.fernet, self.settings.allow_unencrypted))
+            else:
+                delta = incremental.load_delta(self._decode_legacy(filename, stored))
+            _, records = incremental.parse_records(
+                self._read_backup(holding, delta['snapshot'], prefix))
+            for name in delta['chain']:
+                previous = incremental.load_delta(self._read_backup(holding, name, prefix))
+                records.update(previous['added'])
+                records.update(previous['changed'])
+            delta['removed'] = incremental.rekey_removed(
+                records, delta['removed'], self._delta_key(delta, records),
+                self._fingerprint_key())
+            delta['key_id'] = self._key_id()
+            plaintext = json.dumps(delta).encode('utf-8')
+            if container.is_container(stored):
+                _, codec_name, _ = container.read_header(stored)
+                data = container.encode(plaintext, codec_name, self.fernet,
+                                        level=self._compression_level())
+            else:
+                codec = codecs.detect(filename, stored)
+                data = self.fernet.encrypt(plaintext)
+                if codec.module is not None:
+                    data = codec.compress(data, self._compression_level())
+            file_io.replace_file(holding, data, filename, prefix, **retry_policy)
+            stage["bytes"] = len(data)
+        return {
+            'size': len(data),
+            'checksum': catalog.checksum(data),
+            'md5': catalog.md5(data),
+            'plaintext_hmac': manifest.fingerprint(plaintext, self._fingerprint_key()),
+            'key_id': self._key_id(),
+        }
+
+    def _catalog_update(self, updates):
+        """Apply changed fields to catalog entries.
+
+        :param updates: dict of file name to the fields to change
+        """
+        outfs, prefix = self._backup_stores()
+        with file_io.index_lock(outfs, prefix), self.metrics.stage("catalog"):
+            backups = catalog.load(self._index_sources(outfs, prefix), prefix)
+            for entry in backups["backups"]:
+                entry.update(updates.get(entry["filename"], {}))
+            catalog.save(outfs, backups, prefix, **self._index_policy(prefix))
+
+    def _reset_fingerprints(self):
+        """Forget this account's fingerprints in the manifest, which are keyed
+        with an old key after a rotation."""
+        outfs, prefix = self._backup_stores()
+        with file_io.index_lock(outfs, prefix), self.metrics.stage("manifest"):
+            current = manifest.load(self._index_sources(outfs, prefix), prefix)
+            entry = current['accounts'].get(self.settings.email)
+            if entry is None:
+                return
+            entry.pop('fingerprint', None)
+            entry.pop('chain', None)
+            manifest.save(outfs, current, prefix, **self._index_policy(prefix))
+            self._manifest = None
 
     def backup(self):
         """
         Using the configuration from the file, create the backup.
         """
-        if not self.logged_in:
-            self.login()
-        run_backup = subprocess.run(["lpass", "export"], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+        with self.metrics.operation("backup"):
+            self._prepare_backup()
+            if not self.logged_in:
+                self.login()
+            if self.settings.streaming:
+                return self._backup_streaming()
+            with self.metrics.stage("export") as stage:
+                run_backup = subprocess.run(["lpass", "export"], stderr=subprocess.PIPE,
+                                            stdout=subprocess.PIPE, **self._lpass_env())
+                stage["bytes"] = len(run_backup.stdout)
+            if run_backup.stderr:
+                raise exceptions.BackupFailed(run_backup.stderr)
+            # print("backup downloaded")
+            return self._store_export(run_backup.stdout)
+
+    def _prepare_backup(self):
+        """The steps every backup takes before exporting, here and in
+        :class:`lp_backup.aio.AsyncRunner`: check options changed since
+        loading, so mistakes fail before logging in, and deliver backups
+        spooled for stores that were down on earlier runs."""
+        # reading the settings compiles the options again if they changed
+        if self.settings.spool_directory:
+            self.drain_spool()
+
+    def _store_export(self, backup_data):
+        """Encrypt, compress and upload the output of ``lpass export``,
+        returning the name of the backup."""
         file_suffix = '.csv'
-        if run_backup.stderr:
-            raise exceptions.BackupFailed(run_backup.stderr)
-        # print("backup downloaded")
-        backup_data = run_backup.stdout
-        # backup_data = '\n'.join(backup_lines)
+        self._manifest = None
+        if self.settings.skip_unchanged:
+            existing = self._find_unchanged(backup_data)
+            if existing:
+                return existing
+        if self.settings.incremental:
+            outfile = self._backup_incremental(backup_data)
+        else:
+            outfile = self._write_backup(backup_data, file_suffix)
+        if self._manifest is not None:
+            self._record_backup(outfile)
+        return outfile
+
+    def _encode(self, backup_data, file_suffix, builder=None):
+        """Encrypt and compress backup data according to the configuration,
+        returning the data and the file suffix describing it. Container frames
+        are indexed by ``builder`` if one is given."""
+        if self._use_container():
+            with self.metrics.stage("encode") as stage:
+                if builder is not None:
+                    frames = container.encode_frames(
+                        builder.split([backup_data]), self._codec(), self.fernet,
+                        self._compression_level(), self._compression_workers())
+                    backup_data = b''.join(builder.track(frames))
+                else:
+                    backup_data = container.encode(
+                        backup_data, self._codec(), self.fernet,
+                        frame_size=self._chunk_size(), level=self._compression_level(),
+                        workers=self._compression_workers())
+                stage["bytes"] = len(backup_data)
+            file_suffix += container.SUFFIX
+        else:
+            if self.fernet:
+                with self.metrics.stage("encrypt") as stage:
+                    backup_data = self.fernet.encrypt(backup_data)
+                    stage["bytes"] = len(backup_data)
+                file_suffix += ".encrypted"
+            codec = codecs.get(self._codec())
+            if codec.module is not None:
+                with self.metrics.stage("compress", codec=codec.name) as stage:
+                    backup_data = self._compress_legacy(codec, backup_data)
+                    stage["bytes"] = len(backup_data)
+                file_suffix += codec.suffix
+        return backup_data, file_suffix
+
+    def _compress_legacy(self, codec, data):
+        workers = self._compression_workers()
+        if workers <= 1:
+            return codec.compress(data, self._compression_level())
+        size = self._chunk_size()
+        blocks = (data[i:i + size] for i in range(0, len(data), size))
+        return b''.join(codecs.compress_blocks(blocks, codec, self._compression_level(),
+                                               workers))
+
+    def _write_backup(self, backup_data, file_suffix, name="-lastpass-backup",
+                      depends=None):
+        builder = self._index_builder() if name != incremental.DELTA_NAME else None
+        plaintext_hmac = manifest.fingerprint(backup_data, self._fingerprint_key())
+        backup_data, file_suffix = self._encode(backup_data, file_suffix, builder)
+        outfs, prefix, outfile = self._backup_destination(file_suffix, name)
+        with self.metrics.stage("upload", bytes=len(backup_data)):
+            self.last_upload = file_io.write_out_backup(
+                backing_store_fs=outfs,
+                outfile=outfile,
+                prefix=prefix,
+                data=backup_data,
+                **self._write_policy()
+            )
+        if self.metrics.enabled:
+            for result in self.last_upload:
+                self.metrics.record("store_upload", result.duration,
+                                    store=file_io.store_label(result.store),
+                                    bytes=result.bytes_written, success=result.success)
+        stores = [file_io.store_label(result.store) for result in self.last_upload
+                  if result.success]
+        index_file = self._write_index(outfs, prefix, outfile, builder) if builder else None
+        self._catalog_backup(outfile, len(backup_data), catalog.checksum(backup_data),
+                             stores, depends=depends, index=index_file,
+                             md5=catalog.md5(backup_data), plaintext_hmac=plaintext_hmac)
+        return outfile
+
+    def _index_builder(self):
+        """An index builder if ``Record Index`` is set for container backups."""
+        if not (self.settings.record_index and self._use_container()):
+            return None
+        return index.Builder(self._fingerprint_key(), self._chunk_size())
+
+    def _write_index(self, outfs, prefix, outfile, builder):
+        """Store the record index of a new backup next to it, encoded like
+        the backup, and return its name."""
+        index_file = index.index_name(outfile)
+        with self.metrics.stage("index") as stage:
+            data = container.encode(builder.dump(outfile), self._codec(), self.fernet)
+            file_io.write_out_backup(outfs, data, index_file, prefix, **self._write_policy())
+            stage["bytes"] = len(data)
+        return index_file
+
+    def _catalog_backup(self, outfile, size, checksum, stores, **details):
+        """Add a newly written backup to the catalog. ``details`` are passed
+        on to :func:`lp_backup.catalog.entry`."""
+        outfs, prefix = self._backup_stores()
+        with file_io.index_lock(outfs, prefix), self.metrics.stage("catalog"):
+            backups = catalog.load(self._index_sources(outfs, prefix), prefix)
+            catalog.add(backups, catalog.entry(
+                outfile, self.settings.email, size, checksum, self._codec(),
+                "container" if self._use_container() else "legacy",
+                self.fernet is not None, stores,
+                kind="delta" if incremental.is_delta(outfile) else "full",
+                key_id=self._key_id(),
+                **details))
+            catalog.save(outfs, backups, prefix, **self._index_policy(prefix))
+
+    def list_backups(self):
+        """
+        List this account's backups from the catalog, without listing the
+        backing stores.
+
+        :return: a list of catalog entries, oldest first. Each is a dict with
+            the ``filename``, ``timestamp``, ``size``, ``checksum``, ``codec``
+            and the ``stores`` holding the backup, among others.
+        """
+        outfs, prefix = self._backup_stores()
+        backups = catalog.load(self._index_sources(outfs, prefix), prefix)
+        return catalog.backups(backups, self.settings.email)
+
+    def latest(self):
+        """
+        The catalog entry of this account's most recent backup.
+
+        :return: the entry, or None if there are no backups
+        """
+        backups = self.list_backups()
+        return backups[-1] if backups else None
+
+    def verify(self, *, quick=False, plaintext=False, max_workers=None):
+        """
+        Check every copy of this account's backups on every backing store
+        against the size and checksums recorded in the catalog, as described
+        in :mod:`lp_backup.verify`.
+
+        :param keyword quick: trust a matching size where the store has no
+            checksum to compare, instead of downloading the copy
+        :param keyword plaintext: also decrypt and decompress every copy and
+            check the keyed hash of its plaintext, which proves it restores
+        :param keyword max_workers: the most copies to check at once, from
+            ``Verify Workers`` by default
+
+        :return: a list of :class:`~lp_backup.verify.CheckResult`
+        """
+        from lp_backup import verify
+        outfs, prefix = self._backup_stores()
+        if not isinstance(outfs, list):
+            outfs = [outfs]
+        if max_workers is None:
+            max_workers = self.settings.verify_workers or verify.DEFAULT_WORKERS
+        with self.metrics.operation("verify"):
+            return verify.verify_backups(
+                outfs, self.list_backups(), prefix, quick=quick,
+                plaintext_hmac=self._plaintext_hmac if plaintext else None,
+                max_workers=max_workers)
+
+    def _plaintext_hmac(self, backing_fs, entry):
+        """Keyed hash of the plaintext of one store's copy of a backup, with
+        the fingerprint key of the key the backup is encrypted with."""
+        digest = hmac.new(self._fingerprint_key(entry.get('key_id')), digestmod=hashlib.sha256)
+        for chunk in self._plaintext_chunks([backing_fs], entry['filename'],
+                                            self.settings.prefix, replay=False):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def _key_id(self):
+        """The id of the current encryption key, or None without encryption."""
+        if self.fernet is None:
+            return None
+        return rotation.key_id(self.settings.encryption_key)
+
+    def _fingerprint_keys(self):
+        """The fingerprint key of every key in the ring by key id, the
+        current key's first."""
+        if self.fernet is None:
+            return {None: manifest.fingerprint_key(None)}
+        return {rotation.key_id(key): manifest.fingerprint_key(key)
+                for key in self._encryption_keys()}
+
+    def _fingerprint_key(self, key_id=None):
+        """The fingerprint key of the current encryption key, or of the key
+        in the ring with ``key_id`` if there is one."""
+        keys = self._fingerprint_keys()
+        return keys.get(key_id, next(iter(keys.values())))
+
+    def _find_unchanged(self, backup_data):
+        """
+        Look the export up in the manifest. If the vault has not changed since
+        the last backup, record the run and return the existing backup's name.
+        """
+        self._fingerprint = manifest.fingerprint(backup_data, self._fingerprint_key())
+        existing = manifest.unchanged_backup(self._load_manifest(), self.settings.email,
+                                             self._fingerprint)
+        if existing:
+            manifest.record(self._manifest, self.settings.email, self._fingerprint,
+                            existing, skipped=True)
+            self._save_manifest()
+            self.last_upload = []
+        return existing
+
+    def _record_backup(self, outfile):
+        if self.settings.skip_unchanged:
+            manifest.record(self._manifest, self.settings.email, self._fingerprint, outfile)
+        self._save_manifest()
+
+    def _load_manifest(self):
+        if self._manifest is None:
+            outfs, prefix = self._backup_stores()
+            self._manifest = manifest.load(self._index_sources(outfs, prefix), prefix)
+        return self._manifest
+
+    def _save_manifest(self):
+        outfs, prefix = self._backup_stores()
+        with file_io.index_lock(outfs, prefix), self.metrics.stage("manifest"):
+            # other accounts may have saved the manifest since it was loaded
+            email = self.settings.email
+            current = manifest.load(self._index_sources(outfs, prefix), prefix)
+            if email in self._manifest['accounts']:
+                current['accounts'][email] = self._manifest['accounts'][email]
+            self._manifest = current
+            manifest.save(outfs, self._manifest, prefix, **self._index_policy(prefix))
+
+    def _backup_incremental(self, backup_data):
+        """
+        Store only the records that changed since the previous run, starting a
+        new chain with a full snapshot every ``Full Snapshot Every`` deltas or
+        ``Full Snapshot Days`` days.
+        """
+        key = self._fingerprint_key()
+        key_id = self._key_id()
+        fieldnames, records = incremental.parse_records(backup_data)
+        hashes = incremental.record_hashes(records, key)
+        entry = self._load_manifest()['accounts'].setdefault(self.settings.email, {})
+        chain = entry.get('chain')
+        if chain and chain['fieldnames'] == fieldnames:
+            delta = incremental.diff(chain['records'], records, key)
+            if incremental.is_empty(delta):
+                self.last_upload = []
+                return (chain['deltas'] or [chain['snapshot']])[-1]
+        if self._needs_snapshot(chain, fieldnames):
+            outfile = self._write_backup(backup_data, '.csv')
+            entry['chain'] = {
+                'snapshot': outfile,
+                'created': datetime.datetime.today().timestamp(),
+                'fieldnames': fieldnames,
+                'deltas': [],
+                'key_id': key_id,
+            }
+        else:
+            delta_data = incremental.dump_delta(delta, fieldnames, chain['snapshot'],
+                                                chain['deltas'], key_id)
+            outfile = self._write_backup(delta_data, incremental.DELTA_SUFFIX,
+                                         name=incremental.DELTA_NAME,
+                                         depends=[chain['snapshot']] + chain['deltas'])
+            chain['deltas'].append(outfile)
+        entry['chain']['records'] = hashes
+        return outfile
+
+    def _needs_snapshot(self, chain, fieldnames):
+        if not chain or chain['fieldnames'] != fieldnames:
+            return True
+        # the previous run's hashes were keyed with a key that has since changed
+        if chain.get('key_id', self._key_id()) != self._key_id():
+            return True
+        if len(chain['deltas']) >= self.settings.full_snapshot_every:
+            return True
+        age = datetime.datetime.today().timestamp() - chain['created']
+        return age >= self.settings.full_snapshot_days * 24 * 60 * 60
+
+    def _backup_streaming(self, cancellation=None):
+        """
+        Create the backup without buffering the export. Chunks are read from
+        ``lpass export`` as they are produced and pushed through encryption and
+        compression straight into writers on every backing store. With
+        ``Format: container`` each chunk becomes one container frame, otherwise
+        each chunk is encrypted as its own length-prefixed Fernet frame, which
+        is marked with ``.stream`` in the file name.
+
+        :param optional cancellation: a :class:`lp_backup.stream.Cancellation`
+            to stop the export from another thread
+        """
+        plaintext_hmac = hmac.new(self._fingerprint_key(), digestmod=hashlib.sha256)
+        chunks = stream.digested(stream.export_chunks(self._chunk_size(),
+                                                      cancellation=cancellation,
+                                                      **self._lpass_env()),
+                                 plaintext_hmac)
+        file_suffix = '.csv'
+        builder = self._index_builder()
+        if self._use_container():
+            if builder is not None:
+                chunks = builder.split(chunks)
+            chunks = container.encode_frames(chunks, self._codec(), self.fernet,
+                                             self._compression_level(),
+                                             self._compression_workers())
+            if builder is not None:
+                chunks = builder.track(chunks)
+            file_suffix += container.SUFFIX
+        else:
+            chunks, file_suffix = self._legacy_stream(chunks, file_suffix)
+        outfs, prefix, outfile = self._backup_destination(file_suffix)
+        measured = stream.Measured(chunks)
+        policy = self._write_policy()
+        policy.pop("max_workers", None)
+        with self.metrics.stage("stream") as stage:
+            self.last_upload = file_io.write_out_stream(
+                backing_store_fs=outfs,
+                outfile=outfile,
+                prefix=prefix,
+                chunks=measured,
+                **policy
+            )
+            stage["bytes"] = measured.size
+        index_file = self._write_index(outfs, prefix, outfile, builder) if builder else None
+        self._catalog_backup(outfile, measured.size, measured.sha256.hexdigest(),
+                             [file_io.store_label(result.store)
+                              for result in self.last_upload if result.success],
+                             index=index_file, md5=measured.md5.hexdigest(),
+                             plaintext_hmac=plaintext_hmac.hexdigest())
+        return outfile
+
+    def _legacy_stream(self, chunks, file_suffix):
         if self.fernet:
-            backup_data = self.fernet.encrypt(backup_data)
-            file_suffix += ".encrypted"
-        if self.config.get("Compression", False):
-            backup_data = lzma.compress(backup_data)
-            file_suffix += ".xz"
-        outfs = None
-        prefix = None
+            chunks = stream.encrypt_frames(chunks, self.fernet)
+            file_suffix += ".stream.encrypted"
+        codec = codecs.get(self._codec())
+        if codec.module is not None:
+            if self._compression_workers() > 1:
+                chunks = codecs.compress_blocks(chunks, codec, self._compression_level(),
+                                                self._compression_workers())
+            else:
+                chunks = codecs.compress_stream(chunks, codec, self._compression_level())
+            file_suffix += codec.suffix
+        return chunks, file_suffix
+
+    def _upload_policy(self):
+        """Keyword arguments for write_out_backup from the optional
+        ``Upload Workers``, ``Quorum``, ``Upload Retries`` and ``Retry Delay``
+        settings."""
+        settings = self.settings
+        policy = {}
+        if settings.upload_workers is not None:
+            policy["max_workers"] = settings.upload_workers
+        if settings.quorum != "all":
+            policy["quorum"] = settings.quorum
+        if settings.upload_retries is not None:
+            policy["retries"] = settings.upload_retries
+        if settings.retry_delay is not None:
+            policy["retry_delay"] = settings.retry_delay
+        return policy
+
+    def _write_policy(self):
+        """The upload policy for backups themselves, which may be spooled."""
+        policy = self._upload_policy()
+        if self._spool() is not None:
+            policy["spool"] = self._spool()
+        return policy
+
+    def _index_policy(self, prefix):
+        """The upload policy for the catalog and the manifest. Stores with
+        backups waiting in the spool count towards the quorum, as the
+        catalog and manifest are written to them again once the backups are
+        delivered."""
+        policy = self._upload_policy()
+        if self._spool() is not None:
+            policy["spooled"] = self._spool().stores(prefix)
+        return policy
+
+    def _index_sources(self, outfs, prefix, behind=None):
+        """The stores to read the catalog and manifest from, in order. Stores
+        the spool holds backups for come last, as they missed the latest
+        catalog and manifest too.
+
+        :param optional behind: labels of those stores, by default the ones
+            in the spool now
+        """
+        if not isinstance(outfs, list):
+            return outfs
+        if behind is None:
+            spool = self._spool()
+            behind = spool.stores(prefix) if spool is not None else ()
+        return sorted(outfs, key=lambda backing_fs: file_io.store_label(backing_fs) in behind)
+
+    def _spool(self):
+        """The spool for backups stores could not take, if ``Spool
+        Directory`` is set."""
+        if not self.settings.spool_directory:
+            return None
+        return Spool(self.settings.spool_directory)
+
+    def drain_spool(self):
+        """
+        Deliver backups kept in the spool for stores that failed on earlier
+        runs, and add the stores to their catalog entries. The catalog and
+        manifest, which those stores missed too, are written to them again.
+        Backups that still can't be delivered stay spooled.
+
+        :return: a tuple of (delivered, failed) lists as returned by
+            :meth:`lp_backup.spool.Spool.drain`
+        """
+        spool = self._spool()
+        if spool is None:
+            return [], []
+        outfs, prefix = self._backup_stores()
+        policy = self._upload_policy()
+        behind = spool.stores(prefix)
+        with self.metrics.stage("drain") as stage:
+            delivered, failed = spool.drain(
+                outfs, prefix, retries=policy.get("retries", file_io.UPLOAD_RETRIES),
+                retry_delay=policy.get("retry_delay", file_io.RETRY_DELAY))
+            stage["files"] = len(delivered)
+        if delivered:
+            # spooled copies are directly under the prefix
+            self._catalog_copies([(backing_fs, path.rsplit('/', 1)[-1])
+                                  for backing_fs, path in delivered], behind)
+            self._refresh_manifest(behind)
+        return delivered, failed
+
+    def _refresh_manifest(self, behind=()):
+        """Write the manifest to every store again, reading it from the
+        stores that are not ``behind`` first."""
+        outfs, prefix = self._backup_stores()
+        with file_io.index_lock(outfs, prefix), self.metrics.stage("manifest"):
+            current = manifest.load(self._index_sources(outfs, prefix, behind), prefix)
+            if current['accounts']:
+                manifest.save(outfs, current, prefix, **self._index_policy(prefix))
+
+    def sync(self, *, dry_run=False, max_workers=None):
+        """
+        Copy every backup missing from a backing store to it from one that
+        has it, as described in :mod:`lp_backup.sync`, and add the stores to
+        the catalog entries of the copied backups. Backups are copied as
+        stored and never decrypted.
+
+        :param keyword dry_run: only work out what would be copied
+        :param keyword max_workers: the most copies to run at once, from
+            ``Sync Workers`` by default
+
+        :return: a list of :class:`~lp_backup.sync.CopyResult`
+        """
+        from lp_backup import sync
+        outfs, prefix = self._backup_stores()
+        if max_workers is None:
+            max_workers = self.settings.sync_workers or sync.DEFAULT_WORKERS
+        policy = self._upload_policy()
+        with self.metrics.operation("sync"):
+            results = sync.sync_backups(
+                outfs, prefix, max_workers=max_workers, dry_run=dry_run,
+                retries=policy.get("retries", file_io.UPLOAD_RETRIES),
+                retry_delay=policy.get("retry_delay", file_io.RETRY_DELAY))
+            copied = [(result.target, result.filename) for result in results
+                      if result.method != sync.LIST and result.error is None]
+            if copied and not dry_run:
+                self._catalog_copies(copied)
+        return results
+
+    def _catalog_copies(self, copies, behind=()):
+        """Add the stores backups were copied to to their catalog entries.
+
+        :param copies: (store, file name) tuples
+        :param optional behind: labels of stores whose catalog may be out of
+            date, which is then read from the others first and always saved
+        """
+        outfs, prefix = self._backup_stores()
+        with file_io.index_lock(outfs, prefix), self.metrics.stage("catalog"):
+            backups = catalog.load(self._index_sources(outfs, prefix, behind), prefix)
+            entries = {entry["filename"]: entry for entry in backups["backups"]}
+            changed = bool(behind)
+            for backing_fs, filename in copies:
+                entry = entries.get(filename)
+                if entry is not None and not file_io.listed_on(entry["stores"], backing_fs):
+                    entry["stores"].append(file_io.store_label(backing_fs))
+                    changed = True
+            if changed:
+                catalog.save(outfs, backups, prefix, **self._index_policy(prefix))
+
+    def _use_container(self):
+        return self.settings.format == "container"
+
+    def _codec(self):
+        return self.settings.compression
+
+    def _compression_level(self):
+        return self.settings.compression_level
+
+    def _compression_workers(self):
+        """The number of processes compressing blocks, from ``Compression
+        Workers``; ``auto`` uses every core."""
+        if self.settings.compression_workers == "auto":
+            return os.cpu_count() or 1
+        return self.settings.compression_workers
+
+    def _chunk_size(self):
+        return self.settings.chunk_size or stream.CHUNK_SIZE
+
+    def _backup_stores(self):
         try:
             outfs = self._configure_backing_store()
-            prefix = self.config.get('Prefix', '')
-            if self.config.get('Date', False):
-                date = datetime.datetime.today().isoformat() + "-"
-            else:
-                date = ""
+            file_io.label_stores(outfs)
+            return outfs, self.settings.prefix
         except KeyError as err:
             _config_error(err)
-        outfile = (date + self.config["Email"] +
-                "-lastpass-backup" + file_suffix)
-        file_io.write_out_backup(
-            backing_store_fs=outfs,
-            outfile=outfile,
-            prefix=prefix,
-            data=backup_data
-        )
-        return outfile
+
+    def _backup_destination(self, file_suffix, name="-lastpass-backup"):
+        outfs, prefix = self._backup_stores()
+        if self.settings.date:
+            date = datetime.datetime.today().isoformat() + "-"
+        else:
+            date = ""
+        outfile = (date + self.settings.email +
+                name + file_suffix)
+        return outfs, prefix, outfile
+
+    def prune(self, dry_run=False, scan=False):
+        """
+        Delete the backups the ``Retention`` policy no longer keeps from every
+        backing store, and drop them from the catalog.
+
+        :param optional dry_run: only report what would be deleted
+        :param optional scan: also consider date-stamped backups that are
+            missing from the catalog, found by listing the prefix on each store
+
+        :return: a dict with the ``keep`` and ``delete`` file names and, unless
+            this is a dry run, the per-store :class:`~lp_backup.file_io.DeleteResult`
+            list as ``results``
+        """
+        if not self.settings.retention:
+            _config_error("No Retention policy is configured.")
+        outfs, prefix = self._backup_stores()
+        if not isinstance(outfs, list):
+            outfs = [outfs]
+        backups = catalog.load(self._index_sources(outfs, prefix), prefix)
+        entries = catalog.backups(backups, self.settings.email)
+        if scan:
+            entries += self._uncatalogued_backups(outfs, prefix, entries)
+        keep, delete = retention.plan(entries,
+                                      self.settings.retention,
+                                      self._protected_backups(outfs, prefix))
+        report = {
+            'keep': [entry['filename'] for entry in keep],
+            'delete': [entry['filename'] for entry in delete],
+            'results': [],
+        }
+        if dry_run or not delete:
+            return report
+        # record indexes go with their backups
+        indexes = [entry['index'] for entry in delete if entry.get('index')]
+        report['results'] = file_io.delete_backups(outfs, report['delete'] + indexes, prefix)
+        with file_io.index_lock(outfs, prefix), self.metrics.stage("catalog"):
+            # backups may have been added since the catalog was read
+            backups = catalog.load(self._index_sources(outfs, prefix), prefix)
+            for result in report['results']:
+                for entry in backups['backups']:
+                    if entry['filename'] in result.deleted:
+                        file_io.unlist(entry['stores'], result.store)
+            deleted = set(report['delete'])
+            backups['backups'] = [entry for entry in backups['backups']
+                                  if entry['filename'] not in deleted or entry['stores']]
+            catalog.save(outfs, backups, prefix, **self._index_policy(prefix))
+        return report
+
+    def _uncatalogued_backups(self, outfs, prefix, entries):
+        known = {entry['filename'] for entry in entries}
+        names = set()
+        for backing_fs in outfs:
+            try:
+                names.update(backing_fs.listdir(prefix or '/'))
+            except fs.errors.ResourceNotFound:
+                continue
+        return [entry for entry in retention.entries_from_names(names, self.settings.email)
+                if entry['filename'] not in known]
+
+    def _protected_backups(self, outfs, prefix):
+        """Backups the manifest still points at, which must not be pruned."""
+        current = manifest.load(self._index_sources(outfs, prefix), prefix)
+        entry = current['accounts'].get(self.settings.email, {})
+        protected = [entry['backup']] if entry.get('backup') else []
+        chain = entry.get('chain')
+        if chain:
+            protected += [chain['snapshot']] + chain['deltas']
+        return protected
 
     def restore(self, infilename, new_file):
         """
@@ -122,53 +1034,249 @@ class Runner(object):
         :param new_file: the filename to save the data to
 
         """
+        with self.filesystem.openbin(str(new_file), 'w') as the_new_file:
+            self.restore_stream(infilename, the_new_file)
+        return new_file
+
+    def restore_stream(self, infilename, output):
+        """
+        Restore a backup into a binary file object, such as an open file or
+        ``sys.stdout.buffer``. The backup is downloaded, decompressed and
+        decrypted a chunk at a time and written as it is decoded, so memory
+        use stays flat however large the vault is. Legacy backups encrypted as
+        a single token, incremental deltas and hedged reads are decoded in
+        memory instead, since they need the whole file at once.
+
+        :param infilename: the name of the backup file
+        :param output: a writable binary file object
+
+        :return: the number of bytes written
+        """
+        with self.metrics.operation("restore"):
+            try:
+                restorefs = self._configure_backing_store()
+                prefix = self.settings.prefix
+            except KeyError as err:
+                _config_error(err)
+            if not self._can_stream(infilename):
+                restored_data = self._read_full(restorefs, infilename, prefix)
+                with self.metrics.stage("write", bytes=len(restored_data)):
+                    output.write(restored_data)
+                return len(restored_data)
+            with self.metrics.stage("stream") as stage:
+                written = 0
+                with file_io.open_backup(restorefs, infilename, prefix) as infile:
+                    for chunk in self._decode_stream(infilename, infile):
+                        output.write(chunk)
+                        written += len(chunk)
+                stage["bytes"] = written
+            return written
+
+    def restore_entries(self, infilename, output, *, entries=(), folders=()):
+        """
+        Restore only some entries of a backup, as csv with the export's header
+        row, into a binary file object. If the backup has a record index (see
+        ``Record Index``) only the index and the frames holding the entries are
+        read, otherwise the whole backup is decoded but only the matching
+        records are written.
+
+        :param infilename: the name of the backup file
+        :param output: a writable binary file object
+        :param keyword entries: ids, names or URLs of the entries to restore
+        :param keyword folders: folders to restore, with their subfolders
+
+        :return: the number of bytes written
+        """
+        entry_filter = index.EntryFilter(self._fingerprint_key(), entries, folders)
+        if not entry_filter:
+            raise exceptions.ConfigurationError("No entries or folders to restore.")
+        with self.metrics.operation("restore"):
+            restorefs, prefix = self._backup_stores()
+            with self.metrics.stage("index"):
+                record_index = self._load_index(restorefs, infilename, prefix)
+            if record_index is None:
+                records = index.matching_records(
+                    self._plaintext_chunks(restorefs, infilename, prefix), entry_filter)
+            else:
+                records = self._indexed_records(restorefs, infilename, prefix,
+                                                record_index, entry_filter)
+            with self.metrics.stage("write") as stage:
+                written = 0
+                for record in records:
+                    output.write(record)
+                    written += len(record)
+                stage["bytes"] = written
+            return written
+
+    def _load_index(self, restorefs, infilename, prefix):
+        """The record index of a backup, or None if it has none."""
+        if not infilename.endswith(container.SUFFIX):
+            return None
         try:
-            restorefs = self._configure_backing_store()
-            prefix = self.config.get("Prefix", "")
-        except KeyError as err:
-            _config_error(err)
-        restored_data = file_io.read_backup(restorefs, infilename, prefix)
-        if self.config.get("Compression", False):
-            restored_data = lzma.decompress(restored_data)
-        if self.fernet:
+            data = file_io.read_backup(restorefs, index.index_name(infilename), prefix)
+        except exceptions.ConfigurationError:
+            return None
+        record_index = index.load(container.decode(data, self.fernet,
+                                                   self.settings.allow_unencrypted))
+        if record_index['backup'] != infilename:
+            raise exceptions.BackupFailed(f"The record index does not belong to {infilename}.")
+        return record_index
+
+    def _indexed_records(self, restorefs, infilename, prefix, record_index, entry_filter):
+        """The header row and matching records, decoding only the frames the
+        index says hold them."""
+        frames = index.select(record_index, entry_filter)
+        ranges = [(0, container.MAX_HEADER_SIZE)] + [
+            tuple(record_index['frames'][number]) for number in frames]
+        with self.metrics.stage("download") as stage:
+            found = file_io.read_ranges(restorefs, infilename, ranges, prefix)
+            stage["bytes"] = sum(len(data) for data in found.values())
+        allow_unencrypted = self.settings.allow_unencrypted
+        plaintext = (container.decode_frame(found[offset], found[0], number, self.fernet,
+                                            allow_unencrypted)
+                     for number, (offset, _) in zip(frames, ranges[1:]))
+        if frames and frames[0] == 0:
+            # the first frame starts with the header row
+            return index.matching_records(plaintext, entry_filter)
+        header = record_index['header'].encode('utf-8', 'surrogateescape')
+        return itertools.chain([header], index.matching_records(
+            plaintext, entry_filter, record_index['fieldnames']))
+
+    def _plaintext_chunks(self, restorefs, infilename, prefix, replay=True):
+        """Yield the plaintext of a whole backup, a chunk at a time where
+        possible. Deltas are replayed onto their snapshot unless ``replay``
+        is false."""
+        if not replay and incremental.is_delta(infilename):
+            yield self._read_backup(restorefs, infilename, prefix)
+            return
+        if not self._can_stream(infilename):
+            yield self._read_full(restorefs, infilename, prefix)
+            return
+        with file_io.open_backup(restorefs, infilename, prefix) as infile:
+            yield from self._decode_stream(infilename, infile)
+
+    def _can_stream(self, infilename):
+        if incremental.is_delta(infilename) or self.settings.hedge_delay is not None:
+            return False
+        # a legacy backup encrypted as one Fernet token must be verified whole
+        whole_token = ".encrypted" in infilename and ".stream.encrypted" not in infilename
+        return not (self.fernet and whole_token)
+
+    def _decode_stream(self, infilename, infile):
+        """Decode a backup read from a binary file object one chunk at a time."""
+        chunks = stream.read_chunks(infile, self._chunk_size())
+        first = next(chunks, b'')
+        chunks = itertools.chain([first], chunks)
+        if container.is_container(first):
+            return container.decode_stream(stream.ChunkReader(chunks), self.fernet,
+                                           self.settings.allow_unencrypted)
+        chunks = codecs.decompress_stream(chunks, codecs.detect(infilename, first))
+        if self.fernet and ".stream.encrypted" in infilename:
+            chunks = stream.decrypt_chunks(chunks, self.fernet)
+        return chunks
+
+    def _read_full(self, restorefs, infilename, prefix):
+        """Fetch and decode a backup, replaying its chain if it is a delta."""
+        restored_data = self._read_backup(restorefs, infilename, prefix)
+        if incremental.is_delta(infilename):
+            with self.metrics.stage("replay"):
+                restored_data = self._replay_deltas(restorefs, prefix, restored_data)
+        return restored_data
+
+    def _read_backup(self, restorefs, infilename, prefix):
+        """Fetch a backup from the backing stores and decode it."""
+        with self.metrics.stage("download") as stage:
+            if self.settings.hedge_delay is not None:
+                restored_data = file_io.read_backup_hedged(
+                    restorefs, infilename, prefix,
+                    delay=self.settings.hedge_delay,
+                    verify=functools.partial(self._verify_backup, infilename))
+            else:
+                restored_data = file_io.read_backup(restorefs, infilename, prefix)
+            stage["bytes"] = len(restored_data)
+        with self.metrics.stage("decode"):
+            if container.is_container(restored_data):
+                return container.decode(restored_data, self.fernet,
+                                        self.settings.allow_unencrypted)
+            return self._decode_legacy(infilename, restored_data)
+
+    def _replay_deltas(self, restorefs, prefix, delta_data):
+        """Rebuild the export a delta was taken from by applying its chain to
+        the snapshot it started from."""
+        delta = incremental.load_delta(delta_data)
+        snapshot = self._read_backup(restorefs, delta['snapshot'], prefix)
+        lineterminator = '\r\n' if snapshot.split(b'\n', 1)[0].endswith(b'\r') else '\n'
+        _, records = incremental.parse_records(snapshot)
+        for name in delta['chain']:
+            previous = incremental.load_delta(self._read_backup(restorefs, name, prefix))
+            incremental.apply_delta(records, previous, self._delta_key(previous, records))
+        incremental.apply_delta(records, delta, self._delta_key(delta, records))
+        return incremental.format_records(delta['fieldnames'], records, lineterminator)
+
+    def _delta_key(self, delta, records):
+        """The fingerprint key a delta's removed records were hashed with:
+        the one of the key it names, or for deltas that don't name one,
+        whichever key in the ring matches them."""
+        keys = self._fingerprint_keys()
+        if delta.get('key_id') in keys:
+            return keys[delta['key_id']]
+        return incremental.matching_key(records, delta['removed'], list(keys.values()))
+
+    def _verify_backup(self, infilename, data):
+        """Cheaply check that downloaded backup data is complete, going by
+        the backup's own name and contents rather than the current settings."""
+        if container.is_container(data):
+            return container.is_complete(data)
+        codec = codecs.detect(infilename, data)
+        if codec.module is not None:
+            if data[:len(codec.magic)] != codec.magic:
+                return False
+            return codec.name != 'lzma' or data[-2:] == XZ_FOOTER_MAGIC
+        if ".stream.encrypted" in infilename:
+            return stream.frames_complete(data)
+        if ".encrypted" in infilename:
+            return data[:1] == stream.FERNET_TOKEN_START
+        return len(data) > 0
+
+    def _decode_legacy(self, infilename, restored_data):
+        codec = codecs.detect(infilename, restored_data)
+        restored_data = codec.decompress(restored_data)
+        if self.fernet and ".stream.encrypted" in infilename:
+            restored_data = stream.decrypt_frames(restored_data, self.fernet)
+        elif self.fernet:
             restored_data = self.fernet.decrypt(restored_data)
-        with self.filesystem.open(str(new_file), 'w') as the_new_file:
-            the_new_file.write(restored_data.decode('utf-8'))
-        return new_file
+        return restored_data
+
+    @property
+    def stores(self):
+        """
+        The :class:`~lp_backup.stores.StoreRegistry` of backing stores. Stores
+        are connected on first use and kept open until :meth:`close`.
+        """
+        if self._stores is None:
+            try:
+                self._stores = StoreRegistry(self.settings.backing_stores)
+            except KeyError as err:
+                _config_error(err)
+        return self._stores
+
+    def close(self):
+        """Close every backing store connection the runner has opened."""
+        if self._stores is not None:
+            self._stores.close()
+            self._stores = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def _configure_backing_store(self):
         try:
-            backing_stores = []
-            for bs in self.config['Backing Store']:
-                if 'Type' in bs:
-                    for key, item in bs.items():
-                        bs[key] = _get_from_env(item)
-                    if bs['Type'].lower() == 's3':
-                        backing_stores.append(S3FS(
-                            bs['Bucket'],
-                            strict=False,
-                            aws_access_key_id=bs.get('Key ID', None),
-                            aws_secret_access_key=bs.get('Secret Key', None),
-                            endpoint_url=bs.get('Endpoint URL', None)
-                        ))
-                    elif 'dav' in bs['Type'].lower():
-                        if not webdav_available:
-                            raise exceptions.NoWebdav("no webdavfs module was found")
-                        if bs['Root'][0] != '/':
-                            bs['Root'] = '/' + bs['Root']
-                        backing_stores.append(WebDAVFS(
-                            url=bs['Base URL'],
-                            login=bs['Username'],
-                            password=bs['Password'],
-                            root=bs['Root']
-                        ))
-                    else:
-                        _config_error("Unknown filesystem type.")
-                else:
-                    backing_stores.append(fs.open_fs(bs['URI'], create=True))
+            return self.stores.all()
         except (KeyError, OSError, CreateFailed) as err:
             _config_error(err)
-        return backing_stores
 
 
 def _config_error(err=''):
@@ -176,14 +1284,3 @@ def _config_error(err=''):
         "Options are missing in the configuration file. "
         f"Pleaseconsult the docs at https://lastpass-local-backup.readthedocs.io\n"
         f"{err}")
-
-
-def _get_from_env(item):
-    if item is None:
-        return None
-    try:
-        if item[0] == '$':
-            return os.environ[item[1:]]
-    except TypeError:
-        pass
-    return item
@@ -0,0 +1,288 @@
+"""
+S3 backing store with concurrent multipart uploads, ranged downloads and
+server-side copies.
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import hashlib
+import io
+import threading
+import time
+
+import fs.errors
+from fs_s3fs import S3FS
+from fs_s3fs._s3fs import s3errors
+
+from lp_backup import exceptions
+
+MIB = 1024 * 1024
+MIN_PART_SIZE = 5 * MIB
+DEFAULT_PART_SIZE = 8 * MIB
+DEFAULT_CONCURRENCY = 4
+PART_RETRIES = 3
+RETRY_DELAY = 0.5
+# the largest object a single CopyObject request can copy
+MAX_COPY_SIZE = 5 * 1024 * MIB
+MAX_PARTS = 10000
+
+
+class MultipartS3FS(S3FS):
+    """
+    An ``S3FS`` that uploads files larger than one part as a multipart upload
+    and downloads them with ranged GETs, ``concurrency`` parts at a time.
+    A part that fails is retried on its own, so one dropped connection does
+    not restart the whole transfer. If an upload still fails, the upload and
+    its finished parts are kept, and uploading the same path again resumes it,
+    skipping every part whose md5 matches the part already stored. Call
+    :meth:`discard_upload` to give it up. Smaller files use a single request.
+
+    Takes the same arguments as ``S3FS``, and:
+
+    :param keyword part_size: the size of each part in bytes, at least 5 MiB
+    :param keyword concurrency: the number of parts to transfer at once
+    :param keyword part_retries: how many times to try each part
+    """
+    def __init__(self, *args, part_size=DEFAULT_PART_SIZE,
+                 concurrency=DEFAULT_CONCURRENCY, part_retries=PART_RETRIES,
+                 **kwargs):
+        if part_size < MIN_PART_SIZE:
+            raise exceptions.ConfigurationError(
+                f"S3 Part Size must be at least {MIN_PART_SIZE // MIB} MiB.")
+        self.part_size = part_size
+        self.concurrency = max(int(concurrency), 1)
+        self.part_retries = max(int(part_retries), 1)
+        self._incomplete = {}
+        self._incomplete_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def upload(self, path, file, chunk_size=None, **options):
+        first_part = file.read(self.part_size)
+        second_part = b''
+        if len(first_part) == self.part_size:
+            second_part = file.read(self.part_size)
+        if not second_part:
+            return self.writebytes(path, first_part)
+        _path = self.validatepath(path)
+        _key = self._path_to_key(_path)
+        with self._incomplete_lock:
+            incomplete = self._incomplete.pop(_key, None)
+        if incomplete is None:
+            with s3errors(path):
+                upload_id = self.client.create_multipart_upload(
+                    Bucket=self._bucket_name, Key=_key,
+                    **self._get_upload_args(_key))['UploadId']
+            incomplete = (upload_id, {})
+        upload_id, uploaded = incomplete
+        try:
+            parts = self._upload_parts(path, _key, upload_id,
+                                       _parts(file, [first_part, second_part],
+                                              self.part_size), uploaded)
+            with s3errors(path):
+                self.client.complete_multipart_upload(
+                    Bucket=self._bucket_name, Key=_key, UploadId=upload_id,
+                    MultipartUpload={'Parts': parts})
+        except fs.errors.ResourceNotFound:
+            # the upload expired or was aborted, so the next try starts afresh
+            raise
+        except BaseException:
+            with self._incomplete_lock:
+                self._incomplete[_key] = incomplete
+            raise
+
+    def discard_upload(self, path):
+        """Abort the incomplete multipart upload kept for ``path``, if any."""
+        _key = self._path_to_key(self.validatepath(path))
+        with self._incomplete_lock:
+            incomplete = self._incomplete.pop(_key, None)
+        if incomplete is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self._bucket_name, Key=_key, UploadId=incomplete[0])
+
+    def close(self):
+        incomplete = {}
+        if hasattr(self, '_incomplete_lock'):
+            with self._incomplete_lock:
+                incomplete, self._incomplete = self._incomplete, {}
+        for key, (upload_id, _) in incomplete.items():
+            try:
+                self.client.abort_multipart_upload(
+                    Bucket=self._bucket_name, Key=key, UploadId=upload_id)
+            except Exception:
+                pass
+        super().close()
+
+    def writebytes(self, path, contents):
+        if len(contents) <= self.part_size:
+            return super().writebytes(path, contents)
+        return self.upload(path, io.BytesIO(contents))
+
+    def download(self, path, file, chunk_size=None, **options):
+        _path = self.validatepath(path)
+        _key = self._path_to_key(_path)
+        with s3errors(path):
+            size = self.client.head_object(Bucket=self._bucket_name,
+                                           Key=_key)['ContentLength']
+        if size <= self.part_size:
+            return super().download(path, file, chunk_size, **options)
+        ranges = [(start, min(start + self.part_size, size) - 1)
+                  for start in range(0, size, self.part_size)]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = []
+            for byte_range in ranges:
+                pending.append(executor.submit(self._get_range, path, _key, byte_range))
+                if len(pending) >= self.concurrency:
+                    file.write(pending.pop(0).result())
+            for future in pending:
+                file.write(future.result())
+
+    def open_stream(self, path):
+        """
+        Open an object for reading straight from the response body, instead
+        of downloading it to a temporary file first as ``openbin`` does.
+
+        :return: a readable binary file object
+        """
+        _path = self.validatepath(path)
+        _key = self._path_to_key(_path)
+        with s3errors(path):
+            return self.client.get_object(Bucket=self._bucket_name, Key=_key)['Body']
+
+    def object_info(self, path):
+        """
+        The size and ETag of an object from one HEAD request.
+
+        :return: a tuple of (size in bytes, ETag without its quotes)
+        """
+        _path = self.validatepath(path)
+        _key = self._path_to_key(_path)
+        with s3errors(path):
+            response = self.client.head_object(Bucket=self._bucket_name, Key=_key)
+        return response['ContentLength'], response.get('ETag', '').strip('"')
+
+    def read_range(self, path, offset, length):
+        """
+        Read ``length`` bytes of an object starting at ``offset`` with one
+        ranged GET.
+        """
+        _path = self.validatepath(path)
+        _key = self._path_to_key(_path)
+        return self._get_range(path, _key, (offset, offset + length - 1))
+
+    def shares_endpoint(self, other):
+        """
+        Whether objects can be copied from another store to this one inside
+        S3: it is an S3 store on the same endpoint using the same credentials.
+        """
+        return (isinstance(other, S3FS) and other.endpoint_url == self.endpoint_url
+                and other.aws_access_key_id == self.aws_access_key_id)
+
+    def copy_from(self, source, src_path, dst_path):
+        """
+        Copy an object from a store that :meth:`shares_endpoint` with this one
+        without downloading it. Objects over 5 GiB are copied as a multipart
+        upload, ``concurrency`` ranges at a time.
+
+        :param source: the S3 store to copy from
+        :param src_path: the path of the object on ``source``
+        :param dst_path: the path to copy it to on this store
+
+        :return: the size of the object in bytes
+        """
+        src_key = source._path_to_key(source.validatepath(src_path))
+        _key = self._path_to_key(self.validatepath(dst_path))
+        copy_source = {'Bucket': source._bucket_name, 'Key': src_key}
+        with s3errors(src_path):
+            size = self.client.head_object(Bucket=source._bucket_name,
+                                           Key=src_key)['ContentLength']
+        if size <= MAX_COPY_SIZE:
+            self._retry(dst_path, self.client.copy_object, Bucket=self._bucket_name,
+                        Key=_key, CopySource=copy_source, **self._get_upload_args(_key))
+            return size
+        part_size = max(self.part_size, -(-size // MAX_PARTS))
+        with s3errors(dst_path):
+            upload_id = self.client.create_multipart_upload(
+                Bucket=self._bucket_name, Key=_key,
+                **self._get_upload_args(_key))['UploadId']
+        ranges = [(start, min(start + part_size, size) - 1)
+                  for start in range(0, size, part_size)]
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                responses = list(executor.map(
+                    lambda part: self._retry(
+                        dst_path, self.client.upload_part_copy, Bucket=self._bucket_name,
+                        Key=_key, UploadId=upload_id, PartNumber=part[0],
+                        CopySource=copy_source,
+                        CopySourceRange='bytes={}-{}'.format(*part[1])),
+                    enumerate(ranges, 1)))
+            parts = [{'PartNumber': number, 'ETag': response['CopyPartResult']['ETag']}
+                     for number, response in enumerate(responses, 1)]
+            with s3errors(dst_path):
+                self.client.complete_multipart_upload(
+                    Bucket=self._bucket_name, Key=_key, UploadId=upload_id,
+                    MultipartUpload={'Parts': parts})
+        except BaseException:
+            self.client.abort_multipart_upload(
+                Bucket=self._bucket_name, Key=_key, UploadId=upload_id)
+            raise
+        return size
+
+    def _upload_parts(self, path, key, upload_id, parts, uploaded):
+        """Upload the parts not already in ``uploaded`` (part number to ETag),
+        recording each in it as it finishes."""
+        count = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = set()
+            for number, body in enumerate(parts, 1):
+                count = number
+                etag = uploaded.get(number)
+                if etag and etag.strip('"') == hashlib.md5(body).hexdigest():
+                    continue
+                pending.add(executor.submit(self._upload_part, path, key, upload_id,
+                                            number, body, uploaded))
+                if len(pending) >= self.concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+            for future in pending:
+                future.result()
+        return [{'PartNumber': number, 'ETag': uploaded[number]}
+                for number in range(1, count + 1)]
+
+    def _upload_part(self, path, key, upload_id, number, body, uploaded):
+        response = self._retry(path, self.client.upload_part, Bucket=self._bucket_name,
+                               Key=key, UploadId=upload_id, PartNumber=number,
+                               Body=body)
+        uploaded[number] = response['ETag']
+
+    def _get_range(self, path, key, byte_range):
+        start, end = byte_range
+
+        def get():
+            # the body is read inside the retry, as that is where a dropped
+            # connection shows up
+            response = self.client.get_object(Bucket=self._bucket_name, Key=key,
+                                              Range=f'bytes={start}-{end}')
+            part = response['Body'].read()
+            if len(part) != end - start + 1:
+                raise exceptions.BackupFailed(
+                    f"Read {len(part)} of {end - start + 1} bytes at {start} of {path}.")
+            return part
+        return self._retry(path, get)
+
+    def _retry(self, path, request, **kwargs):
+        for attempt in range(1, self.part_retries + 1):
+            try:
+                with s3errors(path):
+                    return request(**kwargs)
+            except Exception:
+                if attempt == self.part_retries:
+                    raise
+                time.sleep(RETRY_DELAY * attempt)
+
+
+def _parts(file, first_parts, part_size):
+    yield from first_parts
+    while True:
+        part = file.read(part_size)
+        if not part:
+            return
+        yield part
@@ -0,0 +1,208 @@
+"""
+Scheduled backups from a single long running process.
+
+The daemon reads the configuration once and keeps one :class:`Runner`, so the
+lastpass session and the backing store connections stay open between backups.
+Backups run on a cron-like schedule with a random delay added to each run, and
+``SIGUSR1`` runs one immediately.
+"""
+import datetime
+import random
+import signal
+import threading
+import traceback
+
+from lp_backup import exceptions
+
+ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+    '@yearly': '0 0 1 1 *',
+}
+FIELDS = (
+    ('minute', 0, 59),
+    ('hour', 0, 23),
+    ('day', 1, 31),
+    ('month', 1, 12),
+    ('weekday', 0, 7),
+)
+# long enough to find a run on 29 February
+MAX_DAYS = 366 * 5
+
+
+def parse_schedule(spec):
+    """
+    Parse a five field cron expression (minute, hour, day of month, month,
+    day of week) or one of ``@hourly``, ``@daily``, ``@weekly``, ``@monthly``
+    and ``@yearly``. Fields take ``*``, numbers, ranges (``1-5``), steps
+    (``*/15``, ``0-30/10``) and comma separated lists of those. Day of week
+    runs from 0 (Sunday) to 6; 7 is also Sunday.
+
+    :param spec: the schedule
+
+    :return: dict of field name to the set of matching values, and the flags
+        ``day_any`` and ``weekday_any`` for unrestricted day fields
+
+    :raises ConfigurationError: if the schedule cannot be parsed
+    """
+    spec = ALIASES.get(str(spec).strip().lower(), str(spec))
+    parts = spec.split()
+    if len(parts) != len(FIELDS):
+        raise exceptions.ConfigurationError(
+            f"Schedule must have {len(FIELDS)} fields: {spec}")
+    schedule = {}
+    for text, (name, low, high) in zip(parts, FIELDS):
+        schedule[name] = _parse_field(text, low, high, spec)
+    schedule['weekday'] = {day % 7 for day in schedule['weekday']}
+    schedule['day_any'] = parts[2] == '*'
+    schedule['weekday_any'] = parts[4] == '*'
+    return schedule
+
+
+def _parse_field(text, low, high, spec):
+    values = set()
+    for item in text.split(','):
+        step = 1
+        if '/' in item:
+            item, step = item.split('/', 1)
+        try:
+            step = int(step)
+            if item == '*':
+                start, end = low, high
+            elif '-' in item:
+                start, end = (int(value) for value in item.split('-', 1))
+            else:
+                start = end = int(item)
+                if step != 1:
+                    end = high
+        except ValueError:
+            raise exceptions.ConfigurationError(f"Invalid schedule: {spec}")
+        if step < 1 or start < low or end > high or start > end:
+            raise exceptions.ConfigurationError(f"Invalid schedule: {spec}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def _day_matches(schedule, when):
+    day = when.day in schedule['day']
+    weekday = (when.weekday() + 1) % 7 in schedule['weekday']
+    # as in cron, a restricted day of month and day of week match either one
+    if schedule['day_any'] or schedule['weekday_any']:
+        return day and weekday
+    return day or weekday
+
+
+def next_run(schedule, after):
+    """
+    The first time after ``after`` that a schedule matches.
+
+    :param schedule: a schedule from :func:`parse_schedule`
+    :param after: a naive datetime
+
+    :return: a datetime on a whole minute, strictly later than ``after``
+    """
+    when = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+    limit = when + datetime.timedelta(days=MAX_DAYS)
+    while when < limit:
+        if when.month not in schedule['month'] or not _day_matches(schedule, when):
+            when = (when + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+        elif when.hour not in schedule['hour']:
+            when = (when + datetime.timedelta(hours=1)).replace(minute=0)
+        elif when.minute not in schedule['minute']:
+            when += datetime.timedelta(minutes=1)
+        else:
+            return when
+    raise exceptions.ConfigurationError("Schedule never runs.")
+
+
+class Daemon(object):
+    """
+    Run backups with one runner on a schedule until stopped.
+
+    :param runner: the :class:`lp_backup.Runner` to back up with
+    :param schedule: a cron-like schedule, see :func:`parse_schedule`
+    :param optional jitter: the most seconds to delay each scheduled run by,
+        so many machines on the same schedule don't back up at once
+    :param keyword rng: source of the random delay (for testing)
+    :param keyword now: function returning the current time (for testing)
+    """
+    def __init__(self, runner, schedule, jitter=0, *, rng=None, now=None):
+        self.runner = runner
+        self.schedule = parse_schedule(schedule)
+        self.jitter = float(jitter or 0)
+        self.rng = rng or random.Random()
+        self.now = now or datetime.datetime.now
+        self.runs = 0
+        self._wake = threading.Event()
+        self._triggered = False
+        self._stopped = False
+
+    def next_due(self):
+        """When the next scheduled backup should start, jitter included."""
+        due = next_run(self.schedule, self.now())
+        return due + datetime.timedelta(seconds=self.rng.uniform(0, self.jitter))
+
+    def trigger(self, *args):
+        """Run a backup now instead of waiting for the schedule."""
+        self._triggered = True
+        self._wake.set()
+
+    def stop(self, *args):
+        """Stop after any backup in progress has finished."""
+        self._stopped = True
+        self._wake.set()
+
+    def install_signal_handlers(self):
+        """``SIGUSR1`` triggers a backup; ``SIGTERM`` and ``SIGINT`` stop."""
+        signal.signal(signal.SIGUSR1, self.trigger)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def run(self, max_runs=None):
+        """
+        Wait for each scheduled or triggered backup and run it, until
+        :meth:`stop` is called.
+
+        :param optional max_runs: stop after this many backups
+        """
+        while not self._stopped:
+            self._wait_until(self.next_due())
+            if self._stopped:
+                break
+            self.run_once()
+            if max_runs is not None and self.runs >= max_runs:
+                break
+
+    def run_once(self):
+        """
+        Run one backup, logging in first if the lastpass session has expired.
+        Failures are reported and the daemon carries on, including unexpected
+        errors, which are reported with their traceback.
+
+        :return: the backup file name, or None if the backup failed
+        """
+        self.runs += 1
+        try:
+            self.runner.ensure_login()
+            outfile = self.runner.backup()
+        except (exceptions.LoginFailed, exceptions.BackupFailed,
+                exceptions.ConfigurationError, OSError) as err:
+            print(f"{self.now().isoformat()} Backup failed: {err}")
+            return None
+        except Exception as err:
+            print(f"{self.now().isoformat()} Backup failed unexpectedly: {err!r}")
+            traceback.print_exc()
+            return None
+        print(f"{self.now().isoformat()} New backup is {outfile}")
+        return outfile
+
+    def _wait_until(self, due):
+        while not self._stopped and not self._triggered:
+            remaining = (due - self.now()).total_seconds()
+            if remaining <= 0:
+                break
+            self._wake.wait(remaining)
+            self._wake.clear()
+        self._triggered = False
@@ -0,0 +1,154 @@
+"""
+Local spool for backups a backing store could not take.
+
+When a store still fails after its retries, the backup is kept in a spool
+directory on local disk for it instead, so the run succeeds with the stores
+that are up and nothing has to be exported or uploaded again. Later runs
+deliver spooled backups to their stores before backing up.
+
+Each spooled copy is a ``.data`` file with the stored bytes and a ``.json``
+file naming the store and the path. The json is written last, so a copy is
+only picked up once its data is complete. The data is what would have been
+uploaded, so it is as encrypted as the backup itself.
+"""
+import json
+import os
+import shutil
+import time
+import uuid
+
+from lp_backup import file_io
+
+
+class Spool(object):
+    """
+    A spool directory.
+
+    :param directory: the directory to keep spooled backups in. It is created
+        on first use, readable only by its owner.
+    """
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(str(directory))
+
+    def add(self, store, path, data):
+        """
+        Keep a copy of a backup for a store.
+
+        :param store: the backing store it is for
+        :param path: the path on the store, prefix included
+        :param data: the bytes, or a readable binary file object
+
+        :return: the id of the spooled copy
+        """
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        spool_id = f"{time.time():.6f}-{uuid.uuid4().hex}"
+        self._write_data(self._path(spool_id, '.data'), data)
+        record = {'store': file_io.store_label(store), 'path': path,
+                  'created': time.time(), 'attempts': 0}
+        self._write_record(spool_id, record)
+        return spool_id
+
+    def entries(self):
+        """The spooled copies, oldest first, each a dict with its ``id``,
+        ``store`` label, ``path``, ``created`` time and delivery
+        ``attempts``."""
+        try:
+            names = sorted(os.listdir(self.directory))
+        except FileNotFoundError:
+            return []
+        entries = []
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(self.directory, name)) as record:
+                entries.append(dict(json.load(record), id=name[:-len('.json')]))
+        return entries
+
+    def stores(self, prefix=''):
+        """The labels of the stores with copies waiting under ``prefix``."""
+        if prefix and not prefix[-1] == '/':
+            prefix = prefix + '/'
+        return {entry['store'] for entry in self.entries()
+                if entry['path'].startswith(prefix) and '/' not in entry['path'][len(prefix):]}
+
+    def drain(self, backing_store_fs, prefix='', *, retries=file_io.UPLOAD_RETRIES,
+              retry_delay=file_io.RETRY_DELAY):
+        """
+        Deliver spooled copies under ``prefix`` to whichever of the stores
+        they are for. A copy that can't be delivered stays for the next run.
+
+        :param backing_store_fs: a pyfilesystem2 object or list of objects
+        :param optional prefix: only deliver copies stored under this prefix
+        :param keyword retries: how many more times to try each delivery
+        :param keyword retry_delay: the base delay between tries in seconds
+
+        :return: a tuple of (delivered, failed) lists. ``delivered`` holds
+            (store, path) tuples and ``failed`` (store, path, error) tuples.
+        """
+        if prefix and not prefix[-1] == '/':
+            prefix = prefix + '/'
+        if not isinstance(backing_store_fs, list):
+            backing_store_fs = [backing_store_fs]
+        stores = {file_io.store_label(backing_fs): backing_fs
+                  for backing_fs in backing_store_fs}
+        for backing_fs in backing_store_fs:
+            # copies spooled before stores had labels
+            stores.setdefault(str(backing_fs), backing_fs)
+        delivered = []
+        failed = []
+        for entry in self.entries():
+            backing_fs = stores.get(entry['store'])
+            name = entry['path'][len(prefix):]
+            if backing_fs is None or not entry['path'].startswith(prefix) or '/' in name:
+                continue
+            try:
+                file_io.with_retries(lambda: self._deliver(backing_fs, entry),
+                                     retries, retry_delay)
+            except Exception as err:
+                failed.append((backing_fs, entry['path'], err))
+                entry['attempts'] += 1
+                self._write_record(entry.pop('id'), entry)
+                continue
+            self.remove(entry['id'])
+            delivered.append((backing_fs, entry['path']))
+        return delivered, failed
+
+    def replace(self, spool_id, data):
+        """
+        Replace the bytes of a spooled copy, such as with the backup after
+        its key was rotated.
+
+        :param spool_id: the id of the spooled copy
+        :param data: the bytes, or a readable binary file object
+        """
+        partial = self._path(spool_id, '.data.partial')
+        self._write_data(partial, data)
+        os.replace(partial, self._path(spool_id, '.data'))
+
+    def remove(self, spool_id):
+        """Forget a spooled copy."""
+        os.remove(self._path(spool_id, '.json'))
+        os.remove(self._path(spool_id, '.data'))
+
+    def _deliver(self, backing_fs, entry):
+        directory = os.path.dirname(entry['path'])
+        if directory:
+            backing_fs.makedirs(directory, recreate=True)
+        with open(self._path(entry['id'], '.data'), 'rb') as spooled:
+            backing_fs.upload(entry['path'], spooled)
+
+    def _write_data(self, path, data):
+        with open(path, 'wb') as spooled:
+            if isinstance(data, (bytes, bytearray)):
+                spooled.write(data)
+            else:
+                shutil.copyfileobj(data, spooled, 1024 * 1024)
+
+    def _write_record(self, spool_id, record):
+        partial = self._path(spool_id, '.json.partial')
+        with open(partial, 'w') as record_file:
+            json.dump(record, record_file)
+        os.replace(partial, self._path(spool_id, '.json'))
+
+    def _path(self, spool_id, suffix):
+        return os.path.join(self.directory, spool_id + suffix)
@@ -0,0 +1,129 @@
+"""
+Registry of backing store connections.
+
+Building a backing store means a new boto session or HTTP connection pool, so
+the registry builds each store the first time it is needed and keeps it, with
+its connections, until the registry is closed. Backend libraries are imported
+only when a store of that type is configured.
+"""
+import re
+import threading
+
+import fs
+
+from lp_backup import exceptions
+from lp_backup import file_io
+
+
+class StoreRegistry(object):
+    """
+    Lazily built, cached backing stores.
+
+    :param store_configs: the ``backing_stores`` of a compiled
+        :class:`~lp_backup.config.Config`, with environment variables read
+    """
+    def __init__(self, store_configs):
+        self.store_configs = list(store_configs or [])
+        self.labels = labels(self.store_configs)
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.store_configs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, index):
+        """
+        The backing store at a position in the configuration, built on first
+        use. A store that has been closed is built again.
+
+        :param index: the position of the store in ``Backing Store``
+        """
+        with self._lock:
+            store = self._stores.get(index)
+            if store is None or store.isclosed():
+                store = open_store(self.store_configs[index])
+                file_io.set_store_label(store, self.labels[index])
+                self._stores[index] = store
+            return store
+
+    def all(self):
+        """Every backing store, in configuration order."""
+        return [self.get(index) for index in range(len(self.store_configs))]
+
+    def close(self):
+        """Close every store that has been built."""
+        with self._lock:
+            stores, self._stores = self._stores, {}
+        for store in stores.values():
+            store.close()
+
+
+def labels(store_configs):
+    """
+    The names stores are recorded under in the catalog: a store's ``Name``
+    if it has one, otherwise where it points, without credentials. Stores
+    that would be named alike get their position added, so every store's
+    name is unique.
+
+    :param store_configs: the ``Backing Store`` list from the configuration
+    """
+    names = [label_of(store_config) for store_config in store_configs]
+    return [f"{name}#{position}" if names.count(name) > 1 else name
+            for position, name in enumerate(names)]
+
+
+def label_of(store_config):
+    """The name of one ``Backing Store`` entry, see :func:`labels`."""
+    if store_config.get('Name'):
+        return str(store_config['Name'])
+    if 'Type' not in store_config:
+        return re.sub(r'//[^/@]*@', '//', str(store_config.get('URI', '')))
+    kind = str(store_config['Type']).lower()
+    if kind == 's3':
+        endpoint = store_config.get('Endpoint URL') or 'aws'
+        return f"s3://{store_config.get('Bucket')}@{endpoint}"
+    if 'dav' in kind:
+        return f"webdav:{store_config.get('Base URL')}/{str(store_config.get('Root')).lstrip('/')}"
+    return kind
+
+
+def open_store(store_config):
+    """
+    Build a pyfilesystem2 object from one ``Backing Store`` entry.
+
+    :param store_config: the entry from the compiled configuration
+    """
+    bs = store_config
+    if 'Type' not in bs:
+        return fs.open_fs(bs['URI'], create=True)
+    if bs['Type'].lower() == 's3':
+        # boto3 is slow to import, so only pay for it when S3 is configured
+        from lp_backup import s3
+        return s3.MultipartS3FS(
+            bs['Bucket'],
+            strict=False,
+            aws_access_key_id=bs.get('Key ID', None),
+            aws_secret_access_key=bs.get('Secret Key', None),
+            endpoint_url=bs.get('Endpoint URL', None),
+            part_size=int(float(bs.get('Part Size', 8)) * s3.MIB),
+            concurrency=int(bs.get('Concurrency', s3.DEFAULT_CONCURRENCY))
+        )
+    if 'dav' in bs['Type'].lower():
+        try:
+            from webdavfs.webdavfs import WebDAVFS
+        except ModuleNotFoundError:
+            raise exceptions.NoWebdav("no webdavfs module was found")
+        root = bs['Root'] if bs['Root'][0] == '/' else '/' + bs['Root']
+        return WebDAVFS(
+            url=bs['Base URL'],
+            login=bs['Username'],
+            password=bs['Password'],
+            root=root
+        )
+    raise exceptions.ConfigurationError(f"Unknown filesystem type {bs['Type']}.")
@@ -0,0 +1,252 @@
+"""
+Chunked pipeline pieces for streaming backups.
+
+Each function takes an iterable of byte chunks and yields transformed chunks,
+so a backup can be pushed from ``lpass export`` to the backing stores without
+ever holding the whole vault in memory.
+"""
+import hashlib
+import struct
+import subprocess
+import threading
+
+from lp_backup import exceptions
+
+CHUNK_SIZE = 1024 * 1024
+FRAME_HEADER = struct.Struct('>I')
+# every Fernet token starts with its version byte, which encodes to 'g'
+FERNET_TOKEN_START = b'g'
+
+
+class Cancellation(object):
+    """
+    Lets another thread stop an export running in :func:`export_chunks`:
+    :meth:`cancel` kills its ``lpass`` process, or the process as soon as it
+    starts if the export has not got that far yet.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._proc = None
+        self.cancelled = False
+
+    def started(self, proc):
+        """Called by :func:`export_chunks` with the process it started."""
+        with self._lock:
+            self._proc = proc
+            if self.cancelled:
+                proc.kill()
+
+    def cancel(self):
+        """Kill the export's lpass process."""
+        with self._lock:
+            self.cancelled = True
+            if self._proc is not None and self._proc.poll() is None:
+                self._proc.kill()
+
+
+def export_chunks(chunk_size=CHUNK_SIZE, env=None, cancellation=None):
+    """
+    Run ``lpass export`` and yield its output as it is produced.
+
+    :param optional chunk_size: the maximum number of bytes per chunk.
+    :param optional env: the environment to run lpass in
+    :param optional cancellation: a :class:`Cancellation` to stop the export
+        from another thread
+
+    :raises BackupFailed: if lpass writes to stderr or exits non-zero,
+        including after being cancelled.
+    """
+    options = {'env': env} if env is not None else {}
+    proc = subprocess.Popen(["lpass", "export"], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, **options)
+    if cancellation is not None:
+        cancellation.started(proc)
+    try:
+        while True:
+            chunk = proc.stdout.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        errors = proc.stderr.read()
+        returncode = proc.wait()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+    if errors or returncode:
+        if cancellation is not None and cancellation.cancelled:
+            raise exceptions.BackupFailed("The export was cancelled.")
+        raise exceptions.BackupFailed(errors)
+
+
+def encrypt_frames(chunks, fernet):
+    """
+    Encrypt each chunk separately and frame it with its length so the frames
+    can be told apart on restore.
+
+    :param chunks: iterable of plaintext byte chunks
+    :param fernet: the Fernet object to encrypt with
+    """
+    for chunk in chunks:
+        token = fernet.encrypt(chunk)
+        yield FRAME_HEADER.pack(len(token)) + token
+
+
+def decrypt_frames(data, fernet):
+    """
+    Reverse :func:`encrypt_frames` on a complete framed payload.
+
+    :param data: the framed, encrypted bytes
+    :param fernet: the Fernet object to decrypt with
+
+    :return: the decrypted plaintext
+    """
+    return b''.join(decrypt_chunks([data], fernet))
+
+
+def frames_complete(data):
+    """
+    Cheap check that the output of :func:`encrypt_frames` was not truncated,
+    without decrypting it: the frames must cover the data exactly and each
+    must hold a Fernet token.
+
+    :param data: the framed, encrypted bytes
+    """
+    offset = 0
+    while offset < len(data):
+        if len(data) - offset < FRAME_HEADER.size:
+            return False
+        (length,) = FRAME_HEADER.unpack_from(data, offset)
+        offset += FRAME_HEADER.size
+        if data[offset:offset + 1] != FERNET_TOKEN_START:
+            return False
+        offset += length
+    return offset == len(data) and offset > 0
+
+
+def decrypt_chunks(chunks, fernet):
+    """
+    Reverse :func:`encrypt_frames` on a stream, yielding the plaintext of each
+    frame as soon as all of it has arrived.
+
+    :param chunks: iterable of framed, encrypted byte chunks of any size
+    :param fernet: the Fernet object to decrypt with
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        offset = 0
+        while len(buffer) - offset >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(buffer, offset)
+            end = offset + FRAME_HEADER.size + length
+            if end > len(buffer):
+                break
+            yield fernet.decrypt(bytes(buffer[offset + FRAME_HEADER.size:end]))
+            offset = end
+        del buffer[:offset]
+    if buffer:
+        raise exceptions.BackupFailed("Backup stream is truncated.")
+
+
+def rotate_frames(chunks, fernet, plaintext=None):
+    """
+    Re-encrypt the frames of :func:`encrypt_frames` with the current key of a
+    ``MultiFernet`` as they arrive.
+
+    :param chunks: iterable of framed, encrypted byte chunks of any size
+    :param fernet: the ``MultiFernet`` holding the current and old keys
+    :param optional plaintext: callable given the plaintext of every frame
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        offset = 0
+        while len(buffer) - offset >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(buffer, offset)
+            end = offset + FRAME_HEADER.size + length
+            if end > len(buffer):
+                break
+            token = bytes(buffer[offset + FRAME_HEADER.size:end])
+            if plaintext is not None:
+                plaintext(fernet.decrypt(token))
+            token = fernet.rotate(token)
+            yield FRAME_HEADER.pack(len(token)) + token
+            offset = end
+        del buffer[:offset]
+    if buffer:
+        raise exceptions.BackupFailed("Backup stream is truncated.")
+
+
+class ChunkReader(object):
+    """
+    A minimal readable binary file over an iterable of byte chunks.
+
+    :param chunks: iterable of byte chunks
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def read_chunks(infile, chunk_size=CHUNK_SIZE):
+    """Yield a binary file's contents ``chunk_size`` bytes at a time."""
+    while True:
+        chunk = infile.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def compress_chunks(chunks, codec='lzma', level=None):
+    """
+    Compress a stream of chunks into a single compressed stream, such as one
+    ``.xz`` stream.
+
+    :param chunks: iterable of byte chunks
+    :param optional codec: name of the compression codec
+    :param optional level: the compression level
+    """
+    from lp_backup import codecs
+    return codecs.compress_stream(chunks, codecs.get(codec), level)
+
+
+class Measured(object):
+    """
+    Pass chunks through while keeping count of their total size, sha256 and
+    md5, so a streamed backup can be catalogued like a buffered one.
+
+    :param chunks: iterable of byte chunks
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5()
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.size += len(chunk)
+            self.sha256.update(chunk)
+            self.md5.update(chunk)
+            yield chunk
+
+
+def digested(chunks, digest):
+    """Pass chunks through, feeding each one to ``digest`` (a hashlib or
+    hmac object) on the way."""
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
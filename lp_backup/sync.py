@@ -0,0 +1,196 @@
+"""
+Copy backups between backing stores so that every store holds every backup.
+
+Each store's prefix is listed, and every backup (or record index) missing
+from a store is copied to it from a store that has it. Between S3 stores on
+the same endpoint the object is copied inside S3, without downloading it;
+otherwise it is streamed from one store into the other a chunk at a time. The
+stored bytes are copied as they are, so encrypted backups are never
+decrypted. Copies run on a thread pool, so backfilling a new store with a
+long history is one parallel operation.
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import fs
+
+from lp_backup import file_io
+from lp_backup import verify
+
+DEFAULT_WORKERS = 8
+BACKUP_MARKER = '-lastpass-'
+
+SERVER = 'server'
+STREAM = 'stream'
+LIST = 'list'
+
+CopyResult = namedtuple('CopyResult', ['filename', 'source', 'target', 'method',
+                                       'bytes_copied', 'error'])
+CopyResult.__doc__ = """
+The outcome of copying one backup to one backing store.
+
+``source`` and ``target`` are the backing stores, ``method`` is ``server``
+for a copy inside S3 or ``stream`` for one streamed through this machine,
+and ``error`` is the exception if the copy failed. A store that could not be
+listed gets a result with the ``list`` method, no ``filename`` and no
+``source``.
+"""
+
+
+def is_backup(filename):
+    """Whether a file under the prefix is a backup or record index, rather
+    than the catalog, the manifest or an unfinished upload."""
+    return BACKUP_MARKER in filename and not filename.endswith('.partial')
+
+
+def listing(backing_fs, prefix=''):
+    """The names of the backups under the prefix on one store."""
+    try:
+        names = backing_fs.listdir(prefix or '/')
+    except fs.errors.ResourceNotFound:
+        return set()
+    return {name for name in names if is_backup(name)}
+
+
+def server_side(source, target):
+    """Whether ``target`` can copy from ``source`` without downloading."""
+    shares_endpoint = getattr(target, 'shares_endpoint', None)
+    return shares_endpoint is not None and shares_endpoint(source)
+
+
+def plan(backing_store_fs, prefix=''):
+    """
+    Work out which backups each store is missing, and where to copy them from.
+    A store that can copy server-side from one of the stores holding a backup
+    copies from that one.
+
+    :param backing_store_fs: a list of pyfilesystem2 objects
+    :param optional prefix: the prefix the backups are stored under
+
+    :return: a tuple of (copies, failed). ``copies`` is a list of (filename,
+        source, target) tuples, by file name, and ``failed`` a list of
+        :class:`CopyResult` for stores that could not be listed.
+    """
+    names = {}
+    failed = []
+    for backing_fs in backing_store_fs:
+        try:
+            names[backing_fs] = listing(backing_fs, prefix)
+        except Exception as err:
+            failed.append(CopyResult('', None, backing_fs, LIST, 0, err))
+    stores = [backing_fs for backing_fs in backing_store_fs if backing_fs in names]
+    copies = []
+    for filename in sorted(set().union(*names.values())):
+        sources = [backing_fs for backing_fs in stores if filename in names[backing_fs]]
+        for target in stores:
+            if filename in names[target]:
+                continue
+            source = next((backing_fs for backing_fs in sources
+                           if server_side(backing_fs, target)), sources[0])
+            copies.append((filename, source, target))
+    return copies, failed
+
+
+def sync_backups(backing_store_fs, prefix='', *, max_workers=DEFAULT_WORKERS,
+                 retries=file_io.UPLOAD_RETRIES, retry_delay=file_io.RETRY_DELAY,
+                 dry_run=False):
+    """
+    Copy every backup missing from a store to it.
+
+    :param backing_store_fs: a pyfilesystem2 object or list of objects
+    :param optional prefix: the prefix the backups are stored under
+    :param keyword max_workers: the most copies to run at once
+    :param keyword retries: how many more times to try a copy that fails
+    :param keyword retry_delay: the base delay between tries in seconds
+    :param keyword dry_run: only work out what would be copied
+
+    :return: a list of :class:`CopyResult`, stores that could not be listed
+        first. A dry run reports every planned copy with no bytes copied.
+    """
+    if prefix and not prefix[-1] == '/':
+        prefix = prefix + '/'
+    if not isinstance(backing_store_fs, list):
+        backing_store_fs = [backing_store_fs]
+    copies, failed = plan(backing_store_fs, prefix)
+    if dry_run or not copies:
+        return failed + [CopyResult(filename, source, target,
+                                    SERVER if server_side(source, target) else STREAM, 0, None)
+                         for filename, source, target in copies]
+    with ThreadPoolExecutor(max_workers=max(min(int(max_workers), len(copies)), 1)) as executor:
+        results = list(executor.map(
+            lambda copy: copy_backup(copy[1], copy[2], copy[0], prefix, retries=retries,
+                                     retry_delay=retry_delay), copies))
+    return failed + results
+
+
+def copy_backup(source, target, filename, prefix='', *, retries=file_io.UPLOAD_RETRIES,
+                retry_delay=file_io.RETRY_DELAY):
+    """
+    Copy one backup between stores, inside S3 where possible and otherwise
+    streamed through a ``.partial`` file that is moved into place once its
+    size matches the source.
+
+    :return: a :class:`CopyResult`
+    """
+    path = prefix + filename
+    method = SERVER if server_side(source, target) else STREAM
+    copy = _server_copy if method == SERVER else _stream_copy
+    try:
+        if prefix:
+            target.makedirs(prefix, recreate=True)
+        size = file_io.with_retries(lambda: copy(source, target, path), retries, retry_delay)
+    except Exception as err:
+        return CopyResult(filename, source, target, method, 0, err)
+    return CopyResult(filename, source, target, method, size, None)
+
+
+def _server_copy(source, target, path):
+    return target.copy_from(source, path, path)
+
+
+def _stream_copy(source, target, path):
+    size = verify.metadata(source, path)[0]
+    partial = path + '.partial'
+    opener = getattr(source, 'open_stream', source.openbin)
+    try:
+        with opener(path) as infile:
+            target.upload(partial, infile)
+        copied = verify.metadata(target, partial)[0]
+        if copied != size:
+            raise fs.errors.OperationFailed(
+                path, msg=f"copied {copied} bytes of {size}")
+        target.move(partial, path, overwrite=True)
+    except Exception:
+        try:
+            target.remove(partial)
+        except Exception:
+            pass
+        file_io.discard_upload(target, partial)
+        raise
+    return size
+
+
+def report(results, dry_run=False):
+    """
+    Describe a sync for people.
+
+    :param results: the results from :func:`sync_backups`
+    :param optional dry_run: whether the copies were only planned
+
+    :return: list of lines, one per copy
+    """
+    lines = []
+    for result in results:
+        target = file_io.store_label(result.target)
+        if result.method == LIST:
+            lines.append(f"Could not list {target}: {result.error}")
+        elif result.error is not None:
+            lines.append(f"Could not copy {result.filename} to {target}: {result.error}")
+        elif dry_run:
+            lines.append(f"Would copy {result.filename} from "
+                         f"{file_io.store_label(result.source)} to {target} ({result.method})")
+        else:
+            lines.append(f"Copied {result.filename} from "
+                         f"{file_io.store_label(result.source)} to {target} "
+                         f"({result.method}, {result.bytes_copied} bytes)")
+    return lines or ["Every store holds every backup."]
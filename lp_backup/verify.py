@@ -0,0 +1,168 @@
+"""
+Check that every copy of every backup is intact.
+
+Each backup in the catalog is checked on every backing store against the size,
+sha256 and md5 recorded when it was made. Cheap metadata is used where it is
+enough: a copy whose size is wrong needs no download, and an S3 object
+uploaded in one part has the md5 of its contents as its ETag. Other copies are
+downloaded and hashed as they stream in, without holding them in memory.
+Copies are checked on a thread pool, so verifying hundreds of backups on
+several stores is bound by the stores, not by running the checks in turn.
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import hmac
+
+import fs
+
+from lp_backup import file_io
+from lp_backup import stream
+
+DEFAULT_WORKERS = 16
+
+OK = 'ok'
+MISSING = 'missing'
+CORRUPT = 'corrupt'
+ERROR = 'error'
+
+CheckResult = namedtuple('CheckResult', ['filename', 'store', 'status', 'method', 'detail'])
+CheckResult.__doc__ = """
+The outcome of checking one copy of one backup.
+
+``store`` is the backing store, ``status`` is ``ok``, ``missing``,
+``corrupt`` or ``error``, ``method`` says how it was checked (``size``,
+``etag``, ``sha256`` or ``plaintext``) and ``detail`` describes a problem.
+"""
+
+
+def verify_backups(backing_store_fs, entries, prefix='', *, quick=False,
+                   plaintext_hmac=None, max_workers=DEFAULT_WORKERS):
+    """
+    Check every copy of some backups.
+
+    :param backing_store_fs: the pyfilesystem2 objects to check
+    :param entries: catalog entries of the backups
+    :param optional prefix: the prefix the backups are stored under
+    :param keyword quick: trust a matching size when the store has no
+        checksum to compare, instead of downloading the copy
+    :param keyword plaintext_hmac: a callable taking a store and a catalog
+        entry and returning the keyed hash of that copy's plaintext. If given, copies
+        whose stored bytes check out are also decoded and compared with the
+        catalog's ``plaintext_hmac``.
+    :param keyword max_workers: the most copies to check at once
+
+    :return: a list of :class:`CheckResult`, by backup and then by store.
+        Copies that are absent from a store the catalog does not list them on
+        are left out.
+    """
+    if prefix and not prefix[-1] == '/':
+        prefix = prefix + '/'
+    pairs = [(entry, backing_fs) for entry in entries for backing_fs in backing_store_fs]
+    if not pairs:
+        return []
+    with ThreadPoolExecutor(max_workers=max(min(int(max_workers), len(pairs)), 1)) as executor:
+        results = list(executor.map(
+            lambda pair: check(pair[1], pair[0], prefix, quick=quick,
+                               plaintext_hmac=plaintext_hmac), pairs))
+    return [result for result in results if result is not None]
+
+
+def check(backing_fs, entry, prefix='', *, quick=False, plaintext_hmac=None):
+    """
+    Check one copy of a backup. See :func:`verify_backups`.
+
+    :return: a :class:`CheckResult`, or None if the copy is absent from a store
+        the catalog does not list it on
+    """
+
+    def result(status, method, detail=''):
+        return CheckResult(entry['filename'], backing_fs, status, method, detail)
+
+    path = prefix + entry['filename']
+    try:
+        size, etag = metadata(backing_fs, path)
+    except fs.errors.ResourceNotFound:
+        if not file_io.listed_on(entry.get('stores', []), backing_fs):
+            return None
+        return result(MISSING, 'size', "not found")
+    except Exception as err:
+        return result(ERROR, 'size', str(err))
+    if size != entry['size']:
+        return result(CORRUPT, 'size', f"{size} bytes, expected {entry['size']}")
+    try:
+        if etag and '-' not in etag and entry.get('md5'):
+            # an object uploaded in one part has its md5 as ETag
+            method = 'etag'
+            if etag != entry['md5']:
+                return result(CORRUPT, method, "ETag does not match the md5")
+        elif quick:
+            method = 'size'
+        else:
+            method = 'sha256'
+            if stream_sha256(backing_fs, path) != entry['checksum']:
+                return result(CORRUPT, method, "sha256 does not match")
+        if plaintext_hmac is not None and entry.get('plaintext_hmac'):
+            method = 'plaintext'
+            try:
+                digest = plaintext_hmac(backing_fs, entry)
+            except (OSError, fs.errors.FSError):
+                raise
+            except Exception as err:
+                # the copy was read but could not be decrypted or decompressed
+                return result(CORRUPT, method, f"cannot be decoded: {err!r}")
+            if not hmac.compare_digest(digest, entry['plaintext_hmac']):
+                return result(CORRUPT, method, "plaintext does not match")
+    except Exception as err:
+        return result(ERROR, method, str(err))
+    return result(OK, method)
+
+
+def metadata(backing_fs, path):
+    """
+    The size of a file and, on S3, its ETag, without downloading it. Other
+    stores report the size they list, such as WebDAV's ``getcontentlength``.
+
+    :return: a tuple of (size, ETag or None)
+    """
+    if hasattr(backing_fs, 'object_info'):
+        return backing_fs.object_info(path)
+    return backing_fs.getinfo(path, namespaces=['details']).size, None
+
+
+def stream_sha256(backing_fs, path):
+    """sha256 hex digest of a file, read a chunk at a time."""
+    digest = hashlib.sha256()
+    opener = getattr(backing_fs, 'open_stream', backing_fs.openbin)
+    with opener(path) as infile:
+        for chunk in stream.read_chunks(infile):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def report(results, backing_store_fs):
+    """
+    Describe the health of each store for people.
+
+    :param results: the results from :func:`verify_backups`
+    :param backing_store_fs: the stores that were checked
+
+    :return: list of lines, one per problem and one per store
+    """
+    lines = [f"{result.status.upper():8} {file_io.store_label(result.store)}  "
+             f"{result.filename}  {result.detail}"
+             for result in results if result.status != OK]
+    for backing_fs in backing_store_fs:
+        label = file_io.store_label(backing_fs)
+        counts = {status: 0 for status in (OK, MISSING, CORRUPT, ERROR)}
+        methods = {}
+        for result in results:
+            if result.store is backing_fs:
+                counts[result.status] += 1
+                methods[result.method] = methods.get(result.method, 0) + 1
+        health = "healthy" if counts[OK] == sum(counts.values()) else "DEGRADED"
+        checked = ', '.join(f"{count} by {method}" for method, count in sorted(methods.items()))
+        checked = checked or "nothing to check"
+        lines.append(f"{label}: {health}, {counts[OK]} ok, {counts[MISSING]} missing, "
+                     f"{counts[CORRUPT]} corrupt, {counts[ERROR]} errors ({checked})")
+    return lines
@@ -54,6 +54,7 @@ def mock_lzma():
     mock_lz = mock.MagicMock()
     mock_lz.compress = mock.MagicMock()
     # mock_lz.compress.return_value = b"some random data that we can look for later"
+    mock_lz.return_value = b"some random data that we can look for later"
     return mock_lz
 
 
@@ -73,6 +74,8 @@ def test_runner_two(tmp_config_file_two, monkeypatch):
 
 @pytest.fixture
 def test_runner_three(tmp_config_file_three, monkeypatch):
+    monkeypatch.setenv('DOKEY', 'testkeyid')
+    monkeypatch.setenv('DOSECRET', 'testsecretkey')
     new_runner = Runner(tmp_config_file_three)
     monkeypatch.setattr(new_runner, 'logged_in', True)
     return new_runner
@@ -80,6 +83,7 @@ def test_runner_three(tmp_config_file_three, monkeypatch):
 
 @pytest.fixture
 def test_runner_four(tmp_config_file_four, monkeypatch):
+    monkeypatch.setenv('WEBDAV_PASSWORD', 'testpassword')
     new_runner = Runner(tmp_config_file_four)
     monkeypatch.setattr(new_runner, 'logged_in', True)
     return new_runner
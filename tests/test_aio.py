@@ -0,0 +1,195 @@
+import asyncio
+import io
+import json
+import subprocess
+import threading
+
+from fs.memoryfs import MemoryFS
+import pytest
+
+from lp_backup import exceptions
+from lp_backup import metrics
+from lp_backup.aio import AsyncRunner
+from lp_backup.spool import Spool
+
+EXPORT = b"url,username,password\nsome,vault,data"
+
+
+class FakeProcess(object):
+    def __init__(self, stdout=b"", stderr=b"", returncode=0, delay=0):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.exit_code = returncode
+        self.delay = delay
+        self.returncode = None
+        self.killed = False
+
+    async def communicate(self):
+        await asyncio.sleep(self.delay)
+        self.returncode = self.exit_code
+        return self.stdout, self.stderr
+
+    def kill(self):
+        self.killed = True
+        self.returncode = -9
+
+    async def wait(self):
+        return self.returncode
+
+
+def fake_lpass(processes, calls):
+    async def create_subprocess_exec(*args, **kwargs):
+        calls.append(list(args))
+        return processes.pop(0)
+    return create_subprocess_exec
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+@pytest.fixture
+def async_runner(tmp_config_file_two):
+    runner = AsyncRunner(tmp_config_file_two)
+    store = MemoryFS()
+    runner.runner._configure_backing_store = lambda: [store]
+    yield runner
+    runner.close()
+
+
+def test_async_backup_and_restore(async_runner, monkeypatch, tmpdir):
+    calls = []
+    processes = [FakeProcess(b"Success: Logged in"), FakeProcess(EXPORT)]
+    monkeypatch.setattr(asyncio, 'create_subprocess_exec', fake_lpass(processes, calls))
+
+    async def backup_then_restore():
+        outfile = await async_runner.backup()
+        assert (await async_runner.latest())['filename'] == outfile
+        return await async_runner.restore(outfile, str(tmpdir.join("restored.csv")))
+
+    restored = run(backup_then_restore())
+    assert calls == [["lpass", "login", "johnsmith@example.com", "--trust"],
+                     ["lpass", "export"]]
+    with open(restored, 'rb') as restored_file:
+        assert restored_file.read() == EXPORT
+
+
+def test_async_backups_run_concurrently(tmp_config_file_one, tmp_config_file_two,
+                                        monkeypatch, mock_fernet):
+    calls = []
+    processes = [FakeProcess(EXPORT, delay=0.1), FakeProcess(EXPORT, delay=0.1)]
+    monkeypatch.setattr(asyncio, 'create_subprocess_exec', fake_lpass(processes, calls))
+    runners = [AsyncRunner(tmp_config_file_one), AsyncRunner(tmp_config_file_two)]
+    stores = [MemoryFS(), MemoryFS()]
+    for runner, store in zip(runners, stores):
+        runner.runner.logged_in = True
+        runner.runner._configure_backing_store = lambda store=store: [store]
+
+    async def both():
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        names = await asyncio.gather(*[runner.backup() for runner in runners])
+        return names, loop.time() - start
+
+    names, elapsed = run(both())
+    assert elapsed < 0.2
+    for prefix, name, store in zip(["backupfolder/", "hi/"], names, stores):
+        assert store.exists(prefix + name)
+
+
+def test_async_timeout_kills_lpass(async_runner, monkeypatch):
+    slow = FakeProcess(EXPORT, delay=10)
+    monkeypatch.setattr(asyncio, 'create_subprocess_exec', fake_lpass([slow], []))
+    async_runner.runner.logged_in = True
+    with pytest.raises(asyncio.TimeoutError):
+        run(async_runner.backup(timeout=0.05))
+    assert slow.killed
+
+
+class HangingExport(object):
+    """An lpass export that produces nothing until it is killed."""
+    def __init__(self, *args, **kwargs):
+        self.killed = threading.Event()
+        self.stdout = self
+        self.stderr = io.BytesIO()
+        HangingExport.started.append(self)
+
+    def read(self, size=-1):
+        self.killed.wait(5)
+        return b""
+
+    def close(self):
+        pass
+
+    def kill(self):
+        self.killed.set()
+
+    def poll(self):
+        return -9 if self.killed.is_set() else None
+
+    def wait(self):
+        return self.poll()
+
+
+def test_async_streaming_timeout_kills_lpass(async_runner, monkeypatch):
+    HangingExport.started = []
+    monkeypatch.setattr(subprocess, 'Popen', HangingExport)
+    async_runner.runner.logged_in = True
+    async_runner.config["Streaming"] = True
+    with pytest.raises(asyncio.TimeoutError):
+        run(async_runner.backup(timeout=0.1))
+    # the export running on the executor is stopped too, and nothing is stored
+    async_runner.executor.shutdown(wait=True)
+    assert HangingExport.started[0].killed.is_set()
+    store = async_runner.runner._configure_backing_store()[0]
+    assert not store.exists('hi') or store.listdir('hi') == []
+
+
+def test_async_failures(async_runner, monkeypatch):
+    processes = [FakeProcess(stderr=b"bad password"),
+                 FakeProcess(returncode=1), FakeProcess(b"Success: Logged in"),
+                 FakeProcess(stderr=b"Error: could not export")]
+    monkeypatch.setattr(asyncio, 'create_subprocess_exec', fake_lpass(processes, []))
+    with pytest.raises(exceptions.LoginFailed):
+        run(async_runner.login())
+    run(async_runner.ensure_login())
+    assert async_runner.runner.logged_in
+    with pytest.raises(exceptions.BackupFailed):
+        run(async_runner.backup())
+
+
+def test_async_backup_steps(async_runner, monkeypatch, tmp_path):
+    """Async backups check the options, drain the spool and record metrics
+    like Runner.backup."""
+    calls = []
+    monkeypatch.setattr(asyncio, 'create_subprocess_exec',
+                        fake_lpass([FakeProcess(EXPORT)], calls))
+    async_runner.runner.logged_in = True
+    async_runner.config["Chunk Size"] = "lots"
+    with pytest.raises(exceptions.ConfigurationError, match="Chunk Size"):
+        run(async_runner.backup())
+    assert calls == []
+    del async_runner.config["Chunk Size"]
+
+    store = async_runner.runner._configure_backing_store()[0]
+    async_runner.config["Spool Directory"] = str(tmp_path)
+    Spool(str(tmp_path)).add(store, 'hi/spooled-backup', b'spooled')
+    records = []
+    async_runner.runner.add_metrics_hook(records.append)
+    log = str(tmp_path / 'metrics.jsonl')
+    async_runner.runner.add_metrics_hook(metrics.JsonLines(log))
+    outfile = run(async_runner.backup())
+    assert store.readbytes('hi/spooled-backup') == b'spooled'
+    assert store.exists('hi/' + outfile)
+    stages = [record['stage'] for record in records]
+    assert stages[0] == 'drain'
+    assert 'export' in stages and 'upload' in stages
+    assert stages[-1] == 'total'
+    assert {record['operation'] for record in records} == {'backup'}
+    with open(log) as lines:
+        logged = [json.loads(line) for line in lines]
+    assert [record['bytes'] for record in logged if record['stage'] == 'export'] == [len(EXPORT)]
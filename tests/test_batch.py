@@ -0,0 +1,95 @@
+import subprocess
+import threading
+import time
+from unittest import mock
+
+from fs.memoryfs import MemoryFS
+
+from lp_backup import batch
+from lp_backup import catalog
+from lp_backup import exceptions
+from lp_backup import manifest
+from lp_backup.runner import Runner
+
+
+def test_backup_accounts_in_parallel():
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def backup(email):
+        def run():
+            with lock:
+                active.append(email)
+                peak.append(len(active))
+            time.sleep(0.05)
+            with lock:
+                active.remove(email)
+            if email == "b@example.com":
+                raise exceptions.BackupFailed("lpass broke")
+            if email == "d@example.com":
+                raise KeyError("Bucket")
+            return email + "-backup"
+        return run
+
+    runners = []
+    for email in ["a@example.com", "b@example.com", "c@example.com", "d@example.com"]:
+        runner = mock.MagicMock(config={"Email": email})
+        runner.backup.side_effect = backup(email)
+        runners.append(runner)
+    results = batch.backup_accounts(runners, max_workers=2)
+    assert max(peak) == 2
+    assert [result.email for result in results] == [runner.config["Email"] for runner in runners]
+    assert [result.success for result in results] == [True, False, True, False]
+    assert results[0].outfile == "a@example.com-backup"
+    assert isinstance(results[1].error, exceptions.BackupFailed)
+    assert isinstance(results[3].error, KeyError)
+    for runner in runners:
+        runner.ensure_login.assert_called_once_with()
+
+    lines = batch.summary(results, 0.1)
+    assert lines[0].startswith("OK      a@example.com")
+    assert lines[1].startswith("FAILED  b@example.com")
+    assert "lpass broke" in lines[1]
+    assert lines[-1].startswith("2 succeeded, 2 failed in 0.1s")
+    assert batch.backup_accounts([]) == []
+
+
+def test_accounts_share_catalog(test_runner_two, monkeypatch, tmpdir):
+    store = MemoryFS()
+    emails = [f"user{number}@example.com" for number in range(6)]
+    test_runner_two.config["LPASS Home"] = str(tmpdir)
+    test_runner_two.config["Skip Unchanged"] = True
+    test_runner_two.config["Accounts"] = [{"Email": email} for email in emails]
+    export = mock.MagicMock(stdout=b"url,username,password\nsome,vault,data", stderr=b"",
+                            returncode=0)
+    with monkeypatch.context() as m:
+        m.setattr(test_runner_two, '_configure_backing_store', lambda: [store])
+        m.setattr(subprocess, 'run', lambda *args, **kwargs: export)
+        results = batch.backup_accounts(test_runner_two.accounts(), max_workers=3)
+    assert all(result.success for result in results)
+    entries = catalog.load(store, 'hi')['backups']
+    assert sorted(entry['email'] for entry in entries) == emails
+    assert sorted(manifest.load(store, 'hi')['accounts']) == emails
+
+
+def test_separate_configs_share_catalog(tmp_config_file_two, monkeypatch):
+    """Runners built from different files still take turns with a shared store."""
+    store = MemoryFS()
+    emails = [f"user{number}@example.com" for number in range(6)]
+    runners = []
+    export = mock.MagicMock(stdout=b"url,username,password\nsome,vault,data", stderr=b"",
+                            returncode=0)
+    with monkeypatch.context() as m:
+        for email in emails:
+            runner = Runner(tmp_config_file_two)
+            runner.config["Email"] = email
+            runner.config["Skip Unchanged"] = True
+            m.setattr(runner, '_configure_backing_store', lambda: [store])
+            runners.append(runner)
+        m.setattr(subprocess, 'run', lambda *args, **kwargs: export)
+        results = batch.backup_accounts(runners, max_workers=6)
+    assert all(result.success for result in results)
+    entries = catalog.load(store, 'hi')['backups']
+    assert sorted(entry['email'] for entry in entries) == emails
+    assert sorted(manifest.load(store, 'hi')['accounts']) == emails
@@ -0,0 +1,23 @@
+import json
+import os
+import subprocess
+import sys
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'benchmarks')
+
+
+def test_benchmark_smoke(tmpdir):
+    output = str(tmpdir.join('results.json'))
+    subprocess.run([sys.executable, os.path.join(BENCHMARKS, 'run.py'), '--records', '50',
+                    '--repeat', '1', '--stores', 'memory,osfs', '--codecs', 'gzip',
+                    '--formats', 'container', '--encryption', 'on', '--output', output],
+                   stdout=subprocess.PIPE, check=True)
+    with open(output) as results_file:
+        report = json.load(results_file)
+    assert report['vault']['records'] == 50
+    assert [result['case'] for result in report['results']] == [
+        'memory/container/gzip/encrypted', 'osfs/container/gzip/encrypted']
+    for result in report['results']:
+        assert result['backup_seconds'] > 0
+        assert result['restore_peak_bytes'] > 0
+        assert result['ratio'] > 1
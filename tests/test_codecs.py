@@ -0,0 +1,58 @@
+import importlib.util
+
+import pytest
+
+from lp_backup import codecs, exceptions
+
+DATA = b"url,username,password\n" + b"https://example.com,user,hunter2\n" * 2000
+AVAILABLE = ["none", "lzma", "gzip", "bz2"]
+if importlib.util.find_spec("zstandard"):
+    AVAILABLE.append("zstd")
+
+
+@pytest.mark.parametrize("name", AVAILABLE)
+def test_round_trip(name):
+    codec = codecs.get(name)
+    assert codec.decompress(codec.compress(DATA)) == DATA
+    assert codec.decompress(codec.compress(DATA, 1)) == DATA
+    streamed = b''.join(codecs.compress_stream([DATA[:1000], DATA[1000:]], codec))
+    assert codec.decompress(streamed) == DATA
+    if name != "none":
+        assert len(codec.compress(DATA)) < len(DATA) / 4
+        assert codecs.detect("backup.csv", streamed) is codec
+        assert codecs.detect("backup.csv" + codec.suffix) is codec
+    assert codecs.by_id(codec.id) is codec
+
+
+@pytest.mark.parametrize("name", AVAILABLE)
+def test_blocks(name):
+    codec = codecs.get(name)
+    blocks = [DATA[i:i + 5000] for i in range(0, len(DATA), 5000)]
+    for workers in [1, 2]:
+        compressed = list(codecs.compress_blocks(blocks, codec, workers=workers))
+        assert len(compressed) == len(blocks)
+        # independent blocks decompress as one concatenated stream
+        assert codec.decompress(b''.join(compressed)) == DATA
+
+
+def test_from_config():
+    assert codecs.from_config(True).name == "lzma"
+    assert codecs.from_config("true").name == "lzma"
+    assert codecs.from_config(False).name == "none"
+    assert codecs.from_config(None).name == "none"
+    assert codecs.from_config("GZIP").name == "gzip"
+    with pytest.raises(exceptions.ConfigurationError):
+        codecs.from_config("rar")
+    with pytest.raises(exceptions.BackupFailed):
+        codecs.by_id(99)
+
+
+def test_detect_falls_back_to_none():
+    assert codecs.detect("backup.csv", "not bytes").name == "none"
+    assert codecs.detect("backup.csv.encrypted", b"gAAAAAB").name == "none"
+
+
+@pytest.mark.skipif("zstd" in AVAILABLE, reason="zstandard is installed")
+def test_missing_optional_codec():
+    with pytest.raises(exceptions.ConfigurationError):
+        codecs.get("zstd").compress(DATA)
@@ -0,0 +1,164 @@
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from lp_backup import codecs, config, exceptions
+from lp_backup.runner import Runner
+
+DATA = Path(os.path.dirname(__file__), 'testdata')
+
+BAD_CONFIG = """\
+Trust: yes please
+Encryption Key: null
+Compression: brotli
+Quorum: most
+Backing Store:
+  - URI: /tmp/backup
+  - Type: S3
+    Part Size: big
+  - Type: ftp
+Retention:
+  Daily: 7
+  Fortnightly: 2
+Schedule: every day
+"""
+
+
+def test_compile(test_runner_three):
+    settings = test_runner_three.settings
+    assert isinstance(settings, config.Config)
+    assert settings.email == "johnsmith@example.com"
+    assert settings.trust is False
+    assert isinstance(settings.encryption_key, bytes)
+    assert settings.compression == "none"
+    assert [store.get('Type') for store in settings.backing_stores] == ['S3', None]
+    assert settings.quorum == 'all'
+    assert settings.full_snapshot_every == 24
+    with pytest.raises(AttributeError):
+        settings.unknown = True
+    # shared between runners, so it can't be changed
+    with pytest.raises(AttributeError):
+        settings.trust = True
+    with pytest.raises(TypeError):
+        settings.backing_stores[0]["Bucket"] = "elsewhere"
+    # variables are read once, and stay as written in the file
+    assert settings.backing_stores[0]["Key ID"] == "testkeyid"
+    assert test_runner_three.config["Backing Store"][0]["Key ID"] == "$DOKEY"
+
+
+def test_compile_environment(tmp_config_file_three, monkeypatch):
+    config.clear_cache()
+    monkeypatch.delenv('DOKEY', raising=False)
+    monkeypatch.setenv('DOSECRET', 'secret')
+    with pytest.raises(exceptions.ConfigurationError,
+                       match=r"store 0 refers to unset environment variables \$DOKEY"):
+        Runner(tmp_config_file_three)
+    monkeypatch.setenv('DOKEY', 'first')
+    assert Runner(tmp_config_file_three).settings.backing_stores[0]["Key ID"] == "first"
+    # the cached configuration is compiled again when a variable changes
+    monkeypatch.setenv('DOKEY', 'second')
+    assert Runner(tmp_config_file_three).settings.backing_stores[0]["Key ID"] == "second"
+
+
+def test_compile_reports_every_problem(tmpdir):
+    path = tmpdir.join("bad.yml")
+    path.write(BAD_CONFIG)
+    with pytest.raises(exceptions.ConfigurationError) as err:
+        Runner(str(path))
+    message = str(err.value)
+    for problem in ["Email is required", "Trust must be true or false",
+                    "Compression", "Quorum must be a number",
+                    "store 1 Part Size must be a number",
+                    "Retention unknown periods Fortnightly",
+                    "Schedule must have 5 fields"]:
+        assert problem in message
+    # parts smaller than S3 allows are caught before logging in, too
+    path.write(BAD_CONFIG.replace("Part Size: big", "Part Size: 4"))
+    with pytest.raises(exceptions.ConfigurationError,
+                       match="store 1 Part Size must be at least 5"):
+        Runner(str(path))
+    # the unknown store type is found once the bad part size is fixed
+    path.write(BAD_CONFIG.replace("Part Size: big", "Bucket: backups"))
+    with pytest.raises(exceptions.ConfigurationError, match="store 2 has unknown Type"):
+        Runner(str(path))
+
+
+def test_compile_accounts():
+    raw = {"Encryption Key": None, "Backing Store": [{"URI": "/tmp/backup"}],
+           "Accounts": [{"Email": "one@example.com"},
+                        {"Email": "two@example.com", "Format": "zip"}]}
+    with pytest.raises(exceptions.ConfigurationError, match="account two@example.com: Format"):
+        config.compile(raw)
+    raw["Accounts"][1].pop("Format")
+    assert [account["Email"] for account in config.compile(raw).accounts] == [
+        "one@example.com", "two@example.com"]
+
+
+def test_load_is_cached(tmp_config_file_two, monkeypatch):
+    config.clear_cache()
+    first = Runner(tmp_config_file_two)
+    parse = config._parse
+    parsed = []
+    monkeypatch.setattr(config, '_parse', lambda configfile: parsed.append(1) or parse(configfile))
+
+    second = Runner(tmp_config_file_two)
+    assert parsed == []
+    assert second.settings is first.settings
+    second.config["Prefix"] = "changed"
+    assert second.settings.prefix == "changed"
+    assert first.settings.prefix == "hi"
+    assert Runner(tmp_config_file_two).config["Prefix"] == "hi"
+
+    with open(tmp_config_file_two, 'a') as configfile:
+        configfile.write("Upload Workers: 2\n")
+    stat = os.stat(tmp_config_file_two)
+    os.utime(tmp_config_file_two, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert Runner(tmp_config_file_two).settings.upload_workers == 2
+    assert parsed == [1]
+
+
+def test_relative_config_path(tmpdir, monkeypatch):
+    config.clear_cache()
+    tmpdir.mkdir("sub")
+    shutil.copy2(str(DATA / "testconfig.yml"), str(tmpdir.join("sub", "rel.yml")))
+    monkeypatch.chdir(tmpdir)
+    runner = Runner("sub/rel.yml")
+    assert runner.config_path == str(tmpdir.join("sub", "rel.yml"))
+    # the generated key is saved to the file that was read
+    assert "Encryption Key: generate" not in tmpdir.join("sub", "rel.yml").read()
+    assert Runner("sub/rel.yml").settings.encryption_key == runner.config["Encryption Key"]
+
+
+def test_backup_checks_config_before_login(test_runner_two, monkeypatch):
+    test_runner_two.logged_in = False
+    monkeypatch.setattr(subprocess, 'run', lambda *args, **kwargs: pytest.fail("ran lpass"))
+    test_runner_two.config["Chunk Size"] = "lots"
+    with pytest.raises(exceptions.ConfigurationError, match="Chunk Size must be a number"):
+        test_runner_two.backup()
+
+
+def test_compile_compression_level():
+    raw = {"Email": "a@example.com", "Encryption Key": None,
+           "Backing Store": [{"URI": "/tmp/backup"}], "Compression": "lzma",
+           "Compression Level": 99}
+    with pytest.raises(exceptions.ConfigurationError,
+                       match="Compression Level must be from 0 to 9 for lzma, not 99"):
+        config.compile(raw)
+    raw["Compression Level"] = 9
+    assert config.compile(raw).compression_level == 9
+    raw["Compression"] = "bz2"
+    raw["Compression Level"] = 0
+    with pytest.raises(exceptions.ConfigurationError, match="from 1 to 9 for bz2"):
+        config.compile(raw)
+
+
+def test_compile_missing_codec_package(monkeypatch):
+    monkeypatch.setattr(codecs.CODECS["zstd"], "module", "lp_backup_missing_zstandard")
+    raw = {"Email": "a@example.com", "Encryption Key": None,
+           "Backing Store": [{"URI": "/tmp/backup"}], "Compression": "zstd"}
+    with pytest.raises(exceptions.ConfigurationError,
+                       match="Compression The zstd codec needs the lp_backup_missing_zstandard package"):
+        config.compile(raw)
@@ -0,0 +1,123 @@
+import base64
+import io
+import lzma
+
+from cryptography.fernet import Fernet
+import pytest
+
+from lp_backup import container, exceptions
+
+
+@pytest.fixture
+def plaintext():
+    lines = [f"url{i},username{i},password{i}" for i in range(1, 2000)]
+    return '\n'.join(lines).encode('utf-8')
+
+
+@pytest.mark.parametrize("codec", ["none", "lzma", "gzip", "bz2"])
+def test_round_trip(plaintext, codec):
+    fernet = Fernet(Fernet.generate_key())
+    data = container.encode(plaintext, codec, fernet, frame_size=1000)
+    assert container.is_container(data)
+    assert container.read_header(data) == (container.VERSION, codec, 'fernet')
+    assert container.decode(data, fernet) == plaintext
+    chunks = list(container.decode_stream(io.BytesIO(data), fernet))
+    assert len(chunks) == len(range(0, len(plaintext), 1000))
+
+
+def test_compress_before_encrypt_is_smaller(plaintext):
+    fernet = Fernet(Fernet.generate_key())
+    data = container.encode(plaintext, 'lzma', fernet)
+    assert len(data) < len(plaintext) / 4
+    assert container.decode(data, fernet) == plaintext
+
+
+def test_unencrypted(plaintext):
+    data = container.encode(plaintext, 'lzma')
+    assert container.read_header(data)[2] == 'none'
+    assert container.decode(data) == plaintext
+
+
+def test_unencrypted_with_key(plaintext):
+    fernet = Fernet(Fernet.generate_key())
+    data = container.encode(plaintext, 'none', frame_size=1000)
+    with pytest.raises(exceptions.BackupFailed, match="not encrypted"):
+        container.decode(data, fernet)
+    head, frames = frames_of(data)
+    with pytest.raises(exceptions.BackupFailed, match="not encrypted"):
+        container.decode_frame(frames[0], head, 0, fernet)
+    assert container.decode(data, fernet, allow_unencrypted=True) == plaintext
+    assert container.decode_frame(frames[0], head, 0, fernet,
+                                  allow_unencrypted=True) == plaintext[:1000]
+
+    # flipping the cipher byte of an encrypted container is refused too
+    encrypted = bytearray(container.encode(plaintext, 'none', fernet))
+    encrypted[container.HEADER.size - 1] = container.CIPHERS['none']
+    with pytest.raises(exceptions.BackupFailed):
+        container.decode(bytes(encrypted), fernet)
+
+
+def test_errors(plaintext):
+    fernet = Fernet(Fernet.generate_key())
+    data = container.encode(plaintext, 'lzma', fernet)
+    assert not container.is_container(b"gAAAAAB")
+    with pytest.raises(exceptions.InvalidKey):
+        container.decode(data)
+    with pytest.raises(exceptions.BackupFailed):
+        container.decode(data[:-4], fernet)
+    with pytest.raises(exceptions.ConfigurationError):
+        container.header('rar')
+
+
+def frames_of(data):
+    """Split a container into its header and frames, length prefixes included."""
+    offset = container.header_size(container.read_header(data)[0])
+    head, frames = data[:offset], []
+    while True:
+        (length,) = container.FRAME_HEADER.unpack_from(data, offset)
+        if not length:
+            return head, frames
+        frames.append(data[offset:offset + container.FRAME_HEADER.size + length])
+        offset += container.FRAME_HEADER.size + length
+
+
+@pytest.mark.parametrize("encrypted", [True, False])
+def test_tampered_frames(encrypted):
+    fernet = Fernet(Fernet.generate_key()) if encrypted else None
+    data = container.encode(b'A' * 10 + b'B' * 10 + b'C' * 10, 'none', fernet, frame_size=10)
+    head, frames = frames_of(data)
+    end = container.FRAME_HEADER.pack(0)
+    for tampered in [[frames[2], frames[0]], [frames[0], frames[1]],
+                     [frames[0], frames[2], frames[1]], frames + [frames[2]]]:
+        with pytest.raises(exceptions.BackupFailed):
+            container.decode(head + b''.join(tampered) + end, fernet)
+    # a frame from another container made with the same key and settings
+    spliced = frames_of(container.encode(b'D' * 30, 'none', fernet, frame_size=10))[1]
+    with pytest.raises(exceptions.BackupFailed, match="another container"):
+        container.decode(head + spliced[0] + b''.join(frames[1:]) + end, fernet)
+    with pytest.raises(exceptions.BackupFailed):
+        container.decode_frame(frames[1], head, 0, fernet)
+    assert container.decode_frame(frames[1], head, 1, fernet) == b'B' * 10
+
+
+def test_empty_container():
+    fernet = Fernet(Fernet.generate_key())
+    data = container.encode(b'', 'lzma', fernet)
+    assert container.decode(data, fernet) == b''
+    head, frames = frames_of(data)
+    with pytest.raises(exceptions.BackupFailed, match="missing frames"):
+        container.decode(head + container.FRAME_HEADER.pack(0), fernet)
+
+
+def test_version_1(plaintext):
+    fernet = Fernet(Fernet.generate_key())
+    head = container.HEADER.pack(container.MAGIC, 1, 1, 1)
+    frames = [base64.urlsafe_b64decode(fernet.encrypt(lzma.compress(plaintext[i:i + 1000])))
+              for i in range(0, len(plaintext), 1000)]
+    data = head + b''.join(container.FRAME_HEADER.pack(len(frame)) + frame
+                           for frame in frames) + container.FRAME_HEADER.pack(0)
+    assert container.read_header(data) == (1, 'lzma', 'fernet')
+    assert container.decode(data, fernet) == plaintext
+    first = container.FRAME_HEADER.pack(len(frames[0])) + frames[0]
+    assert container.decode_frame(first, data[:container.MAX_HEADER_SIZE], 0,
+                                  fernet) == plaintext[:1000]
@@ -1,9 +1,16 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from unittest import mock
+
 import botocore
 import fs_s3fs
 
 from lp_backup import file_io, exceptions
 import pytest
 import fs
+import fs.tempfs
+from fs.memoryfs import MemoryFS
 
 
 @pytest.fixture
@@ -85,3 +92,258 @@ def test_read_backup(tmpdir_factory, test_backup_data, monkeypatch):
 
 
 
+
+
+def test_write_out_stream(tmpdir_factory, test_backup_data):
+    back_fs = [fs.open_fs(str(tmpdir_factory.mktemp(f"write_out_stream_{i}"))) for i in range(0, 2)]
+    chunks = [test_backup_data[i:i + 10] for i in range(0, len(test_backup_data), 10)]
+    file_io.write_out_stream(back_fs, iter(chunks), 'streamed-backup', prefix='hi')
+    for fs_ in back_fs:
+        assert fs_.listdir('hi') == ['streamed-backup']
+        assert fs_.readbytes('hi/streamed-backup') == test_backup_data
+
+    def failing_chunks():
+        yield test_backup_data
+        raise exceptions.BackupFailed("export failed")
+
+    with pytest.raises(exceptions.BackupFailed):
+        file_io.write_out_stream(back_fs, failing_chunks(), 'failed-backup', prefix='hi')
+    for fs_ in back_fs:
+        assert fs_.listdir('hi') == ['streamed-backup']
+        fs_.close()
+
+
+class SlowMemoryFS(MemoryFS):
+    def makedirs(self, *args, **kwargs):
+        time.sleep(0.3)
+        return super().makedirs(*args, **kwargs)
+
+
+def test_write_out_backup_concurrent(test_backup_data):
+    slow_fs = [SlowMemoryFS() for _ in range(0, 3)]
+    start = time.monotonic()
+    results = file_io.write_out_backup(slow_fs, test_backup_data, 'backup', prefix='hi')
+    assert time.monotonic() - start < 0.8
+    assert [result.store for result in results] == slow_fs
+    for result in results:
+        assert result.success
+        assert result.bytes_written == len(test_backup_data)
+        assert result.duration >= 0.3
+        assert result.store.readbytes('hi/backup') == test_backup_data
+
+    closed_fs = MemoryFS()
+    closed_fs.close()
+    with pytest.raises(exceptions.BackupFailed):
+        file_io.write_out_backup([MemoryFS(), closed_fs], test_backup_data, 'backup')
+    results = file_io.write_out_backup([MemoryFS(), closed_fs], test_backup_data, 'backup',
+                                       quorum=1, max_workers=1)
+    assert [result.success for result in results] == [True, False]
+    assert isinstance(results[1].error, fs.errors.FilesystemClosed)
+
+
+def test_no_local_staging(test_backup_data, monkeypatch):
+    def no_tempfs(*args, **kwargs):
+        raise AssertionError("backups should not be staged on local disk")
+
+    monkeypatch.setattr(fs.tempfs, 'TempFS', no_tempfs)
+    back_fs = [MemoryFS(), MemoryFS()]
+    file_io.write_out_backup(back_fs, test_backup_data, 'backup', prefix='hi')
+    assert file_io.read_backup(back_fs, 'backup', prefix='hi') == test_backup_data
+
+
+class SlowUploadFS(MemoryFS):
+    def upload(self, *args, **kwargs):
+        time.sleep(0.3)
+        return super().upload(*args, **kwargs)
+
+
+def test_write_out_stream_concurrent(test_backup_data):
+    slow_fs = [SlowUploadFS() for _ in range(0, 3)]
+    chunks = [test_backup_data[i:i + 10] for i in range(0, len(test_backup_data), 10)]
+    start = time.monotonic()
+    results = file_io.write_out_stream(slow_fs, iter(chunks), 'backup', prefix='hi')
+    assert time.monotonic() - start < 0.8
+    for result in results:
+        assert result.success
+        assert result.store.readbytes('hi/backup') == test_backup_data
+
+
+def test_concurrent_streams_share_stores(test_backup_data):
+    stores = [MemoryFS(), MemoryFS()]
+    chunks = [test_backup_data[i:i + 10] for i in range(0, len(test_backup_data), 10)]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(file_io.write_out_stream, stores, iter(chunks * 20),
+                                   name) for name in ['first', 'second']]
+        for future in futures:
+            future.result(timeout=10)
+    for store in stores:
+        assert store.readbytes('first') == store.readbytes('second') == test_backup_data * 20
+
+
+class HungMemoryFS(MemoryFS):
+    def __init__(self, release):
+        super().__init__()
+        self.release = release
+
+    def download(self, *args, **kwargs):
+        self.release.wait(5)
+        return super().download(*args, **kwargs)
+
+
+def test_read_backup_hedged(test_backup_data):
+    release = threading.Event()
+    hung_fs = HungMemoryFS(release)
+    good_fs = MemoryFS()
+    corrupt_fs = MemoryFS()
+    for fs_, data in [(hung_fs, test_backup_data), (good_fs, test_backup_data),
+                      (corrupt_fs, test_backup_data[:10])]:
+        fs_.makedir('hi')
+        fs_.writebytes('hi/backup', data)
+    try:
+        start = time.monotonic()
+        data = file_io.read_backup_hedged([hung_fs, good_fs], 'backup', 'hi', delay=0.1)
+        assert data == test_backup_data
+        assert time.monotonic() - start < 1
+
+        def verify(data):
+            return data == test_backup_data
+
+        data = file_io.read_backup_hedged([corrupt_fs, MemoryFS(), good_fs], 'backup', 'hi',
+                                          delay=5, verify=verify)
+        assert data == test_backup_data
+
+        with pytest.raises(exceptions.ConfigurationError):
+            file_io.read_backup_hedged([corrupt_fs, MemoryFS()], 'backup', 'hi', verify=verify)
+    finally:
+        release.set()
+
+
+def test_delete_backups():
+    stores = [MemoryFS(), MemoryFS()]
+    for store in stores:
+        store.makedir('hi')
+        for i in range(0, 5):
+            store.writebytes(f'hi/backup-{i}', b'data')
+    stores[1].remove('hi/backup-0')
+    results = file_io.delete_backups(stores, ['backup-0', 'backup-1', 'backup-2'], 'hi',
+                                     max_workers=2)
+    for store, result in zip(stores, results):
+        assert result.store is store
+        assert sorted(result.deleted) == ['backup-0', 'backup-1', 'backup-2']
+        assert result.errors == {}
+        assert sorted(store.listdir('hi')) == ['backup-3', 'backup-4']
+
+
+def test_delete_backups_s3_batches(monkeypatch):
+    s3_fs = fs_s3fs.S3FS('fake-bucket')
+    client = mock.MagicMock()
+    client.delete_objects.side_effect = [
+        {},
+        {'Errors': [{'Key': 'hi/backup-1001', 'Code': 'AccessDenied', 'Message': 'Denied'}]},
+    ]
+    monkeypatch.setattr(fs_s3fs.S3FS, 'client', client)
+    monkeypatch.setattr(file_io, 'S3_DELETE_BATCH', 1000)
+    names = [f'backup-{i}' for i in range(0, 1500)]
+    result, = file_io.delete_backups(s3_fs, names, 'hi')
+    assert client.delete_objects.call_count == 2
+    first_batch = client.delete_objects.call_args_list[0][1]
+    assert first_batch['Bucket'] == 'fake-bucket'
+    assert len(first_batch['Delete']['Objects']) == 1000
+    assert first_batch['Delete']['Objects'][0] == {'Key': 'hi/backup-0'}
+    assert len(result.deleted) == 1499
+    assert result.errors == {'backup-1001': 'Denied'}
+
+
+def test_read_ranges(test_backup_data):
+    missing, store = MemoryFS(), MemoryFS()
+    store.makedir('hi')
+    store.writebytes('hi/backup', test_backup_data)
+    ranges = [(0, 4), (4, 10), (100, 20)]
+    reader = mock.MagicMock(side_effect=lambda path, offset, length:
+                            test_backup_data[offset:offset + length])
+    store.read_range = reader
+    found = file_io.read_ranges([missing, store], 'backup', ranges, prefix='hi')
+    assert found == {offset: test_backup_data[offset:offset + length]
+                     for offset, length in ranges}
+    # neighbouring ranges are read together
+    assert reader.call_args_list == [mock.call('hi/backup', 0, 14),
+                                     mock.call('hi/backup', 100, 20)]
+    del store.read_range
+    assert file_io.read_ranges(store, 'backup', ranges, prefix='hi') == found
+    with pytest.raises(exceptions.BackupFailed):
+        file_io.read_ranges(store, 'backup', [(len(test_backup_data) - 2, 10)], prefix='hi')
+    with pytest.raises(exceptions.ConfigurationError):
+        file_io.read_ranges(missing, 'backup', ranges)
+
+
+class FlakyMemoryFS(MemoryFS):
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+        self.attempts = 0
+
+    def upload(self, *args, **kwargs):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise fs.errors.RemoteConnectionError(msg="throttled")
+        return super().upload(*args, **kwargs)
+
+
+def test_write_out_backup_retries(test_backup_data, tmp_path):
+    flaky_fs = FlakyMemoryFS(2)
+    results = file_io.write_out_backup([MemoryFS(), flaky_fs], test_backup_data, 'backup',
+                                       prefix='hi', retry_delay=0)
+    assert all(result.success for result in results)
+    assert flaky_fs.attempts == 3
+    assert flaky_fs.readbytes('hi/backup') == test_backup_data
+
+    down_fs = FlakyMemoryFS(100)
+    with pytest.raises(exceptions.BackupFailed):
+        file_io.write_out_backup([MemoryFS(), down_fs], test_backup_data, 'backup',
+                                 retries=1, retry_delay=0)
+    assert down_fs.attempts == 2
+
+    # errors that won't go away are not retried
+    closed_fs = FlakyMemoryFS(0)
+    closed_fs.close()
+    sleeps = []
+    with mock.patch.object(time, 'sleep', sleeps.append):
+        results = file_io.write_out_backup([MemoryFS(), closed_fs], test_backup_data,
+                                           'backup', quorum=1)
+    assert sleeps == []
+    assert not results[1].success
+
+    # copies spooled for a failed store count towards the quorum
+    from lp_backup.spool import Spool
+    spool = Spool(tmp_path / 'spool')
+    down_fs = FlakyMemoryFS(100)
+    results = file_io.write_out_backup([MemoryFS(), down_fs], test_backup_data, 'backup',
+                                       prefix='hi', retries=0, spool=spool)
+    assert [result.success for result in results] == [True, False]
+    assert [(entry['store'], entry['path']) for entry in spool.entries()] == [
+        (str(down_fs), 'hi/backup')]
+
+
+class BrokenWriterFS(MemoryFS):
+    def openbin(self, path, mode='r', *args, **kwargs):
+        writer = super().openbin(path, mode, *args, **kwargs)
+        if 'w' in mode:
+            def write(data):
+                raise fs.errors.RemoteConnectionError(msg="dropped")
+            writer.write = write
+        return writer
+
+
+def test_write_out_stream_isolation(test_backup_data):
+    good_fs = MemoryFS()
+    broken_fs = BrokenWriterFS()
+    chunks = [test_backup_data[i:i + 10] for i in range(0, len(test_backup_data), 10)]
+    results = file_io.write_out_stream([good_fs, broken_fs], iter(chunks), 'backup',
+                                       prefix='hi', quorum=1)
+    assert [result.success for result in results] == [True, False]
+    assert results[0].bytes_written == len(test_backup_data)
+    assert good_fs.readbytes('hi/backup') == test_backup_data
+    assert broken_fs.listdir('hi') == []
+
+    with pytest.raises(exceptions.BackupFailed):
+        file_io.write_out_stream([MemoryFS(), BrokenWriterFS()], iter(chunks), 'backup')
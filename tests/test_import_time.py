@@ -0,0 +1,43 @@
+import subprocess
+import sys
+
+# Generous enough for a small ARM box; the heavy backends alone blow it.
+IMPORT_BUDGET = 1.0
+HEAVY_MODULES = ['boto3', 'botocore', 'fs_s3fs', 'cryptography', 'ruamel.yaml',
+                 'webdavfs']
+
+
+def run_python(code):
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+
+
+def imported_modules(importtime_output):
+    """Map each module in ``-X importtime`` output to its cumulative seconds."""
+    modules = {}
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(cumulative) / 1e6
+    return modules
+
+
+def test_cli_import_is_light():
+    modules = imported_modules(run_python("import lp_backup.interface").stderr)
+    for heavy in HEAVY_MODULES:
+        assert heavy not in modules
+    assert modules['lp_backup.interface'] < IMPORT_BUDGET
+
+
+def test_local_store_does_not_import_backends(tmp_config_file_two):
+    result = run_python(
+        "import sys\n"
+        "from lp_backup.runner import Runner\n"
+        f"runner = Runner({str(tmp_config_file_two)!r})\n"
+        "runner._configure_backing_store()\n"
+        "print(' '.join(sorted(sys.modules)))\n")
+    loaded = result.stdout.split()
+    for heavy in ['boto3', 'botocore', 'fs_s3fs', 'webdavfs']:
+        assert heavy not in loaded
@@ -0,0 +1,85 @@
+from cryptography.fernet import Fernet
+import pytest
+
+from lp_backup import container, exceptions, index
+
+KEY = b'k' * 32
+FIELDNAMES = ['url', 'username', 'password', 'extra', 'name', 'grouping']
+
+
+@pytest.fixture
+def export():
+    lines = [','.join(FIELDNAMES)]
+    for i in range(200):
+        folder = ['Email', 'Email\\Work', 'Banking', 'Emails'][i % 4]
+        notes = '"line one\nline two, with a comma"' if i % 7 == 0 else ''
+        lines.append(f"https://site{i}.example.com,user{i},pass{i},{notes},site{i},{folder}")
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def test_split_keeps_records_whole(export):
+    builder = index.Builder(KEY, 500)
+    chunks = [export[i:i + 333] for i in range(0, len(export), 333)]
+    frames = list(builder.split(chunks))
+    assert b''.join(frames) == export
+    assert len(frames) > 1
+    assert all(len(frame) <= 500 for frame in frames)
+    assert builder.fieldnames == FIELDNAMES
+    assert len(builder.entries) == 200
+    for number, frame in enumerate(frames):
+        rows = [row for _, row in index.records([frame])]
+        if number == 0:
+            assert rows.pop(0) == FIELDNAMES
+        names = [entry['name'] for entry in builder.entries if entry['frame'] == number]
+        assert [row[4] for row in rows] == names
+
+
+def test_track_frame_offsets(export):
+    fernet = Fernet(Fernet.generate_key())
+    builder = index.Builder(KEY, 1000)
+    data = b''.join(builder.track(container.encode_frames(builder.split([export]),
+                                                          'gzip', fernet)))
+    assert container.decode(data, fernet) == export
+    head = data[:container.MAX_HEADER_SIZE]
+    plaintext = b''.join(container.decode_frame(data[offset:offset + length], head, number,
+                                                fernet)
+                         for number, (offset, length) in enumerate(builder.frames))
+    assert plaintext == export
+    document = index.load(builder.dump('backup.csv.lpbk'))
+    assert document['backup'] == 'backup.csv.lpbk'
+    assert document['header'] == ','.join(FIELDNAMES) + '\n'
+    assert len(document['frames']) == max(entry['frame'] for entry in document['entries']) + 1
+
+
+def test_entry_filter():
+    fieldnames = ['url', 'name', 'grouping']
+    entry_filter = index.EntryFilter(KEY, entries=['bank', 'https://mail.example.com'],
+                                     folders=['Email\\'])
+
+    def matches(row):
+        return entry_filter.matches(index.entry_of(fieldnames, row, KEY))
+
+    assert matches(['https://a.example.com', 'bank', ''])
+    assert matches(['https://mail.example.com', 'webmail', ''])
+    assert matches(['', 'x', 'Email'])
+    assert matches(['', 'x', 'Email\\Work'])
+    assert not matches(['', 'x', 'Emails'])
+    assert not matches(['https://a.example.com', 'banking', 'Bank'])
+    assert not index.EntryFilter(KEY)
+
+
+def test_matching_records(export):
+    entry_filter = index.EntryFilter(KEY, entries=['site7'], folders=['Banking'])
+    restored = b''.join(index.matching_records([export], entry_filter))
+    rows = [row for _, row in index.records([restored])]
+    assert rows[0] == FIELDNAMES
+    assert rows[1] == ['https://site2.example.com', 'user2', 'pass2', '', 'site2', 'Banking']
+    assert ['https://site7.example.com', 'user7', 'pass7', 'line one\nline two, with a comma',
+            'site7', 'Emails'] in rows
+    assert len(rows) == 1 + 50 + 1
+
+
+def test_invalid_index():
+    with pytest.raises(exceptions.BackupFailed):
+        index.load(b'not json')
+    assert index.is_index(index.index_name('backup.csv.lpbk'))
@@ -0,0 +1,181 @@
+import subprocess
+from unittest import mock
+
+from click.testing import CliRunner
+from cryptography.fernet import Fernet
+from freezegun import freeze_time
+import pytest
+
+from lp_backup import config
+from lp_backup import interface
+from lp_backup.schedule import Daemon
+
+EXPORT = b"url,username,password,extra,name,grouping,fav\nhttps://example.com,user,hunter2,,Example,,0\n"
+
+CONFIG = """\
+Email: johnsmith@example.com
+Encryption Key: {key}
+Prefix: backups
+LPASS Home: {home}
+Backing Store:
+  - URI: {stores}/first
+  - URI: {stores}/second
+"""
+
+
+def fake_lpass(args, **kwargs):
+    """Stand in for lpass; exports fail for accounts with bad in their email."""
+    if args[1] == "login":
+        return mock.MagicMock(stdout=b"Success: Logged in", stderr=b"", returncode=0)
+    if args[1] == "status":
+        return mock.MagicMock(stdout=b"", stderr=b"", returncode=0)
+    if "bad@" in kwargs.get("env", {}).get("LPASS_HOME", ""):
+        return mock.MagicMock(stdout=b"", stderr=b"Error: Could not export", returncode=1)
+    return mock.MagicMock(stdout=EXPORT, stderr=b"", returncode=0)
+
+
+@pytest.fixture
+def config_path(tmpdir, monkeypatch):
+    config.clear_cache()
+    monkeypatch.setattr(subprocess, 'run', fake_lpass)
+    path = tmpdir.join("lp_backup.yml")
+    path.write(CONFIG.format(key=Fernet.generate_key().decode(), home=tmpdir.join("lpass"),
+                             stores=tmpdir))
+    return path
+
+
+def invoke(config_path, *args):
+    return CliRunner().invoke(interface.cli, ["-c", str(config_path)] + list(args))
+
+
+def backup(config_path):
+    result = invoke(config_path, "backup")
+    assert result.exit_code == 0, result.output
+    return result.output.split()[-1]
+
+
+@pytest.mark.parametrize("command", [
+    ["backup"], ["restore", "--latest", "-o", "-"], ["verify"], ["sync"], ["prune"],
+    ["rotate-key"], ["daemon"], ["backup-all"]])
+def test_bad_config_is_reported(tmpdir, command):
+    path = tmpdir.join("broken.yml")
+    path.write("Email: johnsmith@example.com\nChunk Size: lots\n")
+    result = invoke(path, *command)
+    assert result.exit_code == 1
+    assert "Error: Invalid options in" in result.output
+    assert "Chunk Size must be a number" in result.output
+    assert "Traceback" not in result.output
+
+
+def test_restore_to_stdout(config_path):
+    backup(config_path)
+    result = invoke(config_path, "restore", "--latest", "-o", "-")
+    assert result.exit_code == 0, result.output
+    assert result.stdout_bytes == EXPORT
+
+    # neither a backup file nor --latest
+    result = invoke(config_path, "restore", "-o", "-", "--entry", "Example")
+    assert result.exit_code == 2
+    assert "Specify a backup file or --latest." in result.output
+    result = invoke(config_path, "restore", "missing-backup.csv", "-o", "-")
+    assert result.exit_code == 1
+    assert "Error: Specified file could not be found" in result.output
+
+
+def test_verify(config_path, tmpdir):
+    backup_file = backup(config_path)
+    result = invoke(config_path, "verify")
+    assert result.exit_code == 0, result.output
+    assert result.output.count("healthy, 1 ok") == 2
+
+    tmpdir.join("second", "backups", backup_file).write_binary(b"corrupted")
+    result = invoke(config_path, "verify")
+    assert result.exit_code == 1
+    assert "CORRUPT" in result.output and backup_file in result.output
+    assert "DEGRADED" in result.output
+
+
+def test_sync(config_path, tmpdir):
+    backup_file = backup(config_path)
+    tmpdir.join("second", "backups", backup_file).remove()
+    result = invoke(config_path, "sync", "--dry-run")
+    assert result.exit_code == 0, result.output
+    assert f"Would copy {backup_file}" in result.output
+    result = invoke(config_path, "sync")
+    assert result.exit_code == 0, result.output
+    assert f"Copied {backup_file}" in result.output
+    assert tmpdir.join("second", "backups", backup_file).exists()
+    assert invoke(config_path, "sync").output.strip() == "Every store holds every backup."
+
+
+def test_prune(config_path):
+    result = invoke(config_path, "prune")
+    assert result.exit_code == 1
+    assert "Error:" in result.output and "No Retention policy is configured." in result.output
+
+    with open(config_path, 'a') as configfile:
+        configfile.write("Date: true\nRetention:\n  Daily: 1\n")
+    with freeze_time("2000-01-01"):
+        first = backup(config_path)
+    with freeze_time("2000-01-02"):
+        second = backup(config_path)
+    result = invoke(config_path, "prune", "--dry-run")
+    assert result.exit_code == 0, result.output
+    assert f"Would delete {first}" in result.output
+    result = invoke(config_path, "prune")
+    assert result.exit_code == 0, result.output
+    assert f"Deleted {first}" in result.output
+    assert "Keeping 1 backups." in result.output
+    assert invoke(config_path, "list").output.split()[-1] == second
+
+
+def test_rotate_key(config_path, tmpdir):
+    backup(config_path)
+    result = invoke(config_path, "rotate-key")
+    assert result.exit_code == 0, result.output
+    assert "Rotated 0 of 0 backups." in result.output
+    result = invoke(config_path, "rotate-key", "--new-key")
+    assert result.exit_code == 0, result.output
+    assert "Generated a new Encryption Key" in result.output
+    assert "Rotated 1 of 1 backups." in result.output
+    assert "Previous Encryption Keys" in config_path.read()
+
+    unencrypted = tmpdir.join("unencrypted.yml")
+    unencrypted.write(CONFIG.format(key="null", home=tmpdir.join("lpass"), stores=tmpdir))
+    result = invoke(unencrypted, "rotate-key")
+    assert result.exit_code == 1
+    assert "Error:" in result.output and "No Encryption Key is configured" in result.output
+
+
+def test_daemon(config_path, monkeypatch):
+    daemons = []
+    monkeypatch.setattr(Daemon, 'install_signal_handlers', lambda self: None)
+    monkeypatch.setattr(Daemon, 'run', lambda self: daemons.append(self))
+    result = invoke(config_path, "daemon", "--now", "--schedule", "0 3 * * *",
+                    "--jitter", "5")
+    assert result.exit_code == 0, result.output
+    assert "Backing up on schedule 0 3 * * *." in result.output
+    assert "New backup is" in result.output
+    assert daemons[0].runs == 1 and daemons[0].jitter == 5
+
+    result = invoke(config_path, "daemon", "--schedule", "every day")
+    assert result.exit_code == 1
+    assert "Error:" in result.output and "Schedule must have 5 fields" in result.output
+    assert len(daemons) == 1
+
+
+def test_backup_all(config_path):
+    with open(config_path, 'a') as configfile:
+        configfile.write("Accounts:\n  - Email: one@example.com\n  - Email: two@example.com\n")
+    result = invoke(config_path, "backup-all", "-w", "2")
+    assert result.exit_code == 0, result.output
+    assert "OK      one@example.com" in result.output
+    assert "2 succeeded, 0 failed" in result.output
+
+    with open(config_path, 'a') as configfile:
+        configfile.write("  - Email: bad@example.com\n")
+    result = invoke(config_path, "backup-all")
+    assert result.exit_code == 1
+    assert "FAILED  bad@example.com" in result.output
+    assert "Could not export" in result.output
+    assert "2 succeeded, 1 failed" in result.output
@@ -0,0 +1,72 @@
+import io
+import json
+
+import pytest
+
+from lp_backup import metrics
+
+
+def test_disabled_recorder_does_nothing():
+    recorder = metrics.Recorder()
+    assert not recorder.enabled
+    assert recorder.stage("export") is metrics.NULL_STAGE
+    assert recorder.operation("backup") is metrics.NULL_STAGE
+    with recorder.operation("backup"), recorder.stage("export") as stage:
+        stage["bytes"] = 10
+    recorder.record("store_upload", 1.0)
+
+
+def test_records():
+    records = []
+    recorder = metrics.Recorder([records.append], {'email': 'a@example.com'})
+    with recorder.operation("backup"):
+        with recorder.stage("export") as stage:
+            stage["bytes"] = 10
+        recorder.record("store_upload", 0.5, store="mem://", bytes=20)
+    with pytest.raises(ValueError):
+        with recorder.operation("restore"), recorder.stage("download"):
+            raise ValueError()
+    assert [(record['operation'], record['stage']) for record in records] == [
+        ('backup', 'export'), ('backup', 'store_upload'), ('backup', 'total'),
+        ('restore', 'download'), ('restore', 'total')]
+    assert records[0]['bytes'] == 10
+    assert records[0]['email'] == 'a@example.com'
+    assert records[1]['store'] == "mem://"
+    assert records[2]['success'] is True
+    assert records[3]['error'] == 'ValueError'
+    assert records[4]['success'] is False
+    assert all(record['seconds'] >= 0 for record in records)
+
+    child_records = recorder.child(email='b@example.com')
+    with child_records.stage("login"):
+        pass
+    assert records[-1]['email'] == 'b@example.com'
+    assert records[-1]['operation'] is None
+
+
+def test_json_lines(tmpdir):
+    stream = io.StringIO()
+    path = str(tmpdir.join('metrics.jsonl'))
+    recorder = metrics.Recorder([metrics.JsonLines(stream), metrics.JsonLines(path)])
+    with recorder.operation("backup"):
+        pass
+    assert json.loads(stream.getvalue())['stage'] == 'total'
+    with open(path) as log:
+        assert json.loads(log.readline())['operation'] == 'backup'
+
+
+def test_prometheus_textfile(tmpdir):
+    path = str(tmpdir.join('lp_backup.prom'))
+    recorder = metrics.from_config({'Textfile': path}, email='a@example.com')
+    with recorder.operation("backup"):
+        with recorder.stage("export") as stage:
+            stage["bytes"] = 10
+        recorder.record("store_upload", 0.5, store='quote"d', bytes=20)
+    with open(path) as textfile:
+        text = textfile.read()
+    assert '# TYPE lp_backup_stage_seconds gauge' in text
+    assert 'lp_backup_stage_bytes{email="a@example.com",operation="backup",stage="export"} 10' in text
+    assert 'store="quote\\"d"' in text
+    assert 'lp_backup_success{email="a@example.com",operation="backup"} 1' in text
+    assert 'lp_backup_last_success_timestamp_seconds{' in text
+    assert not tmpdir.join('lp_backup.prom.partial').exists()
@@ -0,0 +1,47 @@
+import datetime
+
+from lp_backup import retention
+
+
+def make_entries(start, count, step, **extra):
+    return [dict({'filename': f"backup-{i}",
+                  'timestamp': (start + step * i).timestamp(), 'depends': []}, **extra)
+            for i in range(0, count)]
+
+
+def test_parse_policy():
+    assert retention.parse_policy({'Daily': 7, 'Monthly': '3'}) == {
+        'Hourly': 0, 'Daily': 7, 'Weekly': 0, 'Monthly': 3, 'Yearly': 0}
+    assert retention.parse_policy(None)['Daily'] == 0
+
+
+def test_select_keep():
+    # one backup an hour for 10 days
+    entries = make_entries(datetime.datetime(2000, 1, 1), 240, datetime.timedelta(hours=1))
+    keep = retention.select_keep(entries, {'Hourly': 6, 'Daily': 3})
+    # the last six hours, plus the last backup of the two days before today
+    assert keep == {f"backup-{i}" for i in [239, 238, 237, 236, 235, 234, 215, 191]}
+    keep = retention.select_keep(entries, {'Weekly': 2})
+    assert keep == {"backup-239", "backup-215"}
+    assert retention.select_keep(entries, {}) == {"backup-239"}
+    assert retention.select_keep([], {'Daily': 1}) == set()
+
+
+def test_plan_keeps_dependencies_and_protected():
+    entries = make_entries(datetime.datetime(2000, 1, 1), 5, datetime.timedelta(days=1))
+    entries[4]['depends'] = ['backup-2', 'backup-3']
+    keep, delete = retention.plan(entries, {'Daily': 1}, protected=['backup-0', 'gone'])
+    assert [entry['filename'] for entry in keep] == ['backup-0', 'backup-2', 'backup-3',
+                                                     'backup-4']
+    assert [entry['filename'] for entry in delete] == ['backup-1']
+
+
+def test_entries_from_names():
+    names = ["2000-01-01T10:00:00.123456-me@example.com-lastpass-backup.csv.xz",
+             "2000-01-02T10:00:00-me@example.com-lastpass-delta.json.xz",
+             "me@example.com-lastpass-backup.csv.xz",
+             "2000-01-01T10:00:00-other@example.com-lastpass-backup.csv.xz",
+             "lp_backup-catalog.json"]
+    entries = retention.entries_from_names(names, "me@example.com")
+    assert [entry['filename'] for entry in entries] == names[:2]
+    assert entries[1]['timestamp'] == datetime.datetime(2000, 1, 2, 10).timestamp()
@@ -0,0 +1,228 @@
+import io
+import subprocess
+from unittest import mock
+
+import pytest
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from fs.memoryfs import MemoryFS
+
+from lp_backup import exceptions, incremental, index, rotation, verify
+
+EXPORT = ("url,username,password,name,grouping\n" + "".join(
+    f"https://site{i}.example.com,user{i},pass{i},site{i},Folder{i % 3}\n"
+    for i in range(300))).encode('utf-8')
+
+
+class Export(object):
+    """Stand-in for the ``lpass export`` Popen object."""
+    def __init__(self, *args, **kwargs):
+        self.stdout = io.BytesIO(EXPORT)
+        self.stderr = io.BytesIO(b"")
+
+    def poll(self):
+        return 0
+
+    def wait(self):
+        return 0
+
+
+@pytest.fixture
+def two_stores(test_runner_one, monkeypatch):
+    stores = [MemoryFS(), MemoryFS()]
+    monkeypatch.setattr(test_runner_one, '_configure_backing_store', lambda: stores)
+    monkeypatch.setattr(subprocess, 'run', lambda *args, **kwargs: mock.MagicMock(
+        stdout=EXPORT, stderr=b""))
+    monkeypatch.setattr(subprocess, 'Popen', Export)
+    test_runner_one.config.update({"Chunk Size": 1000, "Retry Delay": 0})
+    return test_runner_one, stores
+
+
+def restored(runner, filename):
+    output = io.BytesIO()
+    runner.restore_stream(filename, output)
+    return output.getvalue()
+
+
+def test_key_ring(test_runner_one):
+    old_key = test_runner_one.config["Encryption Key"]
+    assert isinstance(test_runner_one.fernet, Fernet)
+    token = test_runner_one.fernet.encrypt(b"secret")
+    new_key = test_runner_one.new_key()
+    assert test_runner_one.config["Encryption Key"] == new_key
+    assert test_runner_one.config["Previous Encryption Keys"] == [old_key]
+    assert isinstance(test_runner_one.fernet, MultiFernet)
+    assert test_runner_one.fernet.decrypt(token) == b"secret"
+    assert Fernet(new_key).decrypt(test_runner_one.fernet.encrypt(b"new")) == b"new"
+    assert rotation.key_id(new_key) != rotation.key_id(old_key)
+    assert rotation.key_id(new_key) == rotation.key_id(new_key.encode('ascii'))
+
+
+@pytest.mark.parametrize('settings', [
+    {"Format": "container", "Record Index": True},
+    {"Format": "container", "Record Index": True, "Streaming": True},
+    {},
+    {"Streaming": True},
+])
+def test_rotate_key(two_stores, settings):
+    runner, stores = two_stores
+    runner.config.update(settings)
+    runner.config["Date"] = True
+    backups = [runner.backup(), runner.backup()]
+    old_key = runner.config["Encryption Key"]
+    old_sizes = [entry['size'] for entry in runner.list_backups()]
+
+    new_key = runner.new_key()
+    # old backups restore through the key ring before they are rotated
+    assert restored(runner, backups[0]) == EXPORT
+    newer = runner.backup()
+    assert runner.latest()['key_id'] == rotation.key_id(new_key)
+
+    results = runner.rotate_key(max_workers=2)
+    assert [(result.filename, result.success) for result in results] == [
+        (backup, True) for backup in backups]
+    entries = runner.list_backups()
+    assert all(entry['key_id'] == rotation.key_id(new_key) for entry in entries)
+    if settings.get("Format") == "container":
+        # frames are rotated without recompressing them
+        assert [entry['size'] for entry in entries[:2]] == old_sizes
+
+    # the old key is no longer needed
+    runner.config["Previous Encryption Keys"] = []
+    runner.configure_encryption()
+    for backup in backups + [newer]:
+        assert restored(runner, backup) == EXPORT
+        for backing_fs in stores:
+            with pytest.raises(InvalidToken):
+                list(rotation.rotate(backup, [backing_fs.readbytes('backupfolder/' + backup)],
+                                     Fernet(old_key)))
+    assert all(result.status == verify.OK for result in runner.verify(plaintext=True))
+    if settings.get("Record Index"):
+        output = io.BytesIO()
+        runner.restore_entries(backups[0], output, entries=['https://site7.example.com'])
+        rows = [row for _, row in index.records([output.getvalue()])]
+        assert rows[1:] == [['https://site7.example.com', 'user7', 'pass7', 'site7', 'Folder1']]
+
+    assert runner.rotate_key() == []
+
+
+def test_rotate_key_resumes(two_stores, monkeypatch):
+    runner, stores = two_stores
+    runner.config.update({"Format": "container", "Date": True, "Skip Unchanged": True})
+    backups = [runner.backup()]
+    runner.config["Skip Unchanged"] = False
+    backups += [runner.backup(), runner.backup()]
+    assert runner._load_manifest()['accounts']['johnsmith@example.com'].get('fingerprint')
+    runner.new_key()
+
+    rotate_backup = runner._rotate_backup
+
+    def interrupted(entry):
+        if entry['filename'] == backups[1]:
+            raise exceptions.BackupFailed("connection lost")
+        return rotate_backup(entry)
+
+    monkeypatch.setattr(runner, '_rotate_backup', interrupted)
+    results = runner.rotate_key()
+    assert [result.success for result in results] == [True, False, True]
+    assert isinstance(results[1].error, exceptions.BackupFailed)
+    current = rotation.key_id(runner.config["Encryption Key"])
+    assert [entry['key_id'] == current for entry in runner.list_backups()] == [True, False, True]
+    # fingerprints keyed with the old key are forgotten
+    assert 'fingerprint' not in runner._load_manifest()['accounts']['johnsmith@example.com']
+
+    monkeypatch.setattr(runner, '_rotate_backup', rotate_backup)
+    results = runner.rotate_key()
+    assert [(result.filename, result.success) for result in results] == [(backups[1], True)]
+    assert all(entry['key_id'] == current for entry in runner.list_backups())
+
+
+def test_rotate_unencrypted(test_runner_two):
+    with pytest.raises(exceptions.ConfigurationError):
+        test_runner_two.rotate_key()
+    with pytest.raises(exceptions.BackupFailed):
+        list(rotation.rotate('backup.csv', [b'data'], Fernet(Fernet.generate_key())))
+
+
+@pytest.mark.parametrize('settings', [{}, {"Format": "container"}])
+def test_deltas_survive_new_key(two_stores, monkeypatch, settings):
+    runner, stores = two_stores
+    runner.config.update(settings)
+    runner.config.update({"Date": True, "Incremental": True})
+    header = "url,username,password,name,grouping\n"
+    exports = [header + "a.com,alice,pw1,A,Work\nb.com,bob,pw2,B,Home\n",
+               header + "a.com,alice,pw1,A,Work\n"]
+    export = mock.MagicMock(stderr=b"")
+    monkeypatch.setattr(subprocess, 'run', lambda *args, **kwargs: export)
+    backups = []
+    for data in exports:
+        export.stdout = data.encode('utf-8')
+        backups.append(runner.backup())
+    assert "-lastpass-delta.json" in backups[1]
+
+    old_key = runner.config["Encryption Key"]
+    runner.new_key()
+    # the removed record stays removed with the old key in the ring
+    assert restored(runner, backups[1]) == exports[1].encode('utf-8')
+    assert all(result.status == verify.OK for result in runner.verify(plaintext=True))
+    # hashes keyed with the old key are not diffed against, a new chain starts
+    export.stdout = (exports[1] + "c.com,carol,pw3,C,Home\n").encode('utf-8')
+    newer = runner.backup()
+    assert "-lastpass-backup.csv" in newer
+
+    assert all(result.success for result in runner.rotate_key())
+    runner.config["Previous Encryption Keys"] = []
+    runner.configure_encryption()
+    assert restored(runner, backups[1]) == exports[1].encode('utf-8')
+    assert all(result.status == verify.OK for result in runner.verify(plaintext=True))
+    for backing_fs in stores:
+        with pytest.raises(InvalidToken):
+            list(rotation.rotate(backups[1], [backing_fs.readbytes('backupfolder/' + backups[1])],
+                                 Fernet(old_key)))
+
+
+def test_matching_key():
+    keys = [b'new' * 8, b'old' * 8]
+    records = {'a': ['a.com'], 'b': ['b.com']}
+    removed = list(incremental.record_hashes({'b': ['b.com']}, keys[1]))
+    assert incremental.matching_key(records, removed, keys) == keys[1]
+    assert incremental.matching_key(records, [], keys) == keys[0]
+    rekeyed = incremental.rekey_removed(records, removed, keys[1], keys[0])
+    assert incremental.apply_delta(dict(records), {'removed': rekeyed, 'added': {}, 'changed': {}},
+                                   keys[0]) == {'a': ['a.com']}
+    with pytest.raises(exceptions.BackupFailed):
+        incremental.rekey_removed({'a': ['a.com']}, removed, keys[1], keys[0])
+
+
+class Outage(MemoryFS):
+    down = True
+
+    def upload(self, *args, **kwargs):
+        if self.down:
+            raise ConnectionError("down")
+        return super().upload(*args, **kwargs)
+
+    def openbin(self, path, mode='r', *args, **kwargs):
+        if self.down and 'w' in mode:
+            raise ConnectionError("down")
+        return super().openbin(path, mode, *args, **kwargs)
+
+
+@pytest.mark.parametrize('settings', [{}, {"Format": "container", "Record Index": True}])
+def test_rotate_spooled_copy(two_stores, monkeypatch, tmpdir, settings):
+    runner, stores = two_stores
+    stores[1] = Outage()
+    runner.config.update(settings)
+    runner.config.update({"Spool Directory": str(tmpdir.join('spool')), "Upload Retries": 0})
+    backup = runner.backup()
+    # the backup, and its record index, wait in the spool for the second store
+    assert len(runner._spool().entries()) == (2 if settings else 1)
+
+    runner.new_key()
+    assert all(result.success for result in runner.rotate_key())
+    stores[1].down = False
+    delivered, failed = runner.drain_spool()
+    assert failed == [] and len(delivered) == (2 if settings else 1)
+    assert stores[1].readbytes('backupfolder/' + backup) == stores[0].readbytes('backupfolder/' + backup)
+    runner.config["Previous Encryption Keys"] = []
+    runner.configure_encryption()
+    assert all(result.status == verify.OK for result in runner.verify(plaintext=True))
@@ -0,0 +1,221 @@
+import hashlib
+import io
+from unittest import mock
+
+import pytest
+
+from lp_backup import exceptions, file_io, s3
+
+
+@pytest.fixture
+def s3_fs(monkeypatch):
+    client = mock.MagicMock()
+    monkeypatch.setattr(s3.MultipartS3FS, 'client', client)
+    monkeypatch.setattr(s3, 'RETRY_DELAY', 0)
+    return s3.MultipartS3FS('fake-bucket', strict=False, part_size=s3.MIN_PART_SIZE,
+                            concurrency=3)
+
+
+def test_multipart_upload(s3_fs):
+    data = bytes(range(256)) * (12 * s3.MIB // 256)
+    client = s3_fs.client
+    client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+    attempts = []
+
+    def upload_part(**kwargs):
+        attempts.append(kwargs['PartNumber'])
+        if attempts.count(2) == 1 and kwargs['PartNumber'] == 2:
+            raise ConnectionError("dropped")
+        return {'ETag': f"etag-{kwargs['PartNumber']}"}
+
+    client.upload_part.side_effect = upload_part
+    s3_fs.upload('hi/backup', io.BytesIO(data))
+    assert sorted(attempts) == [1, 2, 2, 3]
+    parts = {call[1]['PartNumber']: call[1]['Body'] for call in client.upload_part.call_args_list}
+    assert b''.join(parts[number] for number in [1, 2, 3]) == data
+    client.complete_multipart_upload.assert_called_once_with(
+        Bucket='fake-bucket', Key='hi/backup', UploadId='upload-1',
+        MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': f"etag-{number}"}
+                                   for number in [1, 2, 3]]})
+    client.upload_fileobj.assert_not_called()
+
+
+def test_multipart_upload_aborts(s3_fs):
+    client = s3_fs.client
+    client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+    client.upload_part.side_effect = ConnectionError("dropped")
+    with pytest.raises(Exception):
+        s3_fs.upload('backup', io.BytesIO(b'x' * (6 * s3.MIB)))
+    assert client.upload_part.call_count == 2 * s3.PART_RETRIES
+    # the upload is kept to be resumed until it is given up
+    client.abort_multipart_upload.assert_not_called()
+    s3_fs.discard_upload('backup')
+    client.abort_multipart_upload.assert_called_once_with(
+        Bucket='fake-bucket', Key='backup', UploadId='upload-1')
+    s3_fs.discard_upload('backup')
+    assert client.abort_multipart_upload.call_count == 1
+
+
+def test_multipart_upload_resumes(s3_fs):
+    data = bytes(range(256)) * (12 * s3.MIB // 256)
+    client = s3_fs.client
+    client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+    uploaded = []
+
+    def upload_part(**kwargs):
+        if kwargs['PartNumber'] == 3 and not uploaded.count(3):
+            uploaded.append(3)
+            raise ConnectionError("dropped")
+        uploaded.append(kwargs['PartNumber'])
+        return {'ETag': '"' + hashlib.md5(kwargs['Body']).hexdigest() + '"'}
+
+    client.upload_part.side_effect = upload_part
+    part_retries = s3_fs.part_retries
+    s3_fs.part_retries = 1
+    with pytest.raises(Exception):
+        s3_fs.upload('backup', io.BytesIO(data))
+    s3_fs.part_retries = part_retries
+    s3_fs.upload('backup', io.BytesIO(data))
+    # parts 1 and 2 were not sent again
+    assert sorted(uploaded) == [1, 2, 3, 3]
+    client.create_multipart_upload.assert_called_once()
+    parts = client.complete_multipart_upload.call_args[1]['MultipartUpload']['Parts']
+    assert [part['PartNumber'] for part in parts] == [1, 2, 3]
+    client.abort_multipart_upload.assert_not_called()
+
+
+def test_small_upload_is_single_request(s3_fs):
+    s3_fs.upload('backup', io.BytesIO(b'small'))
+    s3_fs.client.create_multipart_upload.assert_not_called()
+    s3_fs.client.upload_fileobj.assert_called_once()
+
+
+def test_ranged_download(s3_fs):
+    data = bytes(range(256)) * (11 * s3.MIB // 256)
+    client = s3_fs.client
+    client.head_object.return_value = {'ContentLength': len(data)}
+
+    def get_object(**kwargs):
+        start, end = kwargs['Range'][len('bytes='):].split('-')
+        return {'Body': io.BytesIO(data[int(start):int(end) + 1])}
+
+    client.get_object.side_effect = get_object
+    out = io.BytesIO()
+    s3_fs.download('backup', out)
+    assert out.getvalue() == data
+    assert client.get_object.call_count == 3
+
+
+class DroppedBody(object):
+    """A response body whose connection drops after some bytes."""
+    def __init__(self, data, error=True):
+        self.data = data
+        self.error = error
+
+    def read(self):
+        if self.error:
+            raise ConnectionError("dropped mid-download")
+        return self.data[:len(self.data) // 2]
+
+
+@pytest.mark.parametrize('error', [True, False])
+def test_ranged_download_retries_body(s3_fs, error):
+    data = bytes(range(256)) * (11 * s3.MIB // 256)
+    client = s3_fs.client
+    client.head_object.return_value = {'ContentLength': len(data)}
+    failed = []
+
+    def get_object(**kwargs):
+        start, end = kwargs['Range'][len('bytes='):].split('-')
+        part = data[int(start):int(end) + 1]
+        if start == str(s3.MIN_PART_SIZE) and not failed:
+            # the second part fails once, or comes back short
+            failed.append(start)
+            return {'Body': DroppedBody(part, error)}
+        return {'Body': io.BytesIO(part)}
+
+    client.get_object.side_effect = get_object
+    out = io.BytesIO()
+    s3_fs.download('backup', out)
+    assert out.getvalue() == data
+    assert client.get_object.call_count == 4
+
+
+def test_short_range_fails(s3_fs):
+    s3_fs.client.get_object.side_effect = lambda **kwargs: {'Body': io.BytesIO(b'fra')}
+    with pytest.raises(exceptions.BackupFailed, match="Read 3 of 5 bytes"):
+        s3_fs.read_range('backup', 100, 5)
+    assert s3_fs.client.get_object.call_count == s3.PART_RETRIES
+
+
+def test_open_stream(s3_fs):
+    client = s3_fs.client
+    client.get_object.return_value = {'Body': io.BytesIO(b'streamed')}
+    assert s3_fs.open_stream('backups/backup').read() == b'streamed'
+    client.get_object.assert_called_once_with(Bucket='fake-bucket', Key='backups/backup')
+
+
+def test_read_range(s3_fs):
+    client = s3_fs.client
+    client.get_object.return_value = {'Body': io.BytesIO(b'frame')}
+    assert s3_fs.read_range('backup', 100, 5) == b'frame'
+    client.get_object.assert_called_once_with(Bucket='fake-bucket', Key='backup',
+                                              Range='bytes=100-104')
+
+
+def test_object_info(s3_fs):
+    client = s3_fs.client
+    client.head_object.return_value = {'ContentLength': 42, 'ETag': '"abc123"'}
+    assert s3_fs.object_info('backup') == (42, 'abc123')
+    client.head_object.assert_called_once_with(Bucket='fake-bucket', Key='backup')
+
+
+def test_part_size_minimum():
+    with pytest.raises(exceptions.ConfigurationError):
+        s3.MultipartS3FS('fake-bucket', part_size=1024)
+
+
+def test_copy_from(s3_fs, monkeypatch):
+    client = s3_fs.client
+    source = s3.MultipartS3FS('other-bucket', strict=False)
+    assert s3_fs.shares_endpoint(source)
+    assert not s3_fs.shares_endpoint(s3.MultipartS3FS('other-bucket', strict=False,
+                                                      endpoint_url='https://elsewhere'))
+    client.head_object.return_value = {'ContentLength': 42}
+    assert s3_fs.copy_from(source, 'hi/backup', 'hi/backup') == 42
+    client.copy_object.assert_called_once_with(
+        Bucket='fake-bucket', Key='hi/backup',
+        CopySource={'Bucket': 'other-bucket', 'Key': 'hi/backup'},
+        ContentType='binary/octet-stream')
+
+    # objects too large for one request are copied in ranges
+    monkeypatch.setattr(s3, 'MAX_COPY_SIZE', 8 * s3.MIB)
+    client.head_object.return_value = {'ContentLength': 12 * s3.MIB}
+    client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+    client.upload_part_copy.side_effect = lambda **kwargs: {
+        'CopyPartResult': {'ETag': f"etag-{kwargs['PartNumber']}"}}
+    assert s3_fs.copy_from(source, 'big', 'big') == 12 * s3.MIB
+    ranges = sorted(call[1]['CopySourceRange'] for call in client.upload_part_copy.call_args_list)
+    assert ranges == ['bytes=0-5242879', 'bytes=10485760-12582911', 'bytes=5242880-10485759']
+    client.complete_multipart_upload.assert_called_once_with(
+        Bucket='fake-bucket', Key='big', UploadId='upload-1',
+        MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': f"etag-{number}"}
+                                   for number in [1, 2, 3]]})
+
+
+def test_streamed_backup_uploads_parts(s3_fs, monkeypatch):
+    data = bytes(range(256)) * (12 * s3.MIB // 256)
+    client = s3_fs.client
+    client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+    client.upload_part.side_effect = lambda **kwargs: {'ETag': f"etag-{kwargs['PartNumber']}"}
+    monkeypatch.setattr(s3_fs, 'move', mock.MagicMock())
+    monkeypatch.setattr(s3_fs, 'openbin', mock.MagicMock(side_effect=AssertionError(
+        "streamed backups should not be staged in a temporary file")))
+    chunks = (data[i:i + 64 * 1024] for i in range(0, len(data), 64 * 1024))
+    results = file_io.write_out_stream(s3_fs, chunks, 'backup')
+    assert results[0].success and results[0].bytes_written == len(data)
+    parts = {call[1]['PartNumber']: call[1]['Body'] for call in client.upload_part.call_args_list}
+    assert b''.join(parts[number] for number in [1, 2, 3]) == data
+    assert client.upload_part.call_args[1]['Key'] == 'backup.partial'
+    client.complete_multipart_upload.assert_called_once()
+    s3_fs.move.assert_called_once_with('backup.partial', 'backup', overwrite=True)
@@ -0,0 +1,84 @@
+import datetime
+import random
+from unittest import mock
+
+import pytest
+
+from lp_backup import exceptions
+from lp_backup import schedule
+
+
+def test_parse_schedule():
+    parsed = schedule.parse_schedule("*/15 0-6/3 1,15 * 7")
+    assert parsed['minute'] == {0, 15, 30, 45}
+    assert parsed['hour'] == {0, 3, 6}
+    assert parsed['day'] == {1, 15}
+    assert parsed['month'] == set(range(1, 13))
+    assert parsed['weekday'] == {0}
+    assert schedule.parse_schedule("@daily") == schedule.parse_schedule("0 0 * * *")
+    for bad in ["* * * *", "60 * * * *", "a * * * *", "*/0 * * * *", "5-1 * * * *"]:
+        with pytest.raises(exceptions.ConfigurationError):
+            schedule.parse_schedule(bad)
+
+
+def test_next_run():
+    after = datetime.datetime(2019, 1, 1, 10, 7, 30)
+    every_15 = schedule.parse_schedule("*/15 * * * *")
+    assert schedule.next_run(every_15, after) == datetime.datetime(2019, 1, 1, 10, 15)
+    assert (schedule.next_run(every_15, datetime.datetime(2019, 1, 1, 10, 15))
+            == datetime.datetime(2019, 1, 1, 10, 30))
+    nightly = schedule.parse_schedule("30 2 * * *")
+    assert schedule.next_run(nightly, after) == datetime.datetime(2019, 1, 2, 2, 30)
+    # 2019-01-01 was a Tuesday
+    sundays = schedule.parse_schedule("0 0 * * 0")
+    assert schedule.next_run(sundays, after) == datetime.datetime(2019, 1, 6)
+    # a restricted day of month and day of week match either one
+    either = schedule.parse_schedule("0 0 3 * 0")
+    assert schedule.next_run(either, after) == datetime.datetime(2019, 1, 3)
+    leap = schedule.parse_schedule("0 0 29 2 *")
+    assert schedule.next_run(leap, after) == datetime.datetime(2020, 2, 29)
+    with pytest.raises(exceptions.ConfigurationError):
+        schedule.next_run(schedule.parse_schedule("0 0 31 2 *"), after)
+
+
+def test_daemon_jitter():
+    now = datetime.datetime(2019, 1, 1, 10, 7)
+    daemon = schedule.Daemon(mock.MagicMock(), "@hourly", 300,
+                             rng=random.Random(1), now=lambda: now)
+    for _ in range(20):
+        delay = daemon.next_due() - datetime.datetime(2019, 1, 1, 11)
+        assert datetime.timedelta(0) <= delay <= datetime.timedelta(seconds=300)
+
+
+def test_daemon_runs_and_survives_failures(capsys):
+    runner = mock.MagicMock()
+    runner.backup.side_effect = [exceptions.BackupFailed("lpass broke"),
+                                 KeyError("Bucket"), "backup-3"]
+    clock = [datetime.datetime(2019, 1, 1, 10, 59, 59)]
+    daemon = schedule.Daemon(runner, "@hourly", now=lambda: clock[0])
+
+    def wait(timeout):
+        clock[0] += datetime.timedelta(seconds=timeout)
+        return False
+
+    daemon._wake.wait = wait
+    daemon.run(max_runs=3)
+    assert runner.ensure_login.call_count == 3
+    assert clock[0] >= datetime.datetime(2019, 1, 1, 13)
+    captured = capsys.readouterr()
+    assert "Backup failed: lpass broke" in captured.out
+    assert "Backup failed unexpectedly: KeyError('Bucket')" in captured.out
+    assert "Traceback" in captured.err
+    assert "New backup is backup-3" in captured.out
+
+
+def test_daemon_trigger_and_stop():
+    runner = mock.MagicMock()
+    daemon = schedule.Daemon(runner, "@yearly")
+    daemon.trigger()
+    daemon.run(max_runs=1)
+    runner.backup.assert_called_once_with()
+    daemon.stop()
+    daemon.run()
+    runner.backup.assert_called_once_with()
+
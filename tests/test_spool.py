@@ -0,0 +1,61 @@
+import io
+
+import fs.errors
+from fs.memoryfs import MemoryFS
+
+from lp_backup import file_io
+from lp_backup.spool import Spool
+
+
+class NamedFS(MemoryFS):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
+    def __str__(self):
+        return f"<{self.name}>"
+
+
+class DownFS(NamedFS):
+    def upload(self, *args, **kwargs):
+        raise fs.errors.RemoteConnectionError(msg="down")
+
+
+def test_spool_add_and_drain(tmp_path):
+    spool = Spool(tmp_path / 'spool')
+    assert spool.entries() == []
+    first = NamedFS('first')
+    second = NamedFS('second')
+    spool.add(first, 'hi/backup-1', b'one')
+    spool.add(second, 'hi/backup-2', io.BytesIO(b'two'))
+    spool.add(first, 'other/backup-3', b'three')
+    spool.add(NamedFS('gone'), 'hi/backup-4', b'four')
+    entries = spool.entries()
+    assert [entry['path'] for entry in entries] == [
+        'hi/backup-1', 'hi/backup-2', 'other/backup-3', 'hi/backup-4']
+    assert all(entry['attempts'] == 0 for entry in entries)
+
+    delivered, failed = spool.drain([first, second], 'hi', retry_delay=0)
+    assert delivered == [(first, 'hi/backup-1'), (second, 'hi/backup-2')]
+    assert failed == []
+    assert first.readbytes('hi/backup-1') == b'one'
+    assert second.readbytes('hi/backup-2') == b'two'
+    # copies under another prefix or for unknown stores are left alone
+    assert [entry['path'] for entry in spool.entries()] == ['other/backup-3', 'hi/backup-4']
+
+
+def test_spool_drain_failure(tmp_path):
+    spool = Spool(tmp_path / 'spool')
+    down = DownFS('down')
+    spool.add(down, 'backup', b'data')
+    delivered, failed = spool.drain(down, retries=1, retry_delay=0)
+    assert delivered == []
+    assert [(store, path) for store, path, _ in failed] == [(down, 'backup')]
+    assert spool.entries()[0]['attempts'] == 1
+
+    up = NamedFS('down')
+    delivered, failed = spool.drain([up], retry_delay=0)
+    assert delivered == [(up, 'backup')]
+    assert up.readbytes('backup') == b'data'
+    assert spool.entries() == []
+    assert file_io.store_label(up) == file_io.store_label(down)
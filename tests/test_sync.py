@@ -0,0 +1,110 @@
+import subprocess
+from unittest import mock
+
+import fs.errors
+import pytest
+from fs.memoryfs import MemoryFS
+
+from lp_backup import file_io, sync
+
+EXPORT = b"url,username,password\n" + b"site,user,pass\n" * 200
+
+
+class NamedFS(MemoryFS):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class BucketFS(NamedFS):
+    """A MemoryFS standing in for S3 buckets on one endpoint."""
+    def __init__(self, name):
+        super().__init__(name)
+        self.server_copies = []
+
+    def shares_endpoint(self, other):
+        return isinstance(other, BucketFS)
+
+    def copy_from(self, source, src_path, dst_path):
+        self.server_copies.append(src_path)
+        data = source.readbytes(src_path)
+        self.writebytes(dst_path, data)
+        return len(data)
+
+
+class UnreachableFS(NamedFS):
+    def listdir(self, path):
+        raise fs.errors.RemoteConnectionError(msg="unreachable")
+
+
+class TruncatingFS(NamedFS):
+    def upload(self, path, file, *args, **kwargs):
+        self.writebytes(path, file.read()[:-1])
+
+
+@pytest.fixture
+def backed_up(test_runner_one, monkeypatch):
+    stores = [NamedFS('local'), BucketFS('bucket')]
+    monkeypatch.setattr(test_runner_one, '_configure_backing_store', lambda: stores)
+    monkeypatch.setattr(subprocess, 'run', lambda *args, **kwargs: mock.MagicMock(
+        stdout=EXPORT, stderr=b""))
+    test_runner_one.config.update({"Date": True, "Retry Delay": 0})
+    backups = [test_runner_one.backup(), test_runner_one.backup()]
+    return test_runner_one, stores, backups
+
+
+def test_sync_backfills_new_stores(backed_up, monkeypatch):
+    runner, stores, backups = backed_up
+    new_stores = [NamedFS('new'), BucketFS('new-bucket')]
+    stores[0].remove('backupfolder/' + backups[0])
+    monkeypatch.setattr(runner, '_configure_backing_store', lambda: stores + new_stores)
+
+    planned = runner.sync(dry_run=True)
+    assert [(result.filename, str(result.source), str(result.target), result.method)
+            for result in planned] == [
+        (backups[0], 'bucket', 'local', sync.STREAM),
+        (backups[0], 'bucket', 'new', sync.STREAM),
+        (backups[0], 'bucket', 'new-bucket', sync.SERVER),
+        (backups[1], 'local', 'new', sync.STREAM),
+        (backups[1], 'bucket', 'new-bucket', sync.SERVER)]
+    assert not new_stores[0].exists('backupfolder/' + backups[0])
+    assert sync.report(planned[:1], dry_run=True) == [
+        f"Would copy {backups[0]} from bucket to local (stream)"]
+
+    results = runner.sync(max_workers=3)
+    assert all(result.error is None for result in results)
+    assert new_stores[1].server_copies == ['backupfolder/' + backup for backup in backups]
+    for backing_fs in stores + new_stores:
+        assert sorted(sync.listing(backing_fs, 'backupfolder')) == sorted(backups)
+        for backup in backups:
+            assert (backing_fs.readbytes('backupfolder/' + backup)
+                    == stores[1].readbytes('backupfolder/' + backup))
+        assert not [name for name in backing_fs.listdir('backupfolder')
+                    if name.endswith('.partial')]
+    labels = [file_io.store_label(backing_fs) for backing_fs in stores + new_stores]
+    for entry in runner.list_backups():
+        assert sorted(entry['stores']) == sorted(labels)
+    assert results[0].bytes_copied == len(stores[1].readbytes('backupfolder/' + backups[0]))
+
+    assert runner.sync() == []
+    assert sync.report([]) == ["Every store holds every backup."]
+
+
+def test_sync_failures(backed_up, monkeypatch):
+    runner, stores, backups = backed_up
+    unreachable = UnreachableFS('unreachable')
+    truncating = TruncatingFS('truncating')
+    monkeypatch.setattr(runner, '_configure_backing_store',
+                        lambda: [stores[0], unreachable, truncating])
+    results = runner.sync()
+    assert [(result.method, str(result.target)) for result in results] == [
+        (sync.LIST, 'unreachable'), (sync.STREAM, 'truncating'), (sync.STREAM, 'truncating')]
+    assert all(result.error is not None for result in results)
+    assert truncating.listdir('backupfolder') == []
+    lines = sync.report(results)
+    assert lines[0].startswith("Could not list unreachable:")
+    assert lines[1].startswith(f"Could not copy {backups[0]} to truncating:")
+    assert all('truncating' not in entry['stores'] for entry in runner.list_backups())
@@ -0,0 +1,110 @@
+import io
+import subprocess
+from unittest import mock
+
+import pytest
+from fs.memoryfs import MemoryFS
+
+from lp_backup import catalog, verify
+
+EXPORT = b"url,username,password\n" + b"site,user,pass\n" * 200
+
+
+class NamedFS(MemoryFS):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class S3LikeFS(NamedFS):
+    """A MemoryFS reporting S3 style metadata."""
+    def object_info(self, path):
+        data = self.readbytes(path)
+        return len(data), catalog.md5(data)
+
+
+@pytest.fixture
+def backed_up(test_runner_one, monkeypatch):
+    stores = [NamedFS('local'), S3LikeFS('s3')]
+    monkeypatch.setattr(test_runner_one, '_configure_backing_store', lambda: stores)
+    monkeypatch.setattr(subprocess, 'run', lambda *args, **kwargs: mock.MagicMock(
+        stdout=EXPORT, stderr=b""))
+    test_runner_one.config["Date"] = True
+    backups = [test_runner_one.backup(), test_runner_one.backup()]
+    return test_runner_one, stores, backups
+
+
+def test_verify_healthy(backed_up):
+    runner, stores, backups = backed_up
+    results = runner.verify()
+    assert [(result.filename, result.store, result.status, result.method)
+            for result in results] == [
+        (backups[0], stores[0], verify.OK, 'sha256'), (backups[0], stores[1], verify.OK, 'etag'),
+        (backups[1], stores[0], verify.OK, 'sha256'), (backups[1], stores[1], verify.OK, 'etag')]
+    assert [result.method for result in runner.verify(quick=True)] == ['size', 'etag'] * 2
+    assert [result.method for result in runner.verify(plaintext=True)] == ['plaintext'] * 4
+    lines = verify.report(results, stores)
+    assert lines == [
+        "local: healthy, 2 ok, 0 missing, 0 corrupt, 0 errors (2 by sha256)",
+        "s3: healthy, 2 ok, 0 missing, 0 corrupt, 0 errors (2 by etag)"]
+
+
+def test_verify_finds_damage(backed_up):
+    runner, stores, backups = backed_up
+    path = 'backupfolder/' + backups[0]
+    data = stores[0].readbytes(path)
+    stores[0].writebytes(path, data[:-1] + bytes([data[-1] ^ 1]))
+    stores[1].writebytes(path, data[:-10])
+    stores[1].remove('backupfolder/' + backups[1])
+    results = runner.verify(max_workers=2)
+    assert [(result.status, result.method) for result in results] == [
+        (verify.CORRUPT, 'sha256'), (verify.CORRUPT, 'size'), (verify.OK, 'sha256'),
+        (verify.MISSING, 'size')]
+    # a flipped bit passes a size check but not the plaintext check
+    results = runner.verify(quick=True, plaintext=True)
+    assert results[0].status == verify.CORRUPT
+    assert results[0].method == 'plaintext'
+    lines = verify.report(results, stores)
+    assert lines[0].startswith(f"CORRUPT  local  {backups[0]}  cannot be decoded")
+    assert lines[-2] == "local: DEGRADED, 1 ok, 0 missing, 1 corrupt, 0 errors (2 by plaintext)"
+    assert lines[-1] == "s3: DEGRADED, 0 ok, 1 missing, 1 corrupt, 0 errors (2 by size)"
+
+
+def test_verify_skips_copies_never_written(backed_up):
+    runner, stores, backups = backed_up
+    extra = NamedFS('extra')
+    stores.append(extra)
+    assert [result.store for result in runner.verify()] == stores[:2] * 2
+    assert verify.report([], [extra]) == [
+        "extra: healthy, 0 ok, 0 missing, 0 corrupt, 0 errors (nothing to check)"]
+
+
+def test_catalog_records_digests(backed_up, monkeypatch):
+    runner, stores, backups = backed_up
+    entry = runner.latest()
+    stored = stores[0].readbytes('backupfolder/' + entry['filename'])
+    assert entry['md5'] == catalog.md5(stored)
+    assert entry['plaintext_hmac'] == runner._plaintext_hmac(stores[0], entry)
+
+    runner.config["Streaming"] = True
+
+    class Export(object):
+        def __init__(self, *args, **kwargs):
+            self.stdout = io.BytesIO(EXPORT)
+            self.stderr = io.BytesIO(b"")
+
+        def poll(self):
+            return 0
+
+        def wait(self):
+            return 0
+
+    monkeypatch.setattr(subprocess, 'Popen', Export)
+    streamed = runner.backup()
+    entry = runner.latest()
+    assert entry['filename'] == streamed
+    assert entry['md5'] == catalog.md5(stores[1].readbytes('backupfolder/' + streamed))
+    assert entry['plaintext_hmac'] == runner._plaintext_hmac(stores[1], entry)